@@ -0,0 +1,166 @@
+from datetime import date
+from typing import Dict, Iterable, Optional
+
+import sqlalchemy as sa
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from .models import AllocationPolicy, Branch, DailySales, Expense, ExpenseAllocation, ExpenseScope
+
+REVENUE_WINDOW = 30  # days of revenue, up to the expense date, weighting a revenue_weighted split
+
+
+def _policy_allocations(expenses: sa.Select) -> sa.Select:
+    """(expense_id, branch_id, day, amount) rows of every non-custom expense in `expenses`.
+
+    Branch expenses go to their branch and main office expenses to no
+    branch. Company-wide expenses are split over the active branches, evenly
+    or by recent revenue; with no revenue to weigh by the split is even, and
+    with no active branch the whole amount goes to the main office.
+    """
+    e = expenses.where(Expense.allocation_policy != AllocationPolicy.CUSTOM.value).subquery('e')
+    branches = sa.select(Branch.id).where(Branch.is_active == True).subquery('active_branches')
+
+    direct = sa.select(
+        e.c.id,
+        sa.case((e.c.scope == ExpenseScope.BRANCH.value, e.c.branch_id), else_=sa.null()),
+        e.c.date_created,
+        e.c.amount
+    ).where(
+        sa.or_(
+            e.c.scope != ExpenseScope.COMPANY_WIDE.value,
+            ~sa.exists(sa.select(branches.c.id))
+        )
+    )
+
+    revenue = (
+        sa.select(sa.func.coalesce(sa.func.sum(DailySales.revenue), 0))
+        .where(
+            DailySales.branch_id == branches.c.id,
+            DailySales.day.between(e.c.date_created - REVENUE_WINDOW + 1, e.c.date_created)
+        )
+        .scalar_subquery()
+    )
+    weight = sa.case(
+        (e.c.allocation_policy == AllocationPolicy.REVENUE_WEIGHTED.value, revenue),
+        else_=1.0
+    )
+    per_expense = {'partition_by': e.c.id}
+    share = sa.func.coalesce(
+        weight / sa.func.nullif(sa.func.sum(weight).over(**per_expense), 0),
+        1.0 / sa.func.count().over(**per_expense)
+    )
+    split = sa.select(
+        e.c.id,
+        branches.c.id,
+        e.c.date_created,
+        e.c.amount * share
+    ).select_from(e.join(branches, sa.true())).where(e.c.scope == ExpenseScope.COMPANY_WIDE.value)
+
+    return sa.union_all(direct, split)
+
+
+def _insert_allocations(db: Session, expenses: sa.Select) -> int:
+    rows = _policy_allocations(expenses)
+    return db.execute(
+        sa.insert(ExpenseAllocation).from_select(['expense_id', 'branch_id', 'day', 'amount'], rows)
+    ).rowcount
+
+
+def allocate_expense(db: Session, expense: Expense, custom: Optional[Dict[int, float]] = None):
+    """(Re)write the allocation of one expense, in the caller's transaction.
+
+    Call it whenever an expense is created or its amount, date or policy
+    changes. `custom` maps branch_id to amount and is required the first
+    time a custom policy is set; afterwards the existing split is kept and
+    rescaled to the current amount.
+    """
+    db.flush()
+
+    if expense.allocation_policy == AllocationPolicy.CUSTOM:
+        if custom is None:
+            existing = {a.branch_id: a.amount for a in expense.allocations}
+            total = sum(existing.values())
+            if not existing or not total:
+                raise HTTPException(status_code=400, detail="Custom allocation requires allocations per branch")
+            custom = {branch_id: amount * expense.amount / total for branch_id, amount in existing.items()}
+        validate_custom_allocation(db, expense.amount, custom)
+
+    db.execute(sa.delete(ExpenseAllocation).where(ExpenseAllocation.expense_id == expense.id))
+    db.expire(expense, ['allocations'])
+
+    if expense.allocation_policy == AllocationPolicy.CUSTOM:
+        db.execute(sa.insert(ExpenseAllocation), [
+            {
+                'expense_id': expense.id,
+                'branch_id': branch_id,
+                'day': expense.date_created,
+                'amount': amount
+            }
+            for branch_id, amount in custom.items()
+        ])
+    else:
+        _insert_allocations(db, sa.select(Expense).where(Expense.id == expense.id))
+
+
+def validate_custom_allocation(db: Session, amount: float, custom: Dict[int, float]):
+    """Raise a 400 unless `custom` charges existing branches exactly `amount` in total"""
+    if not custom or any(value < 0 for value in custom.values()):
+        raise HTTPException(status_code=400, detail="Custom allocation needs non-negative amounts per branch")
+    if abs(sum(custom.values()) - amount) > 0.005:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Custom allocation totals {sum(custom.values()):.2f}, expected {amount:.2f}"
+        )
+    known = {
+        branch_id for (branch_id,) in
+        db.query(Branch.id).filter(Branch.id.in_(list(custom)))
+    }
+    missing = set(custom) - known
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown branches in allocation: {sorted(missing)}")
+
+
+def reallocate_company_wide(db: Session, since: Optional[date] = None) -> int:
+    """Rewrite the even and revenue-weighted splits after the branch set changed.
+
+    Only company-wide expenses dated on or after `since` (the start of the
+    current month by default) move: earlier periods stay as they were
+    reported. Returns the number of allocation rows written.
+    """
+    since = since or date.today().replace(day=1)
+    expenses = sa.select(Expense).where(
+        Expense.scope == ExpenseScope.COMPANY_WIDE.value,
+        Expense.date_created >= since
+    )
+    return _reallocate(db, expenses)
+
+
+def backfill_allocations(db: Session, expense_ids: Optional[Iterable[int]] = None) -> int:
+    """Rebuild the allocation of every non-custom expense, or of the given ones"""
+    expenses = sa.select(Expense)
+    if expense_ids is not None:
+        expenses = expenses.where(Expense.id.in_(list(expense_ids)))
+    return _reallocate(db, expenses)
+
+
+def _reallocate(db: Session, expenses: sa.Select) -> int:
+    db.flush()
+    ids = expenses.where(Expense.allocation_policy != AllocationPolicy.CUSTOM.value).with_only_columns(Expense.id)
+    db.execute(
+        sa.delete(ExpenseAllocation).where(ExpenseAllocation.expense_id.in_(ids)),
+        execution_options={'synchronize_session': False}
+    )
+    return _insert_allocations(db, expenses)
+
+
+if __name__ == '__main__':
+    # python -m api.allocations, rebuilds every non-custom allocation
+    from .database import SessionLocal
+
+    session = SessionLocal()
+    try:
+        print(f"{backfill_allocations(session)} allocation rows written")
+        session.commit()
+    finally:
+        session.close()
@@ -0,0 +1,133 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from .models import DataVersion
+from .parallel import run_queries
+
+COMPANY_SCOPE = 'company'
+
+
+def branch_scope(branch_id: int) -> str:
+    return f'branch:{branch_id}'
+
+
+def bump_data_version(db: Session, branch_id: Optional[int] = None):
+    """Invalidate cached analytics that cover a branch, or everything when branch_id is None.
+
+    Runs in the caller's transaction so the bump commits or rolls back with the write.
+    """
+    scope = branch_scope(branch_id) if branch_id is not None else COMPANY_SCOPE
+    stmt = insert(DataVersion).values(scope=scope, version=1)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[DataVersion.scope],
+        set_={'version': DataVersion.version + 1}
+    ))
+
+
+def _data_version(db: Session, branch_id: Optional[int]) -> tuple:
+    """Version token of the data a response depends on: one branch plus company-wide data, or everything"""
+    query = sa.select(DataVersion.scope, DataVersion.version)
+    if branch_id is not None:
+        query = query.where(DataVersion.scope.in_([COMPANY_SCOPE, branch_scope(branch_id)]))
+    return tuple(sorted(db.execute(query).all()))
+
+
+class ResponseCache:
+    """In-process LRU of endpoint responses, invalidated by data versions with a TTL as backstop"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, entry_version, expires_at = entry
+            if entry_version != version:
+                self.stale += 1
+            elif expires_at < time.monotonic():
+                self.expired += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, version):
+        with self._lock:
+            self._entries[key] = (value, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "stale": self.stale,
+                "expired": self.expired,
+                "evictions": self.evictions
+            }
+
+
+analytics_cache = ResponseCache()
+
+
+def cached_response(scope: Callable[[dict], Optional[int]] = lambda kwargs: None):
+    """Cache an async endpoint's return value in analytics_cache.
+
+    The key is the endpoint, its query parameters and the caller's role and
+    branch. `scope` maps the endpoint kwargs to the branch the response
+    depends on, None meaning every branch. The endpoint must take `db` and
+    `current_user`. The data version is read on a worker connection, not
+    the request session, so the event loop never waits on it.
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(**kwargs):
+            user = kwargs['current_user']
+            params = tuple(sorted(
+                (name, value) for name, value in kwargs.items()
+                if name not in ('db', 'current_user')
+            ))
+            key = (endpoint.__name__, params, user['role'], user.get('branch_id'))
+            branch_id = scope(kwargs)
+            version, = await run_queries("data_version", lambda db: _data_version(db, branch_id))
+
+            response = analytics_cache.get(key, version)
+            if response is None:
+                response = await endpoint(**kwargs)
+                analytics_cache.set(key, response, version)
+            return response
+        return wrapper
+    return decorator
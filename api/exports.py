@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+from enum import Enum
+
+import sqlalchemy as sa
+from fastapi.responses import StreamingResponse
+
+from .database import SessionLocal
+
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+MEDIA_TYPES = {
+    ExportFormat.CSV: "text/csv",
+    ExportFormat.NDJSON: "application/x-ndjson"
+}
+
+
+def _stream_rows(query: sa.Select, export_format: ExportFormat, batch_size: int):
+    """Run `query` on a server-side cursor and yield it encoded, one chunk per fetched batch.
+
+    Uses its own session: the request's session is closed by the time the
+    response body is sent.
+    """
+    db = SessionLocal()
+    try:
+        result = db.execute(query, execution_options={'yield_per': batch_size})
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        if export_format == ExportFormat.CSV:
+            writer.writerow(columns)
+            yield buffer.getvalue()
+
+        for rows in result.partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            if export_format == ExportFormat.CSV:
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(columns, row)), default=str))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+    finally:
+        db.close()
+
+
+def export_response(query: sa.Select, filename: str, export_format: ExportFormat, batch_size: int = 1000) -> StreamingResponse:
+    """Stream the rows of `query` as a CSV or NDJSON download.
+
+    Memory stays bounded by `batch_size` rows however large the range is,
+    and the first rows are sent while the rest are still being fetched.
+    """
+    return StreamingResponse(
+        _stream_rows(query, export_format, batch_size),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format.value}"'}
+    )
@@ -0,0 +1,364 @@
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import sqlalchemy as sa
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from .models import Branch, BranchProduct, BranchType, Product, ProductBatch
+
+
+# Default days-until-expiry thresholds, the same as ProductBatch.expiry_status
+EXPIRY_EXPIRED_DAYS = 0
+EXPIRY_CRITICAL_DAYS = 30
+EXPIRY_WARNING_DAYS = 90
+
+
+def expiry_bucket(
+    expiration_date,
+    today: Optional[date] = None,
+    expired_days: int = EXPIRY_EXPIRED_DAYS,
+    critical_days: int = EXPIRY_CRITICAL_DAYS,
+    warning_days: int = EXPIRY_WARNING_DAYS
+):
+    """SQL counterpart of ProductBatch.expiry_status: expired, critical, warning or good"""
+    days = expiration_date - (today or date.today())
+    return sa.case(
+        (days <= expired_days, "expired"),
+        (days <= critical_days, "critical"),
+        (days <= warning_days, "warning"),
+        else_="good"
+    )
+
+
+def allocate_fefo(db: Session, branch_id: int, demands: Dict[int, int]) -> Dict[int, List[dict]]:
+    """Deduct quantities from active batches, earliest expiry first.
+
+    `demands` maps product_id to the quantity to take. All products are
+    allocated by a single UPDATE driven by window-function running totals,
+    so the cost is one round trip per call regardless of batch count.
+
+    Returns the allocation per product_id as a list of
+    {"batch_id", "expiration_date", "quantity"} dicts in FEFO order.
+    Raises a 400 if any product does not have enough active stock; callers
+    must not commit in that case.
+    """
+    demands = {product_id: quantity for product_id, quantity in demands.items() if quantity > 0}
+    if not demands:
+        return {}
+
+    # Pending deliveries and pull-outs must be visible to the statement
+    db.flush()
+
+    # Lock the candidate batches in id order: concurrent allocations for the
+    # same products queue here instead of deducting from the same stock, and
+    # the UPDATE below then reads the quantities they committed
+    lock_batches(db, sa.and_(
+        ProductBatch.branch_id == branch_id,
+        ProductBatch.product_id.in_(list(demands)),
+        ProductBatch.is_active == True,
+        ProductBatch.quantity > 0
+    ))
+
+    demand = sa.values(
+        sa.column('product_id', sa.Integer),
+        sa.column('quantity', sa.Integer),
+        name='demand'
+    ).data(list(demands.items()))
+
+    ranked = (
+        sa.select(
+            ProductBatch.id.label('batch_id'),
+            ProductBatch.quantity.label('quantity'),
+            demand.c.quantity.label('demand'),
+            (
+                sa.func.sum(ProductBatch.quantity).over(
+                    partition_by=ProductBatch.product_id,
+                    order_by=(ProductBatch.expiration_date, ProductBatch.id)
+                ) - ProductBatch.quantity
+            ).label('consumed_before'),
+            sa.func.sum(ProductBatch.quantity).over(
+                partition_by=ProductBatch.product_id
+            ).label('available')
+        )
+        .select_from(ProductBatch)
+        .join(demand, demand.c.product_id == ProductBatch.product_id)
+        .where(
+            ProductBatch.branch_id == branch_id,
+            ProductBatch.is_active == True,
+            ProductBatch.quantity > 0
+        )
+        .cte('ranked')
+    )
+
+    allocation = (
+        sa.select(
+            ranked.c.batch_id,
+            ranked.c.available,
+            sa.func.least(ranked.c.quantity, ranked.c.demand - ranked.c.consumed_before).label('allocated')
+        )
+        .where(ranked.c.consumed_before < ranked.c.demand)
+        .cte('allocation')
+    )
+
+    remaining = ProductBatch.quantity - allocation.c.allocated
+    rows = db.execute(
+        sa.update(ProductBatch)
+        .where(ProductBatch.id == allocation.c.batch_id)
+        .values(quantity=remaining, is_active=remaining > 0)
+        .returning(
+            ProductBatch.id,
+            ProductBatch.product_id,
+            ProductBatch.expiration_date,
+            allocation.c.allocated,
+            allocation.c.available
+        ),
+        execution_options={'synchronize_session': 'fetch'}
+    ).all()
+
+    allocations = defaultdict(list)
+    available = {}
+    for row in rows:
+        allocations[row.product_id].append({
+            "batch_id": row.id,
+            "expiration_date": row.expiration_date,
+            "quantity": row.allocated
+        })
+        available[row.product_id] = row.available
+
+    for product_id, required in demands.items():
+        allocated = sum(a["quantity"] for a in allocations[product_id])
+        if allocated < required:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient quantity available for product {product_id}. "
+                       f"Required: {required}, Available: {available.get(product_id, 0)}"
+            )
+        allocations[product_id].sort(key=lambda a: (a["expiration_date"], a["batch_id"]))
+
+    return dict(allocations)
+
+
+def take_allocated(allocations: Dict[int, List[dict]], product_id: int, quantity: int) -> List[dict]:
+    """Split `quantity` of one line over what allocate_fefo allocated to its product.
+
+    Consumes the allocation in FEFO order, so lines of the same product
+    sharing one allocate_fefo call each get their own batches. Returns
+    {"batch_id", "expiration_date", "quantity"} dicts.
+    """
+    product_allocations = allocations[product_id]
+    taken = []
+    while quantity > 0:
+        allocation = product_allocations[0]
+        used = min(allocation["quantity"], quantity)
+        taken.append({**allocation, "quantity": used})
+        allocation["quantity"] -= used
+        if allocation["quantity"] == 0:
+            product_allocations.pop(0)
+        quantity -= used
+    return taken
+
+
+def return_to_batches(db: Session, returns: Dict[int, int]):
+    """Put quantities back on the batches they were taken from, reactivating emptied ones.
+
+    `returns` maps batch_id to the quantity to give back, e.g. the
+    allocation of a voided transaction. Locks the batches like
+    allocate_fefo; callers sync the branch products afterwards.
+    """
+    returns = {batch_id: quantity for batch_id, quantity in returns.items() if quantity > 0}
+    if not returns:
+        return
+
+    db.flush()
+    lock_batches(db, ProductBatch.id.in_(list(returns)))
+
+    returned = sa.values(
+        sa.column('batch_id', sa.Integer),
+        sa.column('quantity', sa.Integer),
+        name='returned'
+    ).data(list(returns.items()))
+
+    db.execute(
+        sa.update(ProductBatch)
+        .where(ProductBatch.id == returned.c.batch_id)
+        .values(quantity=ProductBatch.quantity + returned.c.quantity, is_active=True),
+        execution_options={'synchronize_session': 'fetch'}
+    )
+
+
+def lock_batches(db: Session, criteria):
+    """SELECT ... FOR UPDATE the batches matching `criteria`, in id order.
+
+    Every writer of batch quantities locks them this way before reading
+    them, so concurrent writers queue instead of losing updates, and
+    always take the locks in the same order, so they cannot deadlock.
+    """
+    db.execute(
+        sa.select(ProductBatch.id)
+        .where(criteria)
+        .order_by(ProductBatch.id)
+        .with_for_update()
+    )
+
+
+def remaining_stock(batches: List[ProductBatch], demand: int = 0) -> Tuple[int, Optional[date]]:
+    """Quantity and earliest expiry left in loaded active batches once `demand` is taken FEFO"""
+    remaining = sum(b.quantity for b in batches) - demand
+    earliest = None
+    for batch in sorted((b for b in batches if b.quantity > 0), key=lambda b: b.expiration_date):
+        demand -= batch.quantity
+        if demand < 0:
+            earliest = batch.expiration_date
+            break
+    return remaining, earliest
+
+
+def _batch_totals():
+    """Active quantity and earliest expiry per (branch, product), computed from the batches"""
+    return (
+        sa.select(
+            ProductBatch.branch_id,
+            ProductBatch.product_id,
+            sa.func.sum(ProductBatch.quantity).label('quantity'),
+            sa.func.min(ProductBatch.expiration_date).filter(ProductBatch.quantity > 0).label('expiration_date')
+        )
+        .where(ProductBatch.is_active == True)
+        .group_by(ProductBatch.branch_id, ProductBatch.product_id)
+        .subquery('batch_totals')
+    )
+
+
+def find_stock_drift(db: Session, branch_id: Optional[int] = None) -> List[dict]:
+    """Branch products whose stored stock no longer matches their active batches"""
+    totals = _batch_totals()
+    expected_quantity = sa.func.coalesce(totals.c.quantity, 0)
+    query = (
+        sa.select(
+            BranchProduct.branch_id,
+            BranchProduct.product_id,
+            BranchProduct.quantity,
+            BranchProduct.current_expiration_date,
+            expected_quantity.label('expected_quantity'),
+            totals.c.expiration_date.label('expected_expiration_date')
+        )
+        .outerjoin(totals, sa.and_(
+            totals.c.branch_id == BranchProduct.branch_id,
+            totals.c.product_id == BranchProduct.product_id
+        ))
+        .where(sa.or_(
+            BranchProduct.quantity.is_distinct_from(expected_quantity),
+            BranchProduct.current_expiration_date.is_distinct_from(totals.c.expiration_date)
+        ))
+        .order_by(BranchProduct.branch_id, BranchProduct.product_id)
+    )
+    if branch_id is not None:
+        query = query.where(BranchProduct.branch_id == branch_id)
+
+    return [dict(row._mapping) for row in db.execute(query)]
+
+
+def sync_branch_stock(db: Session, branch_id: Optional[int] = None, product_ids: Optional[Iterable[int]] = None) -> int:
+    """Recompute stored quantity and earliest expiry from the active batches.
+
+    Call it in the same transaction as any batch mutation that did not
+    already set the branch product from loaded batches. Only rows that
+    drifted are written; low stock state is refreshed for the same branch.
+    Returns the number of repaired rows.
+    """
+    db.flush()
+
+    quantity = (
+        sa.select(sa.func.coalesce(sa.func.sum(ProductBatch.quantity), 0))
+        .where(
+            ProductBatch.branch_id == BranchProduct.branch_id,
+            ProductBatch.product_id == BranchProduct.product_id,
+            ProductBatch.is_active == True
+        )
+        .scalar_subquery()
+    )
+    expiration_date = (
+        sa.select(sa.func.min(ProductBatch.expiration_date))
+        .where(
+            ProductBatch.branch_id == BranchProduct.branch_id,
+            ProductBatch.product_id == BranchProduct.product_id,
+            ProductBatch.is_active == True,
+            ProductBatch.quantity > 0
+        )
+        .scalar_subquery()
+    )
+
+    stmt = (
+        sa.update(BranchProduct)
+        .where(sa.or_(
+            BranchProduct.quantity.is_distinct_from(quantity),
+            BranchProduct.current_expiration_date.is_distinct_from(expiration_date)
+        ))
+        .values(quantity=quantity, current_expiration_date=expiration_date)
+    )
+    if branch_id is not None:
+        stmt = stmt.where(BranchProduct.branch_id == branch_id)
+    if product_ids is not None:
+        stmt = stmt.where(BranchProduct.product_id.in_(list(product_ids)))
+
+    repaired = db.execute(stmt, execution_options={'synchronize_session': 'fetch'}).rowcount
+    refresh_low_stock(db, branch_id=branch_id)
+    return repaired
+
+
+def low_stock_threshold(product: Product, branch_type: str) -> int:
+    """Low stock threshold of a product for the given branch type"""
+    if branch_type == BranchType.WHOLESALE:
+        return product.wholesale_low_stock_threshold
+    return product.retail_low_stock_threshold
+
+
+def apply_low_stock(branch_product: BranchProduct, product: Product, branch_type: str, quantity: int):
+    """Set or clear low_stock_since on a loaded branch product whose active quantity is known"""
+    is_low = branch_product.is_available and quantity <= low_stock_threshold(product, branch_type)
+    if is_low and not branch_product.low_stock_since:
+        branch_product.low_stock_since = datetime.now()
+    elif not is_low and branch_product.low_stock_since:
+        branch_product.low_stock_since = None
+
+
+def refresh_low_stock(db: Session, branch_id: Optional[int] = None, product_id: Optional[int] = None):
+    """Set or clear low_stock_since for every matching branch product.
+
+    Write-side counterpart of BranchProduct.is_low_stock: call it in the same
+    transaction as anything that changes stock, availability or thresholds.
+    Runs as one UPDATE that only touches rows whose low stock state flipped.
+    """
+    db.flush()
+
+    threshold = (
+        sa.select(sa.case(
+            (Branch.branch_type == BranchType.WHOLESALE.value, Product.wholesale_low_stock_threshold),
+            else_=Product.retail_low_stock_threshold
+        ))
+        .where(
+            Branch.id == BranchProduct.branch_id,
+            Product.id == BranchProduct.product_id
+        )
+        .scalar_subquery()
+    )
+    is_low = sa.and_(BranchProduct.is_available == True, BranchProduct.quantity <= threshold)
+
+    stmt = (
+        sa.update(BranchProduct)
+        .where(sa.or_(
+            sa.and_(BranchProduct.low_stock_since == None, is_low),
+            sa.and_(BranchProduct.low_stock_since != None, sa.not_(is_low))
+        ))
+        .values(low_stock_since=sa.case(
+            (BranchProduct.low_stock_since == None, datetime.now()),
+            else_=None
+        ))
+    )
+    if branch_id is not None:
+        stmt = stmt.where(BranchProduct.branch_id == branch_id)
+    if product_id is not None:
+        stmt = stmt.where(BranchProduct.product_id == product_id)
+
+    db.execute(stmt, execution_options={'synchronize_session': 'fetch'})
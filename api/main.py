@@ -1,11 +1,30 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .routers import auth, products, branches, branch_products, inventory_reports, clients, transactions, expenses, suppliers, analytics, app_management
 from fastapi.staticfiles import StaticFiles
 
 from .database import Base, engine
-
-app = FastAPI()
+from .metrics import metric_writer
+from .snapshots import snapshot_loop
+from .timeseries import compaction_loop, prepare_partitions
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # analytics_timeseries is partitioned by month, this month's partition must exist before any write
+    await asyncio.to_thread(prepare_partitions)
+    # Dashboard metrics are snapshotted in the background instead of on every GET
+    snapshot_task = asyncio.create_task(snapshot_loop())
+    compaction_task = asyncio.create_task(compaction_loop())
+    metric_writer.start()
+    yield
+    snapshot_task.cancel()
+    compaction_task.cancel()
+    metric_writer.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/product_images", StaticFiles(directory="static/product_images"), name="product_images")
 app.mount("/apk_files", StaticFiles(directory="static/apk_files"), name="apk_files")
@@ -0,0 +1,102 @@
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+import sqlalchemy as sa
+
+from .database import SessionLocal
+from .models import AnalyticsTimeSeries
+
+logger = logging.getLogger(__name__)
+
+
+class MetricWriter:
+    """Buffers AnalyticsTimeSeries points and writes them with one multi-row INSERT.
+
+    Requests only append to an in-memory buffer; a background thread flushes
+    it every `flush_interval` seconds, or sooner once `batch_size` points are
+    waiting. The buffer holds at most `max_size` points, the oldest are
+    dropped (and counted) if the database cannot keep up. Points are lost if
+    the process dies before a flush, so only record what may be lost.
+    """
+
+    def __init__(self, max_size: int = 10000, batch_size: int = 500, flush_interval: float = 5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._buffer = deque(maxlen=max_size)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def record(self, metric_name: str, value: float, branch_id: Optional[int] = None,
+               product_id: Optional[int] = None, timestamp: Optional[datetime] = None):
+        """Queue one data point, never touches the database"""
+        point = {
+            "metric_name": metric_name,
+            "value": value,
+            "timestamp": timestamp or datetime.now(),
+            "branch_id": branch_id,
+            "product_id": product_id
+        }
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(point)
+            pending = len(self._buffer)
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """Write everything buffered so far, returns the number of points written"""
+        with self._lock:
+            points = list(self._buffer)
+            self._buffer.clear()
+        if not points:
+            return 0
+
+        db = SessionLocal()
+        try:
+            db.execute(sa.insert(AnalyticsTimeSeries).values(points))
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Failed to write %d metric points", len(points))
+            with self._lock:
+                # Put them back in front of anything recorded meanwhile, the bound still applies
+                room = min(self._buffer.maxlen - len(self._buffer), len(points))
+                if room:
+                    self._buffer.extendleft(reversed(points[-room:]))
+                self.dropped += len(points) - room
+            return 0
+        finally:
+            db.close()
+        return len(points)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="metric-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and flush what is left"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+metric_writer = MetricWriter()
@@ -1,12 +1,12 @@
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Table, Float, Date, select, DateTime, ARRAY
-from sqlalchemy.orm import relationship, column_property
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Table, Float, Date, select, DateTime, ARRAY, Index, event, DDL
+from sqlalchemy.orm import relationship, column_property, synonym
 from .database import Base, engine
 from datetime import date, datetime, timezone
 from enum import Enum
+from typing import Optional
 from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import Optional
-from sqlalchemy.orm import object_session
+from sqlalchemy.dialects.postgresql import insert
 
 
 class UserRole(str, Enum):
@@ -70,9 +70,14 @@ class BranchProduct(Base):
 
     product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
     branch_id = Column(Integer, ForeignKey('branches.id'), primary_key=True)
-    quantity = Column(Integer)
+    quantity = Column(Integer, nullable=False, default=0, server_default='0')  # Sum of active batch quantities
+    current_expiration_date = Column(Date, nullable=True)  # Earliest expiry among active batches with stock
     is_available = Column(Boolean, default=False)
     low_stock_since = Column(DateTime, nullable=True)
+
+    # quantity and current_expiration_date are kept in step with product_batches
+    # by every batch mutation, see api.inventory.sync_branch_stock
+    active_quantity = synonym("quantity")
     
     product = relationship("Product", back_populates="branch_products")
     branch = relationship("Branch", back_populates="branch_products")
@@ -87,22 +92,6 @@ class BranchProduct(Base):
     def peso_value(self):
         return self.quantity * self.product.cost
 
-    @property
-    def current_expiration_date(self):
-        if not self.batches:
-            return None
-        active_batches = [b for b in self.batches if b.is_active]
-        if not active_batches:
-            return None
-        return min(b.expiration_date for b in active_batches)
-
-    @property
-    def active_quantity(self):
-        return sum(
-            batch.quantity for batch in self.batches 
-            if batch.is_active
-        )
-
     @property
     def is_low_stock(self):
         if not self.product or not self.is_available:
@@ -113,22 +102,8 @@ class BranchProduct(Base):
             if self.branch.branch_type == BranchType.WHOLESALE 
             else self.product.retail_low_stock_threshold
         )
-        is_low = self.active_quantity <= threshold
-        
-        # Get the session
-        session = object_session(self)
-        if session is not None:
-            # Update low_stock_since when status changes
-            if is_low and not self.low_stock_since:
-                self.low_stock_since = datetime.now()
-                session.add(self)
-                session.commit()
-            elif not is_low and self.low_stock_since:
-                self.low_stock_since = None
-                session.add(self)
-                session.commit()
-            
-        return is_low
+        # low_stock_since is maintained on the write side, see api.inventory.refresh_low_stock
+        return self.active_quantity <= threshold
 
     @property
     def days_in_low_stock(self):
@@ -155,6 +130,12 @@ class InvReport(Base):
     products_with_pullout = Column(Integer, default=0)
     products_with_offtake = Column(Integer, default=0)
     total_offtake_value = Column(Float, default=0)
+
+    __table_args__ = (
+        Index('ix_invreports_branch_id_created_at', branch_id, created_at),
+        Index('ix_invreports_branch_id_end_date', branch_id, end_date),
+        Index('ix_invreports_end_date', end_date),
+    )
     items = relationship("InvReportItem", back_populates="invreport")
     branch = relationship("Branch", back_populates="invreports")
 
@@ -169,6 +150,13 @@ class InvReportItem(Base):
     offtake = Column(Integer)
     current_cost = Column(Float)
     current_srp = Column(Float)
+
+    __table_args__ = (
+        # Covers the offtake * srp / cost sums so analytics never visit the heap
+        Index('ix_invreport_items_invreport_id_product_id', invreport_id, product_id,
+              postgresql_include=['offtake', 'current_srp', 'current_cost']),
+        Index('ix_invreport_items_product_id', product_id),
+    )
     
     invreport = relationship("InvReport", back_populates="items")
     product = relationship("Product", back_populates="inv_report_items")
@@ -190,6 +178,10 @@ class InvReportItem(Base):
     def pull_out_batches(self):
         return [b for b in self.batches if b.batch_type == 'pull_out']
 
+    @property
+    def offtake_batches(self):
+        return [b for b in self.batches if b.batch_type == 'offtake']
+
     @property
     def pull_out(self):
         session = Session.object_session(self)
@@ -233,6 +225,11 @@ class ExpenseType(str, Enum):
     TRANSPORTATION = "transportation"
     OTHERS = "others"
 
+class AllocationPolicy(str, Enum):
+    EVEN = "even"                           # company-wide expenses split evenly over active branches
+    REVENUE_WEIGHTED = "revenue_weighted"   # split by each branch's revenue over the preceding 30 days
+    CUSTOM = "custom"                       # split given explicitly when the expense is written
+
 class Expense(Base):
     __tablename__ = "expenses"
 
@@ -243,13 +240,20 @@ class Expense(Base):
     date_created = Column(Date, default=date.today)
     scope = Column(String, nullable=False, default=ExpenseScope.BRANCH)
     branch_id = Column(Integer, ForeignKey('branches.id'), nullable=True)
+    allocation_policy = Column(String, nullable=False, default=AllocationPolicy.EVEN, server_default=AllocationPolicy.EVEN.value)
     created_by_id = Column(Integer, ForeignKey('users.id'))
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
+    __table_args__ = (
+        Index('ix_expenses_date_created_scope', date_created, scope),
+        Index('ix_expenses_branch_id_date_created', branch_id, date_created),
+    )
+
     # Relationships
     branch = relationship("Branch", backref="expenses")
     created_by = relationship("User", backref="created_expenses")
+    allocations = relationship("ExpenseAllocation", back_populates="expense", cascade="all, delete-orphan", passive_deletes=True)
 
     @classmethod
     def get_branch_expenses(cls, db: Session, branch_id: int, start_date: date = None, end_date: date = None):
@@ -305,6 +309,25 @@ class Expense(Base):
             
         return query.group_by(cls.type).all()
 
+class ExpenseAllocation(Base):
+    """Share of an expense charged to a branch, or to the main office when branch_id is None, see api.allocations"""
+    __tablename__ = "expense_allocations"
+
+    id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, ForeignKey('expenses.id', ondelete='CASCADE'), nullable=False)
+    branch_id = Column(Integer, ForeignKey('branches.id', ondelete='CASCADE'), nullable=True)
+    day = Column(Date, nullable=False)  # the expense's date_created
+    amount = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_expense_allocations_branch_id_day', branch_id, day, postgresql_include=['amount']),
+        Index('ix_expense_allocations_day', day, postgresql_include=['amount']),
+        Index('ix_expense_allocations_expense_id', expense_id),
+    )
+
+    expense = relationship("Expense", back_populates="allocations")
+    branch = relationship("Branch")
+
 class Supplier(Base):
     __tablename__ = "suppliers"
 
@@ -330,6 +353,14 @@ class ProductBatch(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.now)
 
+    __table_args__ = (
+        # Only active batches are ever read for stock, FEFO and expiry
+        Index('ix_product_batches_active', branch_id, product_id, expiration_date,
+              postgresql_where=is_active),
+        Index('ix_product_batches_active_expiration_date', expiration_date,
+              postgresql_where=(is_active & (quantity > 0))),
+    )
+
     @property
     def days_until_expiry(self):
         return (self.expiration_date - date.today()).days
@@ -352,8 +383,13 @@ class InvReportBatch(Base):
     invreport_item_id = Column(Integer, ForeignKey('invreport_items.id'))
     quantity = Column(Integer, nullable=False)
     expiration_date = Column(Date, nullable=False)
-    batch_type = Column(String)  # 'delivery', 'transfer', or 'pull_out'
+    batch_type = Column(String)  # 'delivery', 'transfer', 'pull_out' or 'offtake'
+    product_batch_id = Column(Integer, ForeignKey('product_batches.id'), nullable=True)  # Batch consumed by an offtake
     created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index('ix_invreport_batches_invreport_item_id', invreport_item_id),
+    )
     
     invreport_item = relationship("InvReportItem", back_populates="batches")
 
@@ -427,26 +463,40 @@ class Transaction(Base):
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
+    __table_args__ = (
+        Index('ix_transactions_branch_id_transaction_date', branch_id, transaction_date),
+        Index('ix_transactions_client_id_transaction_date', client_id, transaction_date),
+        # Receivables: aging and overdue filters only ever read open transactions
+        Index('ix_transactions_unpaid_branch_id_due_date', branch_id, due_date,
+              postgresql_where=((payment_status != 'paid') & (is_void == False)),
+              postgresql_include=['client_id', 'total_amount', 'amount_paid']),
+    )
+
     client = relationship("Client", backref="transactions")
     branch = relationship("Branch", backref="transactions")
     items = relationship("TransactionItem", back_populates="transaction", cascade="all, delete-orphan")
     payments = relationship("Payment", back_populates="transaction")
 
     @classmethod
-    def generate_reference(cls, db: Session, branch_id: int) -> str:
-        today = date.today()
-        date_part = today.strftime("%Y%m%d")
-        latest = db.query(cls).filter(
-            cls.branch_id == branch_id,
-            cls.reference_number.like(f"WS-{branch_id}-{date_part}-%")
-        ).order_by(cls.reference_number.desc()).first()
-        
-        if latest:
-            last_sequence = int(latest.reference_number.split('-')[-1])
-            new_sequence = str(last_sequence + 1).zfill(4)
-        else:
-            new_sequence = "0001"
-        return f"WS-{branch_id}-{date_part}-{new_sequence}"
+    def generate_reference(cls, db: Session, branch_id: int, day: Optional[date] = None) -> str:
+        """Next WS-<branch>-<yyyymmdd>-<nnnn> reference number of the branch for `day`, today by default.
+
+        Bumps the branch's counter for the day with one upsert in the
+        caller's transaction: concurrent sales always get distinct,
+        increasing numbers, and the counter row stays locked until the sale
+        commits or rolls back, so call it as late as possible. A second
+        connection is deliberately not used, a sale holding batch locks
+        could otherwise wait on an exhausted pool.
+        """
+        day = day or date.today()
+        stmt = insert(ReferenceCounter).values(branch_id=branch_id, day=day, last_value=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ReferenceCounter.branch_id, ReferenceCounter.day],
+            set_={'last_value': ReferenceCounter.last_value + 1}
+        ).returning(ReferenceCounter.last_value)
+
+        sequence = db.execute(stmt).scalar_one()
+        return f"WS-{branch_id}-{day:%Y%m%d}-{sequence:04d}"
 
     @property
     def balance(self):
@@ -456,6 +506,14 @@ class Transaction(Base):
     def is_overdue(self):
         return date.today() > self.due_date and self.payment_status != 'paid'
 
+class ReferenceCounter(Base):
+    """Last transaction reference number handed out per branch and day, see Transaction.generate_reference"""
+    __tablename__ = "reference_counters"
+
+    branch_id = Column(Integer, ForeignKey('branches.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    last_value = Column(Integer, nullable=False, default=0)
+
 class TransactionItem(Base):
     __tablename__ = "transaction_items"
 
@@ -466,14 +524,35 @@ class TransactionItem(Base):
     base_price = Column(Float, nullable=False)
     markup_price = Column(Float, nullable=False)
     total_amount = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_transaction_items_transaction_id', transaction_id),
+    )
     
     transaction = relationship("Transaction", back_populates="items")
     product = relationship("Product")
+    batches = relationship("TransactionItemBatch", back_populates="transaction_item", cascade="all, delete-orphan")
 
     def calculate_prices(self, markup_percentage: float):
         self.markup_price = round(self.base_price * (1 + markup_percentage), 2)
         self.total_amount = round(self.markup_price * self.quantity, 2)
 
+class TransactionItemBatch(Base):
+    """Quantity of a transaction item taken from one product batch, given back to it on void"""
+    __tablename__ = "transaction_item_batches"
+
+    id = Column(Integer, primary_key=True)
+    transaction_item_id = Column(Integer, ForeignKey('transaction_items.id', ondelete='CASCADE'), nullable=False)
+    product_batch_id = Column(Integer, ForeignKey('product_batches.id'), nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_transaction_item_batches_transaction_item_id', transaction_item_id),
+    )
+
+    transaction_item = relationship("TransactionItem", back_populates="batches")
+    product_batch = relationship("ProductBatch")
+
 class Payment(Base):
     __tablename__ = "payments"
 
@@ -488,6 +567,10 @@ class Payment(Base):
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
+    __table_args__ = (
+        Index('ix_payments_transaction_id', transaction_id),
+    )
+
     # Relationships
     transaction = relationship("Transaction", back_populates="payments")
     client = relationship("Client")
@@ -496,30 +579,54 @@ class Payment(Base):
 class AnalyticsTimeSeries(Base):
     __tablename__ = "analytics_timeseries"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     metric_name = Column(String, nullable=False)  # e.g., 'revenue', 'expenses', 'profit'
     value = Column(Float, nullable=False)
-    timestamp = Column(DateTime, default=datetime.now)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.now)  # partition key
     branch_id = Column(Integer, ForeignKey('branches.id'), nullable=True)
     product_id = Column(Integer, ForeignKey('products.id'), nullable=True)
 
+    __table_args__ = (
+        Index('ix_analytics_timeseries_timestamp', timestamp),
+        Index('ix_analytics_timeseries_metric_branch_product_timestamp', metric_name, branch_id, product_id, timestamp),
+        # Monthly partitions are created ahead by api.timeseries.ensure_partitions
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
     # Relationships
     branch = relationship("Branch", back_populates="analytics")
     product = relationship("Product", back_populates="analytics")
 
-    @classmethod
-    def record_metric(cls, db: Session, metric_name: str, value: float, 
-                     branch_id: Optional[int] = None, product_id: Optional[int] = None):
-        """Record a new metric data point"""
-        metric = cls(
-            metric_name=metric_name,
-            value=value,
-            branch_id=branch_id,
-            product_id=product_id
-        )
-        db.add(metric)
-        db.commit()
-        return metric
+    # Event metrics are written in batches by api.metrics.metric_writer,
+    # points older than a week are compacted into AnalyticsRollup by api.timeseries
+
+# Created with the table so inserts succeed before api.timeseries.ensure_partitions first runs
+event.listen(AnalyticsTimeSeries.__table__, 'after_create', DDL(
+    "CREATE TABLE IF NOT EXISTS analytics_timeseries_default PARTITION OF analytics_timeseries DEFAULT"
+))
+
+class AnalyticsRollup(Base):
+    """AnalyticsTimeSeries points aggregated per hour, day or month bucket, see api.timeseries"""
+    __tablename__ = "analytics_rollups"
+
+    id = Column(Integer, primary_key=True)
+    resolution = Column(String, nullable=False)  # 'hour', 'day' or 'month'
+    bucket = Column(DateTime, nullable=False)  # start of the hour, day or month
+    metric_name = Column(String, nullable=False)
+    branch_id = Column(Integer, ForeignKey('branches.id'), nullable=True)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=True)
+    value_count = Column(Integer, nullable=False)
+    value_sum = Column(Float, nullable=False)
+    value_min = Column(Float, nullable=False)
+    value_max = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_analytics_rollups_metric_name_bucket', metric_name, bucket),
+        Index('ix_analytics_rollups_resolution_bucket', resolution, bucket),
+    )
+
+    branch = relationship("Branch")
+    product = relationship("Product")
 
 class PriceHistory(Base):
     __tablename__ = 'price_history'
@@ -532,6 +639,32 @@ class PriceHistory(Base):
     
     product = relationship("Product", back_populates="price_history")
 
+class DailySales(Base):
+    """Offtake rolled up per report day, branch and product, see api.rollups"""
+    __tablename__ = "daily_sales"
+
+    day = Column(Date, primary_key=True)
+    branch_id = Column(Integer, ForeignKey('branches.id'), primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)  # offtake * srp at report time
+    cost = Column(Float, nullable=False, default=0)  # offtake * cost at report time
+
+    __table_args__ = (
+        Index('ix_daily_sales_branch_id_day', branch_id, day),
+        Index('ix_daily_sales_product_id_day', product_id, day),
+    )
+
+    branch = relationship("Branch")
+    product = relationship("Product")
+
+class DataVersion(Base):
+    """Write counter per data scope, bumped by writers to invalidate cached analytics"""
+    __tablename__ = "data_versions"
+
+    scope = Column(String, primary_key=True)  # 'company' or 'branch:<id>'
+    version = Column(Integer, nullable=False, default=0)
+
 class AppVersion(Base):
     __tablename__ = "app_versions"
 
@@ -0,0 +1,58 @@
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from .database import MAX_OVERFLOW, POOL_SIZE, SessionLocal
+
+# Threads, so pooled connections, shared by every endpoint using run_queries.
+# Half the pool: the rest stays free for request sessions and writes.
+QUERY_WORKERS = (POOL_SIZE + MAX_OVERFLOW) // 2
+ENDPOINT_LIMIT = 3  # queries of one endpoint running at once, across all of its requests
+
+_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="analytics-query")
+
+# Semaphores per event loop and endpoint, asyncio primitives cannot be shared between loops
+_limits: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+
+def _run(query: Callable[[Session], Any]):
+    db = SessionLocal()
+    try:
+        return query(db)
+    finally:
+        db.close()
+
+
+async def run_queries(
+    endpoint: str,
+    *queries: Callable[[Session], Any],
+    limit: int = ENDPOINT_LIMIT,
+    release: Optional[Session] = None
+) -> list:
+    """Run independent read-only queries in parallel and return their results in order.
+
+    Each callable gets its own session, so its own pooled connection and
+    snapshot, on a shared thread pool; the event loop stays free meanwhile.
+    At most `limit` queries of `endpoint` run at once, however many
+    requests for it are in flight, so one dashboard cannot take the whole
+    pool. Callables must return plain rows or values: their session is
+    closed as soon as they return.
+
+    Pass the request's own session as `release`: it is closed first, so
+    its connection goes back to the pool instead of idling in transaction
+    while the queries wait for theirs. It reconnects if used again.
+    """
+    if release is not None:
+        release.close()
+
+    loop = asyncio.get_running_loop()
+    semaphore = _limits.setdefault(loop, {}).setdefault(endpoint, asyncio.Semaphore(limit))
+
+    async def run(query):
+        async with semaphore:
+            return await loop.run_in_executor(_executor, _run, query)
+
+    return await asyncio.gather(*(run(query) for query in queries))
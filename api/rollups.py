@@ -0,0 +1,107 @@
+from datetime import date
+from typing import Optional
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from .cache import bump_data_version
+from .models import DailySales, InvReport, InvReportItem
+
+
+def _upsert(rows):
+    """INSERT ... ON CONFLICT that adds onto the existing (day, branch, product) row"""
+    stmt = insert(DailySales)
+    if isinstance(rows, sa.Select):
+        stmt = stmt.from_select(['day', 'branch_id', 'product_id', 'quantity', 'revenue', 'cost'], rows)
+    else:
+        stmt = stmt.values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[DailySales.day, DailySales.branch_id, DailySales.product_id],
+        set_={
+            'quantity': DailySales.quantity + stmt.excluded.quantity,
+            'revenue': DailySales.revenue + stmt.excluded.revenue,
+            'cost': DailySales.cost + stmt.excluded.cost
+        }
+    )
+
+
+def record_daily_sales(db: Session, report: InvReport):
+    """Add a new report's offtake to the rollup, in the caller's transaction"""
+    totals = {}
+    for item in report.items:
+        if not item.offtake:
+            continue
+        quantity, revenue, cost = totals.get(item.product_id, (0, 0, 0))
+        totals[item.product_id] = (
+            quantity + item.offtake,
+            revenue + item.offtake * item.current_srp,
+            cost + item.offtake * item.current_cost
+        )
+    if not totals:
+        return
+
+    day = report.created_at.date()
+    db.execute(_upsert([
+        {
+            'day': day,
+            'branch_id': report.branch_id,
+            'product_id': product_id,
+            'quantity': quantity,
+            'revenue': revenue,
+            'cost': cost
+        }
+        for product_id, (quantity, revenue, cost) in totals.items()
+    ]))
+
+
+def backfill_daily_sales(db: Session, start_date: Optional[date] = None, end_date: Optional[date] = None) -> int:
+    """Rebuild the rollup from inventory reports for the given days (all days by default).
+
+    Existing rows in the range are replaced, so it is safe to run again.
+    Returns the number of rollup rows written.
+    """
+    day = sa.func.date(InvReport.created_at)
+
+    delete = sa.delete(DailySales)
+    if start_date:
+        delete = delete.where(DailySales.day >= start_date)
+    if end_date:
+        delete = delete.where(DailySales.day <= end_date)
+    db.execute(delete)
+
+    rows = (
+        sa.select(
+            day,
+            InvReport.branch_id,
+            InvReportItem.product_id,
+            sa.func.sum(InvReportItem.offtake),
+            sa.func.sum(InvReportItem.offtake * InvReportItem.current_srp),
+            sa.func.sum(InvReportItem.offtake * InvReportItem.current_cost)
+        )
+        .join(InvReportItem, InvReportItem.invreport_id == InvReport.id)
+        .where(InvReportItem.offtake > 0)
+        .group_by(day, InvReport.branch_id, InvReportItem.product_id)
+    )
+    if start_date:
+        rows = rows.where(day >= start_date)
+    if end_date:
+        rows = rows.where(day <= end_date)
+
+    return db.execute(_upsert(rows)).rowcount
+
+
+if __name__ == '__main__':
+    # python -m api.rollups [start_date] [end_date]
+    import sys
+    from .database import SessionLocal
+
+    args = [date.fromisoformat(arg) for arg in sys.argv[1:3]]
+    db = SessionLocal()
+    try:
+        written = backfill_daily_sales(db, *args)
+        bump_data_version(db)
+        db.commit()
+        print(f"daily_sales: {written} rows rebuilt")
+    finally:
+        db.close()
@@ -1,25 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import func, desc, and_, case, distinct, select, or_
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, desc, and_, case, distinct, select
+from collections import defaultdict
 from datetime import datetime, timedelta, date
-from typing import List, Optional, Annotated
+from typing import Dict, List, Optional, Annotated
 from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
 import sqlalchemy as sa
-from sqlalchemy.sql import exists
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 
 from api.deps import db_dependency, role_required
+from api.cache import analytics_cache, cached_response
+from api.exports import ExportFormat, export_response
+from api.inventory import expiry_bucket
+from api.parallel import run_queries
+from api.timeseries import AGGREGATES, FILLS, RESOLUTIONS, pick_resolution, query_timeseries
 from api.models import (
     Expense, 
+    ExpenseAllocation,
     Product, 
     Branch, 
     InvReport, 
-    AnalyticsTimeSeries, 
     UserRole, 
     BranchProduct,
     InvReportItem,
     ProductBatch,
     BranchType,
-    PriceHistory
+    PriceHistory,
+    DailySales
 )
 
 
@@ -90,12 +98,22 @@ class ProductAnalytics(BaseModel):
         "change_count": int
     }
 
+class TimeSeriesResponse(BaseModel):
+    resolution: str
+    aggregate: str
+    timestamps: List[datetime]
+    series: Dict[str, List[Optional[float]]]
+
 @router.get("/", response_model=CompanyAnalytics)
+@cached_response()
 async def get_company_analytics(
     db: db_dependency,
     current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN]))],
     time_range: str = "30d"
 ):
+    # Read-only: revenue, expense, profit and top product metrics are recorded
+    # once per day by api.snapshots instead of on every request
+
     # Calculate date range
     end_date = datetime.now()
     if time_range == "7d":
@@ -111,46 +129,77 @@ async def get_company_analytics(
         start_date = end_date - timedelta(days=365)
         prev_start_date = start_date - timedelta(days=365)
 
-    # Get sales data from inventory reports
-    sales_data = db.query(
-        InvReport.branch_id,
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('total_sales'),
-        func.sum(
-            InvReportItem.offtake * 
-            (InvReportItem.current_srp - InvReportItem.current_cost)
-        ).label('total_profit')
-    ).join(
-        InvReportItem, 
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.end_date >= start_date,
-        InvReport.end_date <= end_date
-    ).group_by(InvReport.branch_id).all()
+    # Get sales data from the daily rollup
+    def query_sales(db: Session):
+        return db.query(
+            DailySales.branch_id,
+            func.sum(DailySales.revenue).label('total_sales'),
+            func.sum(DailySales.revenue - DailySales.cost).label('total_profit')
+        ).filter(
+            DailySales.day >= start_date.date(),
+            DailySales.day <= end_date.date()
+        ).group_by(DailySales.branch_id).all()
 
     # Get previous period data
-    prev_sales_data = db.query(
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('total_sales')
-    ).join(
-        InvReport,
-        InvReportItem.invreport_id == InvReport.id
-    ).filter(
-        InvReport.end_date >= prev_start_date,
-        InvReport.end_date < start_date
-    ).scalar() or 0
-
-    # Get expense data
-    expense_data = db.query(
-        Expense.branch_id,
-        func.sum(case(
-            (Expense.scope == 'company_wide', 
-             Expense.amount / db.query(func.count(Branch.id)).scalar()),
-            (Expense.scope == 'main_office', Expense.amount),
-            else_=Expense.amount
-        )).label('total_expenses')
-    ).filter(
-        Expense.date_created >= start_date,
-        Expense.date_created <= end_date
-    ).group_by(Expense.branch_id).all()
+    def query_prev_sales(db: Session):
+        return db.query(
+            func.sum(DailySales.revenue).label('total_sales')
+        ).filter(
+            DailySales.day >= prev_start_date.date(),
+            DailySales.day < start_date.date()
+        ).scalar() or 0
+
+    # Get expense data, company-wide expenses already split per branch
+    def query_expenses(db: Session):
+        return db.query(
+            ExpenseAllocation.branch_id,
+            func.sum(ExpenseAllocation.amount).label('total_expenses')
+        ).filter(
+            ExpenseAllocation.day >= start_date.date(),
+            ExpenseAllocation.day <= end_date.date()
+        ).group_by(ExpenseAllocation.branch_id).all()
+
+    def query_branches(db: Session):
+        return db.query(Branch.id, Branch.branch_name).all()
+
+    # Get product analytics
+    def query_top_products(db: Session):
+        return db.query(
+            Product.id,
+            Product.name,
+            func.sum(DailySales.quantity).label('total_quantity'),
+            func.sum(DailySales.revenue).label('total_revenue'),
+            func.sum(DailySales.cost).label('total_cost')
+        ).join(
+            DailySales,
+            Product.id == DailySales.product_id
+        ).filter(
+            DailySales.day >= start_date.date(),
+            DailySales.day <= end_date.date()
+        ).group_by(Product.id).order_by(desc('total_revenue')).limit(10).all()
+
+    # Get time series data
+    def query_time_series(db: Session):
+        return get_time_series_data(db, start_date, end_date)
+
+    # Independent of each other, so they run in parallel on their own connections
+    (
+        sales_data,
+        prev_sales_data,
+        expense_data,
+        branches,
+        product_performance,
+        time_series
+    ) = await run_queries(
+        "company_analytics",
+        query_sales,
+        query_prev_sales,
+        query_expenses,
+        query_branches,
+        query_top_products,
+        query_time_series,
+        release=db
+    )
 
     # Calculate metrics
     total_revenue = sum(sale.total_sales for sale in sales_data)
@@ -159,13 +208,7 @@ async def get_company_analytics(
     net_profit = gross_profit - total_expenses
     profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
 
-    # Record daily metrics
-    AnalyticsTimeSeries.record_metric(db, "revenue", total_revenue)
-    AnalyticsTimeSeries.record_metric(db, "expenses", total_expenses)
-    AnalyticsTimeSeries.record_metric(db, "profit", net_profit)
-
     # Get branch performance
-    branches = db.query(Branch).all()
     branch_performance = []
     for branch in branches:
         branch_sales = next((s for s in sales_data if s.branch_id == branch.id), None)
@@ -195,53 +238,6 @@ async def get_company_analytics(
         }
         branch_performance.append(performance)
 
-        # Record branch-specific metrics
-        if branch_sales:
-            AnalyticsTimeSeries.record_metric(
-                db, 
-                "branch_revenue", 
-                branch_sales.total_sales,
-                branch_id=branch.id
-            )
-        
-        if branch_expenses:
-            AnalyticsTimeSeries.record_metric(
-                db, 
-                "branch_expenses", 
-                branch_expenses.total_expenses,
-                branch_id=branch.id
-            )
-
-    # Get product analytics
-    product_performance = db.query(
-        Product.id,
-        Product.name,
-        func.sum(InvReportItem.offtake).label('total_quantity'),
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('total_revenue'),
-        func.sum(InvReportItem.offtake * InvReportItem.current_cost).label('total_cost')
-    ).join(
-        InvReportItem, 
-        Product.id == InvReportItem.product_id
-    ).join(
-        InvReport,
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.end_date >= start_date,
-        InvReport.end_date <= end_date
-    ).group_by(Product.id).order_by(desc('total_revenue')).limit(10).all()
-
-    # Record product metrics
-    for product in product_performance:
-        AnalyticsTimeSeries.record_metric(
-            db,
-            "product_revenue",
-            product.total_revenue,
-            product_id=product.id
-        )
-
-    # Get time series data
-    time_series = get_time_series_data(db, start_date, end_date)
-
     return {
         "total_revenue": total_revenue,
         "total_expenses": total_expenses,
@@ -287,50 +283,37 @@ def get_time_series_data(db: db_dependency, start_date: datetime, end_date: date
     # Get revenue data with proper grouping
     revenue_data = {}
     revenue_query = db.query(
-        func.date_trunc('day', InvReport.end_date).label('date'),
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('value')
-    ).join(
-        InvReportItem,
-        InvReport.id == InvReportItem.invreport_id
+        DailySales.day.label('date'),
+        func.sum(DailySales.revenue).label('value')
     ).filter(
-        InvReport.end_date >= start_date,
-        InvReport.end_date <= end_date
-    ).group_by('date').all()
+        DailySales.day >= start_date.date(),
+        DailySales.day <= end_date.date()
+    ).group_by(DailySales.day).all()
 
     for rev in revenue_query:
-        revenue_data[rev.date.date()] = rev.value or 0
+        revenue_data[rev.date] = rev.value or 0
 
-    # Get expense data directly from expenses table
+    # Get expense data from the per-branch allocations
     expense_data = {}
     expense_query = db.query(
-        Expense.date_created.label('date'),
-        func.sum(case(
-            # Company wide expenses divided by branch count
-            (Expense.scope == 'company_wide', 
-             Expense.amount / db.query(func.count(Branch.id)).scalar()),
-            # Main office expenses should NOT be divided
-            (Expense.scope == 'main_office', Expense.amount),
-            # Branch specific expenses as is
-            else_=Expense.amount
-        )).label('value')
+        ExpenseAllocation.day.label('date'),
+        func.sum(ExpenseAllocation.amount).label('value')
     ).filter(
-        Expense.date_created >= start_date,
-        Expense.date_created <= end_date
-    ).group_by(Expense.date_created).all()
+        ExpenseAllocation.day >= start_date.date(),
+        ExpenseAllocation.day <= end_date.date()
+    ).group_by(ExpenseAllocation.day).all()
 
-    # Debug print to check values
     for exp in expense_query:
-        print(f"Date: {exp.date}, Amount: {exp.value}")
         expense_data[exp.date] = exp.value or 0
 
     # Combine data for all dates
     combined_data = []
-    for date in date_range:
-        daily_revenue = revenue_data.get(date, 0)
-        daily_expense = expense_data.get(date, 0)
+    for day in date_range:
+        daily_revenue = revenue_data.get(day, 0)
+        daily_expense = expense_data.get(day, 0)
         
         combined_data.append({
-            "timestamp": date,
+            "timestamp": day,
             "value": daily_revenue,
             "expenses": daily_expense,
             "profit": daily_revenue - daily_expense
@@ -354,29 +337,40 @@ async def get_inventory_analytics(
     db: db_dependency,
     current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST]))],
     branch_id: Optional[int] = None,
-    days: int = 30
+    days: int = 30,
+    as_of: Optional[date] = None
 ):
     """Get inventory analytics focusing on stock levels and expiry"""
     end_date = datetime.now()
     start_date = end_date - timedelta(days=days)
-    
-    query = db.query(BranchProduct).join(Product)
-    if branch_id:
-        query = query.filter(BranchProduct.branch_id == branch_id)
-    
+
+    expiring_products, low_stock_items, inventory_valuation = await run_queries(
+        "inventory_analytics",
+        lambda db: get_expiring_products(db, days, branch_id),
+        lambda db: get_low_stock_items(db, branch_id),
+        lambda db: get_inventory_valuation(db, branch_id, as_of),
+        release=db
+    )
+
     return {
-        "expiring_products": get_expiring_products(db, days),
-        "low_stock_items": get_low_stock_items(db, branch_id),
-        "inventory_value": calculate_inventory_value(query.all())
+        "expiring_products": expiring_products,
+        "low_stock_items": low_stock_items,
+        "inventory_value": inventory_valuation["cost_value"],
+        "inventory_valuation": inventory_valuation
     }
 
-def get_expiring_products(db: db_dependency, days: int):
-    """Get products nearing expiration"""
+def get_expiring_products(db: db_dependency, days: int, branch_id: Optional[int] = None):
+    """Get products nearing expiration, their batches summed per expiration date"""
     today = date.today()
     expiry_date = today + timedelta(days=days)
     
     query = (
-        db.query(ProductBatch, Product)
+        db.query(
+            ProductBatch.product_id,
+            Product.name.label('product_name'),
+            ProductBatch.expiration_date,
+            func.sum(ProductBatch.quantity).label('quantity')
+        )
         .select_from(ProductBatch)
         .join(Product, ProductBatch.product_id == Product.id)
         .filter(
@@ -385,17 +379,21 @@ def get_expiring_products(db: db_dependency, days: int):
             ProductBatch.is_active == True,
             ProductBatch.quantity > 0
         )
+        .group_by(ProductBatch.product_id, Product.name, ProductBatch.expiration_date)
+        .order_by(ProductBatch.expiration_date, ProductBatch.product_id)
     )
+    if branch_id:
+        query = query.filter(ProductBatch.branch_id == branch_id)
     
     return [
         {
-            "product_id": batch.product_id,
-            "product_name": product.name,
-            "quantity": batch.quantity,
-            "expiration_date": batch.expiration_date,
-            "days_until_expiry": (batch.expiration_date - today).days
+            "product_id": row.product_id,
+            "product_name": row.product_name,
+            "quantity": int(row.quantity),
+            "expiration_date": row.expiration_date,
+            "days_until_expiry": (row.expiration_date - today).days
         }
-        for batch, product in query.all()
+        for row in query.all()
     ]
 
 def get_low_stock_items(db: db_dependency, branch_id: Optional[int] = None):
@@ -404,53 +402,99 @@ def get_low_stock_items(db: db_dependency, branch_id: Optional[int] = None):
         db.query(
             BranchProduct,
             Product,
-            Branch,
-            sa.func.coalesce(
-                sa.func.sum(
-                    sa.case(
-                        (ProductBatch.is_active == True, ProductBatch.quantity),
-                        else_=0
-                    )
-                ),
-                0
-            ).label("active_quantity")
+            Branch
         )
         .join(Product)
         .join(Branch)
-        .outerjoin(ProductBatch)
         .filter(BranchProduct.is_available == True)
-        .group_by(
-            BranchProduct.product_id,
-            BranchProduct.branch_id,
-            Product.id,
-            Branch.id,
-            BranchProduct.is_available,
-            BranchProduct.low_stock_since
-        )
     )
     
     if branch_id:
         query = query.filter(BranchProduct.branch_id == branch_id)
     
     low_stock_items = []
-    for bp, product, branch, active_quantity in query.all():
+    for bp, product, branch in query.all():
         threshold = (product.wholesale_low_stock_threshold 
                    if branch.branch_type == BranchType.WHOLESALE.value 
                    else product.retail_low_stock_threshold)
-        if active_quantity <= threshold:
+        if bp.active_quantity <= threshold:
             low_stock_items.append({
                 "product_id": bp.product_id,
                 "product_name": product.name,
-                "current_stock": active_quantity,
+                "current_stock": bp.active_quantity,
                 "threshold": threshold,
                 "low_stock_since": bp.low_stock_since,
                 "days_in_low_stock": bp.days_in_low_stock
             })
     return low_stock_items
 
-def calculate_inventory_value(branch_products):
-    """Calculate total inventory value"""
-    return sum(bp.active_quantity * bp.product.cost for bp in branch_products)
+def get_inventory_valuation(db: Session, branch_id: Optional[int] = None, as_of: Optional[date] = None) -> dict:
+    """Stock value at cost and at SRP, per branch and per expiry bucket.
+
+    One grouped query over the active batches, so its cost does not grow
+    with the number of branch products loaded. Prices are the current
+    ones, or with `as_of` the latest price history entry up to that day;
+    products without one keep their current price.
+    """
+    cost, srp = Product.cost, Product.srp
+    prices = None
+    if as_of:
+        prices = (
+            select(PriceHistory.product_id, PriceHistory.cost, PriceHistory.srp)
+            .where(PriceHistory.date < as_of + timedelta(days=1))
+            .distinct(PriceHistory.product_id)
+            .order_by(PriceHistory.product_id, PriceHistory.date.desc())
+            .subquery('prices')
+        )
+        cost = func.coalesce(prices.c.cost, Product.cost)
+        srp = func.coalesce(prices.c.srp, Product.srp)
+
+    bucket = expiry_bucket(ProductBatch.expiration_date).label('bucket')
+    query = (
+        select(
+            ProductBatch.branch_id,
+            Branch.branch_name,
+            bucket,
+            func.sum(ProductBatch.quantity).label('quantity'),
+            func.sum(ProductBatch.quantity * cost).label('cost_value'),
+            func.sum(ProductBatch.quantity * srp).label('srp_value')
+        )
+        .join(Product, Product.id == ProductBatch.product_id)
+        .join(Branch, Branch.id == ProductBatch.branch_id)
+        .where(ProductBatch.is_active == True, ProductBatch.quantity > 0)
+        .group_by(ProductBatch.branch_id, Branch.branch_name, bucket)
+        .order_by(ProductBatch.branch_id, bucket)
+    )
+    if prices is not None:
+        query = query.outerjoin(prices, prices.c.product_id == ProductBatch.product_id)
+    if branch_id:
+        query = query.where(ProductBatch.branch_id == branch_id)
+
+    def totals():
+        return {"quantity": 0, "cost_value": 0.0, "srp_value": 0.0}
+
+    def add(target, row):
+        target["quantity"] += int(row.quantity)
+        target["cost_value"] += float(row.cost_value)
+        target["srp_value"] += float(row.srp_value)
+
+    valuation = {"as_of": as_of or date.today(), **totals(), "by_expiry": {}, "by_branch": []}
+    branches = {}
+    for row in db.execute(query):
+        if row.branch_id not in branches:
+            branches[row.branch_id] = {
+                "branch_id": row.branch_id,
+                "branch_name": row.branch_name,
+                **totals(),
+                "by_expiry": {}
+            }
+            valuation["by_branch"].append(branches[row.branch_id])
+        branch = branches[row.branch_id]
+        add(valuation, row)
+        add(valuation["by_expiry"].setdefault(row.bucket, totals()), row)
+        add(branch, row)
+        add(branch["by_expiry"].setdefault(row.bucket, totals()), row)
+    return valuation
 
 def calculate_growth(previous: float, current: float) -> float:
     """Calculate percentage growth"""
@@ -470,14 +514,38 @@ def calculate_expense_ratio(expenses: float, sales: float) -> float:
         return 0
     return (expenses / sales) * 100
 
+GRANULARITIES = {
+    "daily": "day",
+    "weekly": "week",
+    "monthly": "month",
+    "yearly": "year"
+}
+
 @router.get("/branch/{branch_id}")
+@cached_response(scope=lambda kwargs: kwargs['branch_id'])
 async def get_branch_analytics(
     branch_id: int,
     db: db_dependency,
     current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST]))],
     time_range: str = "30d",
-    granularity: str = "daily"  # Can be 'daily', 'weekly', 'monthly', 'yearly'
+    granularity: str = "daily",  # Can be 'daily', 'weekly', 'monthly', 'yearly'
+    by_product: bool = False,
+    by_expense_type: bool = False
 ):
+    """Sales and expenses of a branch summed per time bucket.
+
+    Buckets are grouped in SQL, so the payload grows with the number of
+    buckets rather than line items. `by_product` and `by_expense_type`
+    split each bucket further by product or expense type.
+    """
+    if granularity not in GRANULARITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid granularity. Must be one of: {', '.join(GRANULARITIES)}"
+        )
+    # Whitelisted above, inlined so the SELECT and GROUP BY expressions match
+    unit = sa.literal_column(f"'{GRANULARITIES[granularity]}'")
+
     # Calculate date range
     end_date = datetime.now()
     if time_range == "7d":
@@ -492,142 +560,270 @@ async def get_branch_analytics(
         # Custom date range can be added here
         start_date = end_date - timedelta(days=30)
 
-    # Get all sales data points
-    sales_data = db.query(
-        InvReport.created_at,
-        InvReportItem.offtake,
-        InvReportItem.current_srp,
-        InvReportItem.current_cost,
-        Product.name.label('product_name')
-    ).join(
-        Product,
-        Product.id == InvReportItem.product_id
-    ).join(
-        InvReport,
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.branch_id == branch_id,
-        InvReport.created_at >= start_date,
-        InvReport.created_at <= end_date
-    ).all()
-
-    # Get all expense data points
-    expense_data = db.query(
-        Expense.date_created,
-        Expense.amount,
-        Expense.type,
-        Expense.name
-    ).filter(
-        Expense.branch_id == branch_id,
-        Expense.date_created >= start_date,
-        Expense.date_created <= end_date
-    ).all()
+    sales_period = func.date_trunc(unit, DailySales.day).label('period')
+    sales_columns = [
+        sales_period,
+        func.sum(DailySales.quantity).label('quantity'),
+        func.sum(DailySales.revenue).label('revenue'),
+        func.sum(DailySales.cost).label('cost')
+    ]
+    sales_groups = [sales_period]
+    if by_product:
+        sales_columns += [DailySales.product_id, Product.name.label('product_name')]
+        sales_groups += [DailySales.product_id, Product.name]
+
+    sales_query = select(*sales_columns).where(
+        DailySales.branch_id == branch_id,
+        DailySales.day.between(start_date.date(), end_date.date())
+    ).group_by(*sales_groups).order_by(*sales_groups)
+    if by_product:
+        sales_query = sales_query.join(Product, Product.id == DailySales.product_id)
+
+    expense_period = func.date_trunc(unit, ExpenseAllocation.day).label('period')
+    expense_columns = [
+        expense_period,
+        func.sum(ExpenseAllocation.amount).label('amount'),
+        func.count(ExpenseAllocation.id).label('count')
+    ]
+    expense_groups = [expense_period]
+    if by_expense_type:
+        expense_columns.append(Expense.type)
+        expense_groups.append(Expense.type)
+
+    expense_query = select(*expense_columns).join(
+        Expense, Expense.id == ExpenseAllocation.expense_id
+    ).where(
+        ExpenseAllocation.branch_id == branch_id,
+        ExpenseAllocation.day.between(start_date.date(), end_date.date())
+    ).group_by(*expense_groups).order_by(*expense_groups)
+
+    sales_rows, expense_rows = await run_queries(
+        "branch_analytics",
+        lambda db: db.execute(sales_query).all(),
+        lambda db: db.execute(expense_query).all(),
+        release=db
+    )
+
+    sales = []
+    for row in sales_rows:
+        bucket = {
+            "period": row.period.date(),
+            "quantity": int(row.quantity),
+            "revenue": float(row.revenue),
+            "cost": float(row.cost),
+            "profit": float(row.revenue - row.cost)
+        }
+        if by_product:
+            bucket["product_id"] = row.product_id
+            bucket["product"] = row.product_name
+        sales.append(bucket)
+
+    expenses = []
+    for row in expense_rows:
+        bucket = {
+            "period": row.period.date(),
+            "amount": float(row.amount),
+            "count": row.count
+        }
+        if by_expense_type:
+            bucket["type"] = row.type
+        expenses.append(bucket)
 
     return {
-        "sales": [
-            {
-                "date": sale.created_at,
-                "product": sale.product_name,
-                "quantity": sale.offtake,
-                "revenue": float(sale.offtake * sale.current_srp),
-                "cost": float(sale.offtake * sale.current_cost),
-                "profit": float(sale.offtake * (sale.current_srp - sale.current_cost))
-            }
-            for sale in sales_data
-        ],
-        "expenses": [
-            {
-                "date": expense.date_created,
-                "amount": float(expense.amount),
-                "type": expense.type,
-                "description": expense.name
-            }
-            for expense in expense_data
-        ]
+        "granularity": granularity,
+        "start_date": start_date.date(),
+        "end_date": end_date.date(),
+        "sales": sales,
+        "expenses": expenses
     }
 
-@router.get("/product/{product_id}", response_model=ProductAnalytics)
-async def get_product_analytics(
-    product_id: int,
+@router.get("/branch/{branch_id}/export")
+def export_branch_analytics(
+    branch_id: int,
     db: db_dependency,
-    user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
-    time_range: str = "30d",
-    branch_type: str = "retail"
+    current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST]))],
+    dataset: str = "sales",  # Can be 'sales' or 'expenses'
+    format: ExportFormat = ExportFormat.CSV,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
 ):
-    # Get product details
-    product = db.query(Product).filter(Product.id == product_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    """Line-level sales or expense rows of a branch, streamed as CSV or NDJSON"""
+    if current_user["role"] != UserRole.ADMIN and branch_id != current_user["branch_id"]:
+        raise HTTPException(status_code=403, detail="Not authorized to view this branch's data")
+
+    end_date = end_date or date.today()
+    start_date = start_date or end_date - timedelta(days=30)
+
+    if dataset == "sales":
+        query = select(
+            InvReport.id.label('report_id'),
+            InvReport.created_at.label('date'),
+            Product.id.label('product_id'),
+            Product.name.label('product'),
+            InvReportItem.offtake.label('quantity'),
+            InvReportItem.current_srp.label('srp'),
+            InvReportItem.current_cost.label('cost'),
+            (InvReportItem.offtake * InvReportItem.current_srp).label('revenue'),
+            (InvReportItem.offtake * (InvReportItem.current_srp - InvReportItem.current_cost)).label('profit')
+        ).join(
+            InvReport, InvReport.id == InvReportItem.invreport_id
+        ).join(
+            Product, Product.id == InvReportItem.product_id
+        ).where(
+            InvReport.branch_id == branch_id,
+            InvReport.created_at >= start_date,
+            InvReport.created_at < end_date + timedelta(days=1)
+        ).order_by(InvReport.created_at, InvReportItem.id)
+    elif dataset == "expenses":
+        query = select(
+            Expense.id.label('expense_id'),
+            Expense.date_created.label('date'),
+            Expense.type,
+            Expense.name.label('description'),
+            Expense.amount
+        ).where(
+            Expense.branch_id == branch_id,
+            Expense.date_created.between(start_date, end_date)
+        ).order_by(Expense.date_created, Expense.id)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid dataset. Must be one of: sales, expenses")
 
-    # Modify branch products query to filter by type
-    branch_products = (
-        db.query(
-            BranchProduct.branch_id,
-            Branch.branch_name.label("branch_name"),
-            Branch.branch_type.label("branch_type"),
-            BranchProduct.is_available,
-            BranchProduct.low_stock_since,
-            Product.wholesale_low_stock_threshold,
-            Product.retail_low_stock_threshold,
-            sa.func.coalesce(
-                sa.func.sum(
-                    sa.case(
-                        (
-                            sa.and_(
-                                ProductBatch.is_active == True,
-                                ProductBatch.branch_id == BranchProduct.branch_id
-                            ),
-                            ProductBatch.quantity
-                        ),
-                        else_=0
-                    )
-                ),
-                0
-            ).label("active_quantity")
+    return export_response(
+        query,
+        f"branch-{branch_id}-{dataset}-{start_date}-{end_date}",
+        format
+    )
+
+PRODUCT_ANALYTICS_CHUNK = 200  # products computed per round of grouped queries by /analytics/products
+
+def product_analytics_queries(product_ids: List[int], start_date: datetime, end_date: datetime, branch_type: str):
+    """The queries behind ProductAnalytics, each grouped over all of `product_ids` at once.
+
+    Returns callables for run_queries; every row carries its product_id.
+    """
+    def query_products(db: Session):
+        return (
+            db.query(Product.id, Product.cost, Product.srp)
+            .filter(Product.id.in_(product_ids))
+            .order_by(Product.id)
+            .all()
         )
-        .select_from(BranchProduct)
-        .join(Branch, Branch.id == BranchProduct.branch_id)
-        .join(Product, Product.id == BranchProduct.product_id)
-        .outerjoin(ProductBatch)
-        .filter(
-            BranchProduct.product_id == product_id,
-            BranchProduct.is_available == True,
-            Branch.branch_type == branch_type,
-            sa.case(
-                (Branch.branch_type == 'wholesale', Product.is_wholesale_available),
-                else_=Product.is_retail_available
+
+    # Modify branch products query to filter by type
+    def query_branch_products(db: Session):
+        return (
+            db.query(
+                BranchProduct.product_id,
+                BranchProduct.branch_id,
+                Branch.branch_name.label("branch_name"),
+                Branch.branch_type.label("branch_type"),
+                BranchProduct.is_available,
+                BranchProduct.low_stock_since,
+                Product.wholesale_low_stock_threshold,
+                Product.retail_low_stock_threshold,
+                BranchProduct.active_quantity.label("active_quantity")
             )
+            .select_from(BranchProduct)
+            .join(Branch, Branch.id == BranchProduct.branch_id)
+            .join(Product, Product.id == BranchProduct.product_id)
+            .filter(
+                BranchProduct.product_id.in_(product_ids),
+                BranchProduct.is_available == True,
+                Branch.branch_type == branch_type,
+                sa.case(
+                    (Branch.branch_type == 'wholesale', Product.is_wholesale_available),
+                    else_=Product.is_retail_available
+                )
+            )
+            .all()
         )
-        .group_by(
-            BranchProduct.branch_id,
-            Branch.branch_name,
-            Branch.branch_type,
-            BranchProduct.is_available,
-            BranchProduct.low_stock_since,
-            Product.wholesale_low_stock_threshold,
-            Product.retail_low_stock_threshold
-        )
-        .all()
-    )
 
     # Modify sales data query to filter by branch type
-    sales_data = (
-        db.query(
-            func.sum(InvReportItem.offtake).label('total_quantity'),
-            func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('total_revenue'),
-            func.sum(InvReportItem.offtake * InvReportItem.current_cost).label('total_cost')
+    def query_sales(db: Session):
+        return (
+            db.query(
+                DailySales.product_id,
+                func.sum(DailySales.quantity).label('total_quantity'),
+                func.sum(DailySales.revenue).label('total_revenue'),
+                func.sum(DailySales.cost).label('total_cost')
+            )
+            .join(Branch, Branch.id == DailySales.branch_id)
+            .filter(
+                DailySales.product_id.in_(product_ids),
+                DailySales.day >= start_date.date(),
+                DailySales.day <= end_date.date(),
+                Branch.branch_type == branch_type
+            )
+            .group_by(DailySales.product_id)
+            .all()
         )
-        .join(InvReport)
-        .join(Branch)
-        .filter(
-            InvReportItem.product_id == product_id,
-            InvReport.created_at >= get_start_date(time_range),
-            InvReport.created_at <= datetime.now(),
-            Branch.branch_type == branch_type
+
+    # Get price history
+    def query_price_history(db: Session):
+        return (
+            db.query(
+                PriceHistory.product_id,
+                PriceHistory.date,
+                PriceHistory.cost,
+                PriceHistory.srp
+            )
+            .filter(
+                PriceHistory.product_id.in_(product_ids),
+                PriceHistory.date >= start_date,
+                PriceHistory.date <= end_date
+            )
+            .order_by(PriceHistory.date.asc())
+            .all()
         )
-        .first()
-    )
 
+    # Get branch-specific sales data
+    def query_branch_sales(db: Session):
+        return (
+            db.query(
+                DailySales.product_id,
+                DailySales.branch_id,
+                Branch.branch_name,
+                Branch.branch_type,
+                func.sum(DailySales.quantity).label('total_quantity'),
+                func.sum(DailySales.revenue).label('total_revenue'),
+                func.sum(DailySales.cost).label('total_cost'),
+                BranchProduct.is_available,
+                Product.is_retail_available,
+                Product.is_wholesale_available
+            )
+            .select_from(DailySales)
+            .join(Branch, Branch.id == DailySales.branch_id)
+            .join(BranchProduct, and_(
+                BranchProduct.product_id == DailySales.product_id,
+                BranchProduct.branch_id == DailySales.branch_id
+            ))
+            .join(Product, Product.id == DailySales.product_id)
+            .filter(
+                DailySales.product_id.in_(product_ids),
+                DailySales.day >= start_date.date(),
+                DailySales.day <= end_date.date(),
+                BranchProduct.is_available == True,
+                sa.case(
+                    (Branch.branch_type == 'wholesale', Product.is_wholesale_available),
+                    else_=Product.is_retail_available
+                )
+            )
+            .group_by(
+                DailySales.product_id,
+                DailySales.branch_id,
+                Branch.branch_name,
+                Branch.branch_type,
+                BranchProduct.is_available,
+                Product.is_retail_available,
+                Product.is_wholesale_available
+            )
+            .all()
+        )
+
+    return query_products, query_branch_products, query_sales, query_price_history, query_branch_sales
+
+def build_product_analytics(product, branch_products, sales_data, price_history, branch_sales) -> ProductAnalytics:
+    """ProductAnalytics of one product from its rows of product_analytics_queries"""
     # Calculate analytics
     stock_analytics = StockAnalytics(
         total_stock=sum(bp.active_quantity for bp in branch_products),
@@ -658,69 +854,12 @@ async def get_product_analytics(
         ]
     )
 
-    # Get start date based on time range
-    end_date = datetime.now()
-    start_date = get_start_date(time_range)
-
-    # Get price history
-    price_history = (
-        db.query(PriceHistory)
-        .filter(
-            PriceHistory.product_id == product_id,
-            PriceHistory.date >= start_date,
-            PriceHistory.date <= end_date
-        )
-        .order_by(PriceHistory.date.asc())
-        .all()
-    )
-
-    # Calculate average margin from sales data
-    total_revenue = sales_data.total_revenue if sales_data.total_revenue else 0
-    total_cost = sales_data.total_cost if sales_data.total_cost else 0
+    # Calculate average margin from sales data, a product without sales has no row
+    total_quantity = sales_data.total_quantity if sales_data and sales_data.total_quantity else 0
+    total_revenue = sales_data.total_revenue if sales_data and sales_data.total_revenue else 0
+    total_cost = sales_data.total_cost if sales_data and sales_data.total_cost else 0
     avg_margin = ((total_revenue - total_cost) / total_revenue * 100) if total_revenue > 0 else 0
 
-    # Get branch-specific sales data
-    branch_sales = (
-        db.query(
-            InvReport.branch_id,
-            Branch.branch_name,
-            Branch.branch_type,
-            func.sum(InvReportItem.offtake).label('total_quantity'),
-            func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('total_revenue'),
-            func.sum(InvReportItem.offtake * InvReportItem.current_cost).label('total_cost'),
-            BranchProduct.is_available,
-            Product.is_retail_available,
-            Product.is_wholesale_available
-        )
-        .select_from(InvReportItem)
-        .join(InvReport, InvReport.id == InvReportItem.invreport_id)
-        .join(Branch, Branch.id == InvReport.branch_id)
-        .join(BranchProduct, and_(
-            BranchProduct.product_id == InvReportItem.product_id,
-            BranchProduct.branch_id == InvReport.branch_id
-        ))
-        .join(Product, Product.id == InvReportItem.product_id)
-        .filter(
-            InvReportItem.product_id == product_id,
-            InvReport.created_at >= start_date,
-            InvReport.created_at <= end_date,
-            BranchProduct.is_available == True,
-            sa.case(
-                (Branch.branch_type == 'wholesale', Product.is_wholesale_available),
-                else_=Product.is_retail_available
-            )
-        )
-        .group_by(
-            InvReport.branch_id,
-            Branch.branch_name,
-            Branch.branch_type,
-            BranchProduct.is_available,
-            Product.is_retail_available,
-            Product.is_wholesale_available
-        )
-        .all()
-    )
-
     # Create branch performance data
     branch_performance = [
         {
@@ -740,7 +879,7 @@ async def get_product_analytics(
     return ProductAnalytics(
         stock_analytics=stock_analytics,
         total_sales={
-            "quantity": int(sales_data.total_quantity or 0),
+            "quantity": int(total_quantity),
             "revenue": float(total_revenue)
         },
         current_price={
@@ -760,6 +899,105 @@ async def get_product_analytics(
         }
     )
 
+def group_by_product(rows) -> Dict[int, list]:
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row.product_id].append(row)
+    return grouped
+
+@router.get("/product/{product_id}", response_model=ProductAnalytics)
+async def get_product_analytics(
+    product_id: int,
+    db: db_dependency,
+    user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
+    time_range: str = "30d",
+    branch_type: str = "retail"
+):
+    # Get start date based on time range
+    end_date = datetime.now()
+    start_date = get_start_date(time_range)
+
+    queries = product_analytics_queries([product_id], start_date, end_date, branch_type)
+
+    # Independent of each other, so they run in parallel on their own connections
+    products, branch_products, sales_data, price_history, branch_sales = await run_queries(
+        "product_analytics",
+        *queries,
+        release=db
+    )
+    if not products:
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    return build_product_analytics(
+        products[0],
+        branch_products,
+        sales_data[0] if sales_data else None,
+        price_history,
+        branch_sales
+    )
+
+@router.get("/products")
+async def get_products_analytics(
+    db: db_dependency,
+    user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
+    product_ids: List[str] = Query(...),  # product IDs, or "all"
+    time_range: str = "30d",
+    branch_type: str = "retail"
+):
+    """ProductAnalytics of many products, streamed as one JSON object keyed by product_id.
+
+    Products are taken PRODUCT_ANALYTICS_CHUNK at a time and each chunk is
+    computed by the same grouped queries as the single product endpoint,
+    so a catalog-wide report costs a few queries per chunk instead of five
+    per product, and its first products are sent while the rest are still
+    being computed.
+    """
+    query = select(Product.id).order_by(Product.id)
+    if product_ids != ["all"]:
+        try:
+            requested = sorted({int(product_id) for product_id in product_ids})
+        except ValueError:
+            raise HTTPException(status_code=400, detail="product_ids must be product IDs or 'all'")
+        query = query.where(Product.id.in_(requested))
+
+    ids, = await run_queries("product_analytics_batch", lambda db: db.scalars(query).all(), release=db)
+    if product_ids != ["all"]:
+        missing = set(requested) - set(ids)
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Products not found: {sorted(missing)}")
+
+    end_date = datetime.now()
+    start_date = get_start_date(time_range)
+
+    async def stream():
+        yield "{"
+        separator = ""
+        for offset in range(0, len(ids), PRODUCT_ANALYTICS_CHUNK):
+            chunk = ids[offset:offset + PRODUCT_ANALYTICS_CHUNK]
+            products, branch_products, sales_data, price_history, branch_sales = await run_queries(
+                "product_analytics_batch",
+                *product_analytics_queries(chunk, start_date, end_date, branch_type),
+                release=db
+            )
+            branch_products = group_by_product(branch_products)
+            sales_data = {row.product_id: row for row in sales_data}
+            price_history = group_by_product(price_history)
+            branch_sales = group_by_product(branch_sales)
+
+            for product in products:
+                analytics = build_product_analytics(
+                    product,
+                    branch_products[product.id],
+                    sales_data.get(product.id),
+                    price_history[product.id],
+                    branch_sales[product.id]
+                )
+                yield f'{separator}"{product.id}":{analytics.model_dump_json()}'
+                separator = ","
+        yield "}"
+
+    return StreamingResponse(stream(), media_type="application/json")
+
 def get_start_date(time_range: str) -> datetime:
     end_date = datetime.now()
     if time_range == "7d":
@@ -772,6 +1010,7 @@ def get_start_date(time_range: str) -> datetime:
         return end_date - timedelta(days=365)
 
 @router.get("/overview")
+@cached_response()
 async def get_company_overview(
     db: db_dependency,
     current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN]))],
@@ -780,246 +1019,204 @@ async def get_company_overview(
 ):
     end_date = datetime.now()
     start_date = get_start_date(time_range)
-    
-    # Get branches of specified type
-    branches = db.query(Branch).filter(
-        Branch.is_active == True,
-        Branch.branch_type == branch_type
-    ).all()
-    branch_ids = [b.id for b in branches]
-
-    # Calculate overall metrics (existing code)
-    sales_data = db.query(
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('total_revenue'),
-        func.sum(InvReportItem.offtake).label('total_sales'),
-        func.sum(InvReportItem.offtake * (InvReportItem.current_srp - InvReportItem.current_cost)).label('gross_profit')
-    ).join(
-        InvReport,
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.branch_id.in_(branch_ids),
-        InvReport.created_at.between(start_date, end_date)
-    ).first()
-    
-    # Get branch performance
-    branch_performance = db.query(
-        Branch.id.label('branch_id'),
-        Branch.branch_name,
-        func.coalesce(func.sum(InvReportItem.offtake), 0).label('total_sales'),
-        func.coalesce(func.sum(InvReportItem.offtake * InvReportItem.current_srp), 0).label('revenue'),
-        func.coalesce(
-            db.query(func.sum(Expense.amount))
-            .filter(
-                Expense.branch_id == Branch.id,
-                Expense.scope == 'branch',
-                Expense.date_created.between(start_date, end_date)
-            ).as_scalar(),
-            0
-        ).label('total_expenses')
-    ).join(
-        InvReport, InvReport.branch_id == Branch.id, isouter=True
-    ).join(
-        InvReportItem, InvReportItem.invreport_id == InvReport.id, isouter=True
-    ).filter(
-        Branch.id.in_(branch_ids),
-        or_(
-            InvReport.created_at.between(start_date, end_date),
-            InvReport.created_at.is_(None)
-        )
-    ).group_by(
-        Branch.id,
-        Branch.branch_name
-    ).all()
-
-    # Get top products
-    top_products = db.query(
-        Product.id,
-        Product.name,
-        func.sum(InvReportItem.offtake).label('total_sales'),
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('revenue'),
-        func.sum(InvReportItem.offtake * (InvReportItem.current_srp - InvReportItem.current_cost)).label('profit')
-    ).join(
-        InvReportItem, InvReportItem.product_id == Product.id
-    ).join(
-        InvReport, and_(
-            InvReport.id == InvReportItem.invreport_id,
-            InvReport.branch_id.in_(branch_ids),
-            InvReport.created_at.between(start_date, end_date)
+    in_range = DailySales.day.between(start_date.date(), end_date.date())
+
+    # Every widget is built by one statement, each as a CTE aggregated to JSON
+    branches = (
+        select(Branch.id, Branch.branch_name)
+        .where(Branch.is_active == True, Branch.branch_type == branch_type)
+        .cte('scope_branches')
+    )
+    branch_ids = select(branches.c.id)
+
+    sales = (
+        select(
+            DailySales.branch_id,
+            DailySales.product_id,
+            DailySales.day,
+            DailySales.quantity,
+            DailySales.revenue,
+            DailySales.cost
         )
-    ).group_by(
-        Product.id,
-        Product.name
-    ).order_by(
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).desc()
-    ).limit(5).all()
+        .where(DailySales.branch_id.in_(branch_ids), in_range)
+        .cte('sales')
+    )
 
-    
-    total_revenue = float(sales_data.total_revenue or 0)
-    gross_profit = float(sales_data.gross_profit or 0)
-    total_expenses = db.query(func.sum(Expense.amount)).filter(
-        Expense.branch_id.in_(branch_ids),
-        Expense.date_created.between(start_date, end_date)
-    ).scalar() or 0
-    net_profit = gross_profit - total_expenses
-    profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
+    branch_sales = (
+        select(
+            sales.c.branch_id,
+            func.sum(sales.c.quantity).label('total_sales'),
+            func.sum(sales.c.revenue).label('revenue')
+        )
+        .group_by(sales.c.branch_id)
+        .cte('branch_sales')
+    )
+    allocations = (
+        select(ExpenseAllocation.branch_id, ExpenseAllocation.day, ExpenseAllocation.amount)
+        .where(
+            ExpenseAllocation.branch_id.in_(branch_ids),
+            ExpenseAllocation.day.between(start_date.date(), end_date.date())
+        )
+        .cte('allocations')
+    )
+    branch_expenses = (
+        select(allocations.c.branch_id, func.sum(allocations.c.amount).label('total_expenses'))
+        .group_by(allocations.c.branch_id)
+        .cte('branch_expenses')
+    )
+    branch_performance = (
+        select(func.json_agg(aggregate_order_by(
+            func.json_build_object(
+                'branch_id', branches.c.id,
+                'branch_name', branches.c.branch_name,
+                'total_sales', func.coalesce(branch_sales.c.total_sales, 0),
+                'revenue', func.coalesce(branch_sales.c.revenue, 0),
+                'total_expenses', func.coalesce(branch_expenses.c.total_expenses, 0)
+            ),
+            branches.c.id
+        )))
+        .select_from(branches)
+        .outerjoin(branch_sales, branch_sales.c.branch_id == branches.c.id)
+        .outerjoin(branch_expenses, branch_expenses.c.branch_id == branches.c.id)
+        .scalar_subquery()
+    )
 
-    # Calculate revenue trend
-    revenue_trend = []
-    
-    # Get revenue data directly from InvReport
-    revenue_data = db.query(
-        func.date(InvReport.created_at).label('date'),
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp).label('value')
-    ).join(
-        InvReportItem,
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.branch_id.in_(branch_ids),
-        InvReport.created_at.between(start_date, end_date)
-    ).group_by(
-        func.date(InvReport.created_at)
-    ).order_by(
-        func.date(InvReport.created_at)
-    ).all()
-
-    # Get expense data directly from expenses table
-    expense_data = db.query(
-        Expense.date_created.label('date'),
-        func.sum(case(
-            (Expense.scope == 'company_wide', 
-             Expense.amount / db.query(func.count(Branch.id)).scalar()),
-            (Expense.scope == 'main_office', Expense.amount),
-            else_=Expense.amount
-        )).label('value')
-    ).filter(
-        Expense.date_created.between(start_date, end_date),
-        or_(
-            Expense.branch_id.in_(branch_ids),
-            Expense.scope.in_(['company_wide', 'main_office'])
+    product_sales = (
+        select(
+            Product.id,
+            Product.name,
+            func.sum(sales.c.quantity).label('total_sales'),
+            func.sum(sales.c.revenue).label('revenue'),
+            func.sum(sales.c.revenue - sales.c.cost).label('profit')
         )
-    ).group_by(
-        Expense.date_created
-    ).all()
+        .join(sales, sales.c.product_id == Product.id)
+        .group_by(Product.id, Product.name)
+        .order_by(func.sum(sales.c.revenue).desc())
+        .limit(5)
+        .cte('top_products')
+    )
+    top_products = (
+        select(func.json_agg(aggregate_order_by(
+            func.json_build_object(
+                'id', product_sales.c.id,
+                'name', product_sales.c.name,
+                'total_sales', product_sales.c.total_sales,
+                'revenue', product_sales.c.revenue,
+                'profit', product_sales.c.profit
+            ),
+            product_sales.c.revenue.desc()
+        )))
+        .scalar_subquery()
+    )
 
-    # Convert to dictionaries for easier lookup
-    expense_dict = {exp.date: exp.value for exp in expense_data}
-    
-    # Combine revenue and expense data
-    for rev in revenue_data:
-        date = rev.date
-        revenue = rev.value or 0
-        expense = expense_dict.get(date, 0)
-        
-        revenue_trend.append({
-            "timestamp": date,
-            "value": revenue,
-            "profit": revenue - expense,
-            "expenses": expense
-        })
+    daily_revenue = (
+        select(sales.c.day, func.sum(sales.c.revenue).label('value'))
+        .group_by(sales.c.day)
+        .cte('daily_revenue')
+    )
+    daily_expenses = (
+        select(allocations.c.day, func.sum(allocations.c.amount).label('value'))
+        .group_by(allocations.c.day)
+        .cte('daily_expenses')
+    )
+    revenue_trend = (
+        select(func.json_agg(aggregate_order_by(
+            func.json_build_object(
+                'timestamp', daily_revenue.c.day,
+                'value', daily_revenue.c.value,
+                'expenses', func.coalesce(daily_expenses.c.value, 0)
+            ),
+            daily_revenue.c.day
+        )))
+        .select_from(daily_revenue)
+        .outerjoin(daily_expenses, daily_expenses.c.day == daily_revenue.c.day)
+        .scalar_subquery()
+    )
 
-    # First, get the total quantity per branch and product
-    product_quantities = db.query(
-        Branch.id.label('branch_id'),
-        Branch.branch_type,
-        Product.id.label('product_id'),
-        Product.wholesale_low_stock_threshold,
-        Product.retail_low_stock_threshold,
-        func.sum(case((ProductBatch.is_active == True, ProductBatch.quantity), else_=0)).label('total_quantity')
-    ).join(
-        BranchProduct, BranchProduct.branch_id == Branch.id
-    ).join(
-        Product, Product.id == BranchProduct.product_id
-    ).outerjoin(
-        ProductBatch, and_(
-            ProductBatch.product_id == Product.id,
-            ProductBatch.branch_id == Branch.id
+    # Stock and earliest expiry are maintained on branch_products
+    low_stock_branches = (
+        select(func.count(distinct(BranchProduct.branch_id)))
+        .join(Product, Product.id == BranchProduct.product_id)
+        .join(Branch, Branch.id == BranchProduct.branch_id)
+        .where(
+            BranchProduct.branch_id.in_(branch_ids),
+            BranchProduct.is_available == True,
+            BranchProduct.quantity <= case(
+                (Branch.branch_type == 'wholesale', Product.wholesale_low_stock_threshold),
+                else_=Product.retail_low_stock_threshold
+            )
         )
-    ).filter(
-        Branch.id.in_(branch_ids)
-    ).group_by(
-        Branch.id,
-        Branch.branch_type,
-        Product.id,
-        Product.wholesale_low_stock_threshold,
-        Product.retail_low_stock_threshold
-    ).subquery()
-
-    # Then use this subquery for the branch-level counts
-    inventory_stats = db.query(
-        func.count(distinct(Branch.id)).label('total_branches'),
-        func.count(distinct(case(
-            (exists(
-                select(1).select_from(product_quantities)
-                .join(BranchProduct, and_(
-                    BranchProduct.branch_id == product_quantities.c.branch_id,
-                    BranchProduct.product_id == product_quantities.c.product_id,
-                    BranchProduct.is_available == True
-                ))
-                .correlate(Branch)
-                .where(and_(
-                    product_quantities.c.branch_id == Branch.id,
-                    product_quantities.c.total_quantity <= 
-                    case(
-                        (product_quantities.c.branch_type == 'wholesale', 
-                         product_quantities.c.wholesale_low_stock_threshold),
-                        else_=product_quantities.c.retail_low_stock_threshold
-                    )
-                ))
-            ), Branch.id)
-        ))).label('low_stock_branches'),
-        func.count(distinct(case(
-            (exists(
-                select(1).select_from(ProductBatch)
-                .correlate(Branch)
-                .where(and_(
-                    ProductBatch.branch_id == Branch.id,
-                    ProductBatch.expiration_date <= datetime.now() + timedelta(days=30),
-                    ProductBatch.is_active == True,
-                    ProductBatch.quantity > 0
-                ))
-            ), Branch.id)
-        ))).label('near_expiry_branches')
-    ).select_from(Branch).filter(
-        Branch.id.in_(branch_ids)
-    ).first()
+        .scalar_subquery()
+    )
+    near_expiry_branches = (
+        select(func.count(distinct(BranchProduct.branch_id)))
+        .where(
+            BranchProduct.branch_id.in_(branch_ids),
+            BranchProduct.current_expiration_date <= (datetime.now() + timedelta(days=30)).date()
+        )
+        .scalar_subquery()
+    )
+
+    overview_query = (
+        select(
+            select(func.count()).select_from(branches).scalar_subquery().label('active_branches'),
+            select(func.sum(sales.c.revenue)).scalar_subquery().label('total_revenue'),
+            select(func.sum(sales.c.quantity)).scalar_subquery().label('total_sales'),
+            select(func.sum(sales.c.revenue - sales.c.cost)).scalar_subquery().label('gross_profit'),
+            select(func.sum(allocations.c.amount)).scalar_subquery().label('total_expenses'),
+            branch_performance.label('branch_performance'),
+            top_products.label('top_products'),
+            revenue_trend.label('revenue_trend'),
+            low_stock_branches.label('low_stock_branches'),
+            near_expiry_branches.label('near_expiry_branches')
+        )
+    )
+    overview, = await run_queries("company_overview", lambda db: db.execute(overview_query).one(), release=db)
+
+    total_revenue = float(overview.total_revenue or 0)
+    gross_profit = float(overview.gross_profit or 0)
+    total_expenses = overview.total_expenses or 0
+    net_profit = gross_profit - total_expenses
+    profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
 
     return {
         "total_revenue": total_revenue,
-        "total_sales": int(sales_data.total_sales or 0),
+        "total_sales": int(overview.total_sales or 0),
         "total_expenses": float(total_expenses),
         "gross_profit": gross_profit,
         "net_profit": net_profit,
         "profit_margin": profit_margin,
-        "active_branches": len(branches),
+        "active_branches": overview.active_branches,
         "branch_performance": [{
-            "branch_id": bp.branch_id,
-            "branch_name": bp.branch_name,
-            "total_sales": int(bp.total_sales or 0),
-            "revenue": float(bp.revenue or 0),
-            "total_expenses": float(bp.total_expenses or 0),
-            "profit": float((bp.revenue or 0) - (bp.total_expenses or 0))
-        } for bp in branch_performance],
+            "branch_id": bp["branch_id"],
+            "branch_name": bp["branch_name"],
+            "total_sales": int(bp["total_sales"]),
+            "revenue": float(bp["revenue"]),
+            "total_expenses": float(bp["total_expenses"]),
+            "profit": float(bp["revenue"] - bp["total_expenses"])
+        } for bp in overview.branch_performance or []],
         "top_products": [{
-            "id": p.id,
-            "name": p.name,
-            "total_sales": int(p.total_sales or 0),
-            "revenue": float(p.revenue or 0),
-            "profit_margin": float(p.profit / p.revenue * 100) if p.revenue else 0
-        } for p in top_products],
+            "id": p["id"],
+            "name": p["name"],
+            "total_sales": int(p["total_sales"] or 0),
+            "revenue": float(p["revenue"] or 0),
+            "profit_margin": float(p["profit"] / p["revenue"] * 100) if p["revenue"] else 0
+        } for p in overview.top_products or []],
         "revenue_trend": [{
-            "timestamp": entry["timestamp"],
+            "timestamp": date.fromisoformat(entry["timestamp"]),
             "value": float(entry["value"]),
-            "profit": float(entry["profit"]),
+            "profit": float(entry["value"] - entry["expenses"]),
             "expenses": float(entry["expenses"])
-        } for entry in revenue_trend],
+        } for entry in overview.revenue_trend or []],
         "inventory": {
-            "total_branches": int(inventory_stats.total_branches or 0),
-            "low_stock_branches": int(inventory_stats.low_stock_branches or 0),
-            "near_expiry_branches": int(inventory_stats.near_expiry_branches or 0)
+            "total_branches": int(overview.active_branches or 0),
+            "low_stock_branches": int(overview.low_stock_branches or 0),
+            "near_expiry_branches": int(overview.near_expiry_branches or 0)
         }
     }
 
 @router.get("/monthly-comparison")
+@cached_response(scope=lambda kwargs: kwargs['branch_id'])
 async def get_monthly_comparison(
     db: db_dependency,
     current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
@@ -1040,54 +1237,44 @@ async def get_monthly_comparison(
     elif branch_id:
         branch_ids = [branch_id]
     else:
-        # Get branches of specified type
-        branches = db.query(Branch).filter(
+        # Branches of the specified type, as a subquery of the sums below
+        branch_ids = select(Branch.id).where(
             Branch.is_active == True,
             Branch.branch_type == branch_type
-        ).all()
-        branch_ids = [b.id for b in branches]
-
-    # Get previous month revenue
-    prev_month_revenue = db.query(
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp)
-    ).join(
-        InvReport,
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.branch_id.in_(branch_ids),
-        InvReport.created_at >= previous_month_start,
-        InvReport.created_at < current_month_start
-    ).scalar() or 0
-
-    # Get two months ago revenue
-    two_months_ago_revenue = db.query(
-        func.sum(InvReportItem.offtake * InvReportItem.current_srp)
-    ).join(
-        InvReport,
-        InvReport.id == InvReportItem.invreport_id
-    ).filter(
-        InvReport.branch_id.in_(branch_ids),
-        InvReport.created_at >= two_months_ago_start,
-        InvReport.created_at < previous_month_start
-    ).scalar() or 0
-
-    # Get previous month expenses
-    prev_month_expenses = db.query(
-        func.sum(Expense.amount)
-    ).filter(
-        Expense.branch_id.in_(branch_ids),
-        Expense.date_created >= previous_month_start,
-        Expense.date_created < current_month_start
-    ).scalar() or 0
-
-    # Get two months ago expenses
-    two_months_ago_expenses = db.query(
-        func.sum(Expense.amount)
-    ).filter(
-        Expense.branch_id.in_(branch_ids),
-        Expense.date_created >= two_months_ago_start,
-        Expense.date_created < previous_month_start
-    ).scalar() or 0
+        )
+
+    def revenue_between(start: datetime, end: datetime):
+        return lambda db: db.query(
+            func.sum(DailySales.revenue)
+        ).filter(
+            DailySales.branch_id.in_(branch_ids),
+            DailySales.day >= start.date(),
+            DailySales.day < end.date()
+        ).scalar() or 0
+
+    def expenses_between(start: datetime, end: datetime):
+        return lambda db: db.query(
+            func.sum(ExpenseAllocation.amount)
+        ).filter(
+            ExpenseAllocation.branch_id.in_(branch_ids),
+            ExpenseAllocation.day >= start.date(),
+            ExpenseAllocation.day < end.date()
+        ).scalar() or 0
+
+    # Previous month and the month before it, all four sums in parallel
+    (
+        prev_month_revenue,
+        two_months_ago_revenue,
+        prev_month_expenses,
+        two_months_ago_expenses
+    ) = await run_queries(
+        "monthly_comparison",
+        revenue_between(previous_month_start, current_month_start),
+        revenue_between(two_months_ago_start, previous_month_start),
+        expenses_between(previous_month_start, current_month_start),
+        expenses_between(two_months_ago_start, previous_month_start),
+        release=db
+    )
 
     # Calculate percentage changes
     revenue_change = ((prev_month_revenue - two_months_ago_revenue) / two_months_ago_revenue * 100) if two_months_ago_revenue > 0 else 0
@@ -1104,3 +1291,67 @@ async def get_monthly_comparison(
         "branch_id": branch_id
     }
 
+MAX_TIMESERIES_BUCKETS = 5000
+
+@router.get("/timeseries", response_model=TimeSeriesResponse)
+async def get_timeseries(
+    db: db_dependency,
+    current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
+    metrics: List[str] = Query(...),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    bucket: Optional[str] = None,  # Can be 'hour', 'day', 'month', picked from the range when omitted
+    aggregate: str = "avg",  # Can be 'sum', 'avg', 'min', 'max', 'count'
+    fill: Optional[str] = None,  # Empty buckets are null, or 'zero', or 'previous' value
+    branch_id: Optional[int] = None,
+    product_id: Optional[int] = None
+):
+    """Recorded metrics as aligned, gap-filled series, one value per bucket for every requested metric"""
+    if current_user["role"] in [UserRole.PHARMACIST, UserRole.WHOLESALER]:
+        if branch_id != current_user["branch_id"]:
+            raise HTTPException(status_code=403, detail="Not authorized to view this branch's data")
+
+    end_date = end_date or datetime.now()
+    start_date = start_date or end_date - timedelta(days=30)
+    if start_date >= end_date:
+        raise HTTPException(status_code=400, detail="start_date must be before end_date")
+    if bucket is not None and bucket not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid bucket. Must be one of: {', '.join(RESOLUTIONS)}")
+    if aggregate not in AGGREGATES:
+        raise HTTPException(status_code=400, detail=f"Invalid aggregate. Must be one of: {', '.join(AGGREGATES)}")
+    if fill not in FILLS:
+        raise HTTPException(status_code=400, detail="Invalid fill. Must be one of: zero, previous")
+
+    bucket = bucket or pick_resolution(start_date, end_date)
+    bucket_size = {"hour": timedelta(hours=1), "day": timedelta(days=1), "month": timedelta(days=28)}[bucket]
+    if (end_date - start_date) / bucket_size > MAX_TIMESERIES_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Range too long for {bucket} buckets, use a larger bucket")
+
+    (resolution, timestamps, series), = await run_queries(
+        "timeseries",
+        lambda db: query_timeseries(
+            db,
+            list(dict.fromkeys(metrics)),
+            start_date,
+            end_date,
+            resolution=bucket,
+            aggregate=aggregate,
+            fill=fill,
+            branch_id=branch_id,
+            product_id=product_id
+        ),
+        release=db
+    )
+    return {
+        "resolution": resolution,
+        "aggregate": aggregate,
+        "timestamps": timestamps,
+        "series": series
+    }
+
+@router.get("/cache-stats")
+async def get_cache_stats(
+    current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN]))]
+):
+    """Hit and miss counters of the analytics response cache"""
+    return analytics_cache.stats()
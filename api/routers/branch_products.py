@@ -6,9 +6,10 @@ from datetime import date, datetime
 
 from api.models import BranchProduct, Branch, Product, UserRole, BranchType
 from api.deps import db_dependency, role_required
+from api.inventory import find_stock_drift, refresh_low_stock, sync_branch_stock
+from api.cache import bump_data_version
 from sqlalchemy.orm import joinedload
 import sqlalchemy as sa
-from api.models import ProductBatch
 
 router = APIRouter(
     prefix='/branch-products',
@@ -67,6 +68,19 @@ class LowStockSummary(BaseModel):
 class AvailabilityUpdate(BaseModel):
     is_available: bool
 
+class StockDriftItem(BaseModel):
+    branch_id: int
+    product_id: int
+    quantity: Optional[int]
+    current_expiration_date: Optional[date]
+    expected_quantity: int
+    expected_expiration_date: Optional[date]
+
+class StockDriftReport(BaseModel):
+    drift_count: int
+    repaired: bool
+    items: List[StockDriftItem]
+
 @router.post('/', response_model=BranchProductResponse, status_code=status.HTTP_201_CREATED)
 def create_branch_product(
     branch_product: BranchProductCreate,
@@ -96,6 +110,8 @@ def create_branch_product(
 
     db_branch_product = BranchProduct(**branch_product.dict())
     db.add(db_branch_product)
+    # Stock always comes from the batches
+    sync_branch_stock(db, branch_id=branch_product.branch_id, product_ids=[branch_product.product_id])
     db.commit()
     db.refresh(db_branch_product)
     return db_branch_product
@@ -108,19 +124,7 @@ def get_branch_products(
     product_id: Optional[int] = None,
     low_stock_only: bool = False
 ):
-    # First get active batches with their quantities
-    batch_totals = db.query(
-        ProductBatch.branch_id,
-        ProductBatch.product_id,
-        sa.func.sum(ProductBatch.quantity).label('total_quantity')
-    ).filter(
-        ProductBatch.is_active == True
-    ).group_by(
-        ProductBatch.branch_id,
-        ProductBatch.product_id
-    ).subquery()
-    
-    # Join with branch products
+    # Stock is stored on the branch product, no need to load batches
     query = (
         db.query(
             BranchProduct,
@@ -130,7 +134,6 @@ def get_branch_products(
         .join(Product)
         .join(Branch)
         .options(
-            joinedload(BranchProduct.batches),
             joinedload(BranchProduct.product),
             joinedload(BranchProduct.branch)
         )
@@ -164,21 +167,18 @@ def get_branch_products(
     # Update quantities and filter low stock if requested
     response = []
     for bp, product, branch in results:
-        active_quantity = sum(
-            batch.quantity for batch in bp.batches 
-            if batch.is_active
-        )
-        bp.quantity = active_quantity
+        active_quantity = bp.active_quantity
+        is_low_stock = bp.is_low_stock
         
-        if not low_stock_only or bp.is_low_stock:
+        if not low_stock_only or is_low_stock:
             response_item = {
                 "id": f"{bp.branch_id}-{bp.product_id}",
                 "product_id": bp.product_id,
                 "branch_id": bp.branch_id,
-                "quantity": bp.quantity,
-                "peso_value": bp.peso_value,
+                "quantity": active_quantity,
+                "peso_value": active_quantity * product.cost,
                 "current_expiration_date": bp.current_expiration_date,
-                "is_low_stock": bp.is_low_stock,
+                "is_low_stock": is_low_stock,
                 "active_quantity": active_quantity,
                 "is_available": bp.is_available,
                 "branch_type": branch.branch_type,
@@ -289,35 +289,19 @@ def get_low_stock_products(
         db.query(
             Product,
             Branch,
-            BranchProduct,
-            sa.func.sum(ProductBatch.quantity).label('current_quantity')
+            BranchProduct
         )
         .join(BranchProduct, sa.and_(
             BranchProduct.product_id == Product.id,
             BranchProduct.branch_id == branch_id
         ))
         .join(Branch)
-        .outerjoin(ProductBatch, sa.and_(
-            ProductBatch.product_id == Product.id,
-            ProductBatch.branch_id == branch_id,
-            ProductBatch.is_active == True
-        ))
-        .filter(BranchProduct.is_available == True)
-        .group_by(
-            Product.id,
-            Branch.id,
-            BranchProduct.product_id,
-            BranchProduct.branch_id,
-            BranchProduct.is_available
-        )
-        .having(
-            sa.or_(
-                sa.func.sum(ProductBatch.quantity) <= threshold_column,
-                sa.func.sum(ProductBatch.quantity) == None
-            )
+        .filter(
+            BranchProduct.is_available == True,
+            BranchProduct.quantity <= threshold_column
         )
         .order_by(
-            (sa.func.coalesce(sa.func.sum(ProductBatch.quantity), 0) / threshold_column).asc(),
+            (BranchProduct.quantity / threshold_column).asc(),
             Product.name.asc()
         )
     )
@@ -328,7 +312,7 @@ def get_low_stock_products(
         {
             "product_id": product.id,
             "name": product.name,
-            "current_quantity": int(quantity or 0),
+            "current_quantity": branch_product.quantity,
             "threshold": (
                 product.wholesale_low_stock_threshold 
                 if branch.branch_type == 'wholesale' 
@@ -337,10 +321,10 @@ def get_low_stock_products(
             "branch_id": branch.id,
             "branch_name": branch.branch_name,
             "is_available": branch_product.is_available,
-            "low_stock_since": low_stock_since,
-            "days_in_low_stock": days_in_low_stock
+            "low_stock_since": branch_product.low_stock_since,
+            "days_in_low_stock": branch_product.days_in_low_stock
         }
-        for product, branch, branch_product, quantity, low_stock_since, days_in_low_stock in results
+        for product, branch, branch_product in results
     ]
 
 @router.get('/low-stock-summary/{branch_id}', response_model=LowStockSummary)
@@ -365,7 +349,6 @@ def get_low_stock_summary(
     query = (
         db.query(BranchProduct, Product, Branch)
         .options(
-            joinedload(BranchProduct.batches),
             joinedload(BranchProduct.product),
             joinedload(BranchProduct.branch)
         )
@@ -387,21 +370,17 @@ def get_low_stock_summary(
     low_stock_products = []
     
     for bp, product, branch in results:
-        active_quantity = sum(
-            batch.quantity for batch in bp.batches 
-            if batch.is_active
-        )
-        bp.quantity = active_quantity
+        active_quantity = bp.active_quantity
         
         if bp.is_low_stock:
             response_item = {
                 "id": f"{bp.branch_id}-{bp.product_id}",
                 "product_id": bp.product_id,
                 "branch_id": bp.branch_id,
-                "quantity": bp.quantity,
-                "peso_value": bp.peso_value,
+                "quantity": active_quantity,
+                "peso_value": active_quantity * product.cost,
                 "current_expiration_date": bp.current_expiration_date,
-                "is_low_stock": bp.is_low_stock,
+                "is_low_stock": True,
                 "active_quantity": active_quantity,
                 "is_available": bp.is_available,
                 "branch_type": branch.branch_type,
@@ -410,7 +389,9 @@ def get_low_stock_summary(
                 "retail_low_stock_threshold": product.retail_low_stock_threshold,
                 "wholesale_low_stock_threshold": product.wholesale_low_stock_threshold,
                 "product_name": product.name,
-                "days_in_low_stock": bp.days_in_low_stock
+                "days_in_low_stock": bp.days_in_low_stock,
+                "low_stock_since": bp.low_stock_since,
+                "image_url": product.image_url
             }
             low_stock_products.append(response_item)
     
@@ -465,6 +446,40 @@ def update_product_availability(
         raise HTTPException(status_code=404, detail="Branch product not found")
     
     db_branch_product.is_available = availability.is_available
+    refresh_low_stock(db, branch_id=branch_id, product_id=product_id)
+    bump_data_version(db, branch_id)
     db.commit()
     db.refresh(db_branch_product)
-    return {"detail": "Availability updated successfully"}
\ No newline at end of file
+    return {"detail": "Availability updated successfully"}
+
+@router.get('/stock-drift', response_model=StockDriftReport)
+def get_stock_drift(
+    db: db_dependency,
+    user: Annotated[dict, Depends(role_required(UserRole.ADMIN))],
+    branch_id: Optional[int] = None
+):
+    """List branch products whose stored stock disagrees with their active batches"""
+    items = find_stock_drift(db, branch_id)
+    return {
+        "drift_count": len(items),
+        "repaired": False,
+        "items": items
+    }
+
+@router.post('/stock-drift/repair', response_model=StockDriftReport)
+def repair_stock_drift(
+    db: db_dependency,
+    user: Annotated[dict, Depends(role_required(UserRole.ADMIN))],
+    branch_id: Optional[int] = None
+):
+    """Recompute stored stock from the active batches for every drifted branch product"""
+    items = find_stock_drift(db, branch_id)
+    if items:
+        sync_branch_stock(db, branch_id=branch_id)
+        bump_data_version(db, branch_id)
+        db.commit()
+    return {
+        "drift_count": len(items),
+        "repaired": bool(items),
+        "items": items
+    }
@@ -1,18 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session
 from typing import Annotated, List, Optional
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from datetime import date, timedelta
 import sqlalchemy as sa
 
-from api.models import Branch, UserRole, Product, BranchProduct, ProductBatch
+from api.models import Branch, BranchType, UserRole, Product, BranchProduct, ProductBatch
 from api.deps import db_dependency, role_required
+from api.cache import bump_data_version
+from api.allocations import reallocate_company_wide
 
 router = APIRouter(
     prefix='/branches',
     tags=['branches']
 )
 
+NEAR_EXPIRY_DAYS = 30  # current expiry within this many days flags a branch product as near expiry
+
 class BranchBase(BaseModel):
     branch_name: str
     location: str
@@ -31,6 +35,9 @@ class BranchResponse(BranchBase):
     branch_type: str
     has_low_stock: bool = False
     has_near_expiry: bool = False
+    low_stock_count: int = 0
+    near_expiry_count: int = 0
+    expired_batch_count: int = 0
 
     class Config:
         from_attributes = True
@@ -59,57 +66,77 @@ def create_branch(
         )
         db.add(branch_product)
 
+    # The new branch takes its share of this period's company-wide expenses
+    reallocate_company_wide(db)
+    bump_data_version(db)
     db.commit()
     db.refresh(new_branch)
     return new_branch
 
+def branch_status_query():
+    """Branches with their low stock and expiry counts, one grouped query for any number of branches"""
+    today = date.today()
+    threshold = sa.case(
+        (Branch.branch_type == BranchType.WHOLESALE.value, Product.wholesale_low_stock_threshold),
+        else_=Product.retail_low_stock_threshold
+    )
+    stock = (
+        sa.select(
+            BranchProduct.branch_id,
+            sa.func.count().filter(BranchProduct.quantity <= threshold).label('low_stock_count'),
+            sa.func.count().filter(
+                BranchProduct.current_expiration_date <= today + timedelta(days=NEAR_EXPIRY_DAYS)
+            ).label('near_expiry_count')
+        )
+        .join(Branch, Branch.id == BranchProduct.branch_id)
+        .join(Product, Product.id == BranchProduct.product_id)
+        .where(BranchProduct.is_available == True)
+        .group_by(BranchProduct.branch_id)
+        .subquery('stock')
+    )
+    expired = (
+        sa.select(ProductBatch.branch_id, sa.func.count().label('expired_batch_count'))
+        .where(
+            ProductBatch.is_active == True,
+            ProductBatch.quantity > 0,
+            ProductBatch.expiration_date <= today
+        )
+        .group_by(ProductBatch.branch_id)
+        .subquery('expired')
+    )
+    return (
+        sa.select(
+            Branch,
+            sa.func.coalesce(stock.c.low_stock_count, 0).label('low_stock_count'),
+            sa.func.coalesce(stock.c.near_expiry_count, 0).label('near_expiry_count'),
+            sa.func.coalesce(expired.c.expired_batch_count, 0).label('expired_batch_count')
+        )
+        .outerjoin(stock, stock.c.branch_id == Branch.id)
+        .outerjoin(expired, expired.c.branch_id == Branch.id)
+        .order_by(Branch.id)
+    )
+
+def with_status(row) -> Branch:
+    branch = row.Branch
+    branch.low_stock_count = row.low_stock_count
+    branch.near_expiry_count = row.near_expiry_count
+    branch.expired_batch_count = row.expired_batch_count
+    branch.has_low_stock = row.low_stock_count > 0
+    branch.has_near_expiry = row.near_expiry_count > 0
+    return branch
+
 @router.get('/', response_model=List[BranchResponse])
 def get_branches(
     db: db_dependency,
     user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
 ):
-    query = db.query(Branch)
+    query = branch_status_query()
     
     # Non-admin users can only view their own branch
     if user['role'] in [UserRole.PHARMACIST.value, UserRole.WHOLESALER.value]:
-        query = query.filter(Branch.id == user['branch_id'])
-    
-    branches = query.all()
+        query = query.where(Branch.id == user['branch_id'])
     
-    for branch in branches:
-        # Get branch products that are available with their batches
-        branch_products = (
-            db.query(BranchProduct)
-            .options(joinedload(BranchProduct.batches))
-            .filter(
-                BranchProduct.branch_id == branch.id,
-                BranchProduct.is_available == True
-            )
-            .all()
-        )
-        
-        # Check for low stock
-        has_low_stock = any(bp.is_low_stock for bp in branch_products)
-        
-        # Check for near expiry or expired (30 days threshold)
-        thirty_days_from_now = datetime.now().date() + timedelta(days=30)
-        today = datetime.now().date()
-        
-        has_near_expiry = any(
-            any(
-                batch.is_active and (
-                    batch.expiration_date <= thirty_days_from_now or  # Near expiry
-                    batch.expiration_date <= today  # Already expired
-                )
-                for batch in bp.batches
-            )
-            for bp in branch_products
-        )
-        
-        branch.has_low_stock = has_low_stock
-        branch.has_near_expiry = has_near_expiry
-    
-    return branches
+    return [with_status(row) for row in db.execute(query)]
 
 @router.get('/{branch_id}', response_model=BranchResponse)
 def get_branch(
@@ -117,8 +144,8 @@ def get_branch(
     db: db_dependency, 
     user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))]
 ):
-    branch = db.query(Branch).filter(Branch.id == branch_id).first()
-    if not branch:
+    row = db.execute(branch_status_query().where(Branch.id == branch_id)).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Branch not found")
     
     # Non-admin users can only view their own branch
@@ -129,29 +156,7 @@ def get_branch(
             detail="You can only view your assigned branch"
         )
     
-    # Get branch products
-    branch_products = (
-        db.query(BranchProduct)
-        .filter(
-            BranchProduct.branch_id == branch_id,
-            BranchProduct.is_available == True
-        )
-        .all()
-    )
-
-    # Check for low stock and near expiry using branch products
-    has_low_stock = any(bp.is_low_stock for bp in branch_products)
-    has_near_expiry = any(
-        bp.current_expiration_date 
-        and bp.current_expiration_date <= datetime.now().date() + timedelta(days=30)
-        for bp in branch_products
-    )
-
-    # Add the status to the branch response
-    branch.has_low_stock = has_low_stock
-    branch.has_near_expiry = has_near_expiry
-    
-    return branch
+    return with_status(row)
 
 @router.put('/{branch_id}', response_model=BranchResponse)
 def update_branch(
@@ -164,9 +169,13 @@ def update_branch(
     if not db_branch:
         raise HTTPException(status_code=404, detail="Branch not found")
     
-    for key, value in branch_update.dict(exclude_unset=True).items():
+    updates = branch_update.dict(exclude_unset=True)
+    for key, value in updates.items():
         setattr(db_branch, key, value)
     
+    if 'is_active' in updates:
+        reallocate_company_wide(db)
+    bump_data_version(db)
     db.commit()
     db.refresh(db_branch)
     return db_branch
@@ -181,5 +190,7 @@ def delete_branch(
     if not branch:
         raise HTTPException(status_code=404, detail="Branch not found")
     db.delete(branch)
+    reallocate_company_wide(db)
+    bump_data_version(db)
     db.commit()
     return {"detail": "Branch deleted successfully"}
\ No newline at end of file
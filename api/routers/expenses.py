@@ -1,11 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session, joinedload
-from typing import List, Optional, Annotated
+from sqlalchemy.orm import Session, joinedload, selectinload
+from typing import Dict, List, Optional, Annotated
 from pydantic import BaseModel, Field, computed_field
 from datetime import date, datetime, timedelta
 
-from api.models import Expense, ExpenseScope, ExpenseType, Branch, UserRole, AnalyticsTimeSeries
+from api.models import AllocationPolicy, Expense, ExpenseScope, ExpenseType, Branch, UserRole
 from api.deps import db_dependency, role_required
+from api.metrics import metric_writer
+from api.cache import bump_data_version
+from api.allocations import allocate_expense
 
 router = APIRouter(
     prefix='/expenses',
@@ -20,15 +23,26 @@ class ExpenseBase(BaseModel):
     scope: ExpenseScope = ExpenseScope.BRANCH
     branch_id: Optional[int] = None
     date_created: Optional[date] = None
+    allocation_policy: AllocationPolicy = AllocationPolicy.EVEN
 
 class ExpenseCreate(ExpenseBase):
-    pass
+    allocations: Optional[Dict[int, float]] = None  # branch_id -> amount, custom policy only
 
 class ExpenseUpdate(BaseModel):
     name: Optional[str] = None
     type: Optional[ExpenseType] = None
     amount: Optional[float] = Field(gt=0, default=None)
     date_created: Optional[date] = None
+    allocation_policy: Optional[AllocationPolicy] = None
+    allocations: Optional[Dict[int, float]] = None
+
+class ExpenseAllocationResponse(BaseModel):
+    branch_id: Optional[int] = None  # None for the main office
+    amount: float
+
+    model_config = {
+        "from_attributes": True
+    }
 
 class BranchResponse(BaseModel):
     id: int
@@ -45,6 +59,7 @@ class ExpenseResponse(ExpenseBase):
     created_at: datetime
     updated_at: datetime
     branch: Optional[BranchResponse] = None
+    allocations: List[ExpenseAllocationResponse] = []
 
     model_config = {
         "from_attributes": True
@@ -59,23 +74,38 @@ class ExpenseAnalytics(BaseModel):
     last_expense_date: date
     category_distribution: List[dict]
 
+def expense_branch_id(expense: Expense) -> Optional[int]:
+    """Branch whose analytics an expense affects, None for main office, company-wide and custom split expenses"""
+    if expense.scope == ExpenseScope.BRANCH and expense.allocation_policy != AllocationPolicy.CUSTOM:
+        return expense.branch_id
+    return None
+
+def check_allocations(allocation_policy: AllocationPolicy, allocations: Optional[Dict[int, float]]):
+    if allocations is not None and allocation_policy != AllocationPolicy.CUSTOM:
+        raise HTTPException(
+            status_code=400,
+            detail="Allocations can only be given with the custom allocation policy"
+        )
+
 @router.post("/", response_model=ExpenseResponse, status_code=status.HTTP_201_CREATED)
 def create_expense(
     expense: ExpenseCreate,
     db: db_dependency,
     current_user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))]
 ):
+    check_allocations(expense.allocation_policy, expense.allocations)
     db_expense = Expense(
-        **expense.model_dump(),
+        **expense.model_dump(exclude={'allocations'}),
         created_by_id=current_user['id']
     )
     db.add(db_expense)
+    allocate_expense(db, db_expense, expense.allocations)
+    bump_data_version(db, expense_branch_id(db_expense))
     db.commit()
     db.refresh(db_expense)
 
     # Record the expense metric
-    AnalyticsTimeSeries.record_metric(
-        db,
+    metric_writer.record(
         "expense",
         db_expense.amount,
         branch_id=db_expense.branch_id
@@ -94,7 +124,7 @@ def get_expenses(
     start_date: Optional[date] = None,
     end_date: Optional[date] = None
 ):
-    query = db.query(Expense).options(joinedload(Expense.branch))
+    query = db.query(Expense).options(joinedload(Expense.branch), selectinload(Expense.allocations))
     
     if scope:
         query = query.filter(Expense.scope == scope)
@@ -206,9 +236,19 @@ def update_expense(
             detail="You can only update expenses from your branch"
         )
     
-    for key, value in expense_update.model_dump(exclude_unset=True).items():
+    updates = expense_update.model_dump(exclude_unset=True)
+    allocations = updates.pop('allocations', None)
+    check_allocations(updates.get('allocation_policy', expense.allocation_policy), allocations)
+
+    previous_branch_id = expense_branch_id(expense)
+    for key, value in updates.items():
         setattr(expense, key, value)
-    
+
+    if allocations is not None or updates.keys() & {'amount', 'date_created', 'allocation_policy'}:
+        allocate_expense(db, expense, allocations)
+    bump_data_version(db, previous_branch_id)
+    if expense_branch_id(expense) != previous_branch_id:
+        bump_data_version(db, expense_branch_id(expense))
     db.commit()
     db.refresh(expense)
     return expense
@@ -231,4 +271,5 @@ def delete_expense(
         )
     
     db.delete(expense)
+    bump_data_version(db, expense_branch_id(expense))
     db.commit() 
\ No newline at end of file
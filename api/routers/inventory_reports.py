@@ -1,12 +1,27 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session, joinedload, selectinload
 import sqlalchemy as sa
-from typing import List, Optional, Annotated
+from typing import Dict, List, Optional, Annotated
 from pydantic import BaseModel, computed_field
 from datetime import date, datetime, timedelta
 
-from api.models import Branch, InvReport, InvReportItem, BranchProduct, Product, UserRole, ProductBatch, InvReportBatch, AnalyticsTimeSeries
+from api.models import Branch, InvReport, InvReportItem, BranchProduct, Product, UserRole, ProductBatch, InvReportBatch
 from api.deps import db_dependency, role_required
+from api.inventory import (
+    EXPIRY_CRITICAL_DAYS,
+    EXPIRY_EXPIRED_DAYS,
+    EXPIRY_WARNING_DAYS,
+    allocate_fefo,
+    apply_low_stock,
+    expiry_bucket,
+    lock_batches,
+    remaining_stock,
+    take_allocated
+)
+from api.rollups import record_daily_sales
+from api.metrics import metric_writer
+from api.cache import bump_data_version
+from api.exports import ExportFormat, export_response
 
 router = APIRouter(
     prefix='/inventory-reports',
@@ -41,6 +56,7 @@ class BatchInfo(BaseModel):
     quantity: int
     expiration_date: date
     batch_type: str
+    product_batch_id: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -179,162 +195,40 @@ class InvReportSummaryResponse(BaseModel):
     class Config:
         from_attributes = True
 
-def update_batch_quantities(db: Session, branch_id: int, product_id: int, used_quantity: int):
-    remaining = used_quantity
-    
-    # Get all active batches including newly added ones
-    batches = (db.query(ProductBatch)
-        .filter(
-            ProductBatch.branch_id == branch_id,
-            ProductBatch.product_id == product_id,
-            ProductBatch.is_active == True
-        )
-        .order_by(ProductBatch.expiration_date)
-        .all())
-
-    # Get pending batches from the current transaction
-    pending_batches = [
-        obj for obj in db.new 
-        if isinstance(obj, ProductBatch) 
-        and obj.branch_id == branch_id 
-        and obj.product_id == product_id
-    ]
-    
-    # Combine and sort all batches by expiration date
-    all_batches = sorted(batches + pending_batches, key=lambda x: x.expiration_date)
-    
-    # Calculate total available quantity
-    total_available = sum(batch.quantity for batch in all_batches)
-    
-    if total_available < used_quantity:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Insufficient quantity available. Required: {used_quantity}, Available: {total_available}"
-        )
+def process_batch(db: Session, branch_id: int, product_id: int, batch_info: BatchDeliveryInfo | BatchTransferInfo, current_time: datetime, product_batches: List[ProductBatch]):
+    """Merge a delivery or transfer into the product's loaded active batches"""
+    # Merge quantities for same expiration date
+    existing_batch = next(
+        (b for b in product_batches if b.expiration_date == batch_info.expiration_date),
+        None
+    )
 
-    # Process all batches in order of expiration date
-    for batch in all_batches:
-        if batch.quantity <= remaining:
-            remaining -= batch.quantity
-            batch.is_active = False
-        else:
-            batch.quantity -= remaining
-            break
-
-def process_batch(db: Session, branch_id: int, product_id: int, batch_info: BatchDeliveryInfo | BatchTransferInfo, current_time: datetime):
-    """Process a single batch delivery or transfer"""
-    # Get branch and product first
-    branch_product = db.query(BranchProduct)\
-        .join(Branch)\
-        .join(Product)\
-        .filter(
-            BranchProduct.branch_id == branch_id,
-            BranchProduct.product_id == product_id
-        ).first()
-    
-    if not branch_product:
-        raise HTTPException(status_code=404, detail="Branch product not found")
-        
-    # Check if product is available for this branch type
-    if (branch_product.branch.branch_type == 'wholesale' and 
-        not branch_product.product.is_wholesale_available):
-        raise HTTPException(
-            status_code=400,
-            detail="This product is not available for wholesale branches"
-        )
-    elif (branch_product.branch.branch_type == 'retail' and 
-          not branch_product.product.is_retail_available):
-        raise HTTPException(
-            status_code=400,
-            detail="This product is not available for retail branches"
-        )
+    if existing_batch:
+        existing_batch.quantity += batch_info.quantity
+        return
 
-    # First save to InvReportBatch
-    new_report_batch = InvReportBatch(
+    new_batch = ProductBatch(
+        branch_id=branch_id,
+        product_id=product_id,
         quantity=batch_info.quantity,
         expiration_date=batch_info.expiration_date,
-        batch_type='delivery' if isinstance(batch_info, BatchDeliveryInfo) else 'transfer',
+        is_active=True,
         created_at=current_time
     )
-    db.add(new_report_batch)
-
-    # Then handle ProductBatch - merge quantities for same expiration date
-    existing_batch = db.query(ProductBatch).filter(
-        ProductBatch.branch_id == branch_id,
-        ProductBatch.product_id == product_id,
-        ProductBatch.expiration_date == batch_info.expiration_date,
-        ProductBatch.is_active == True
-    ).first()
-
-    if existing_batch:
-        existing_batch.quantity += batch_info.quantity
-    else:
-        new_batch = ProductBatch(
-            branch_id=branch_id,
-            product_id=product_id,
-            quantity=batch_info.quantity,
-            expiration_date=batch_info.expiration_date,
-            created_at=current_time
-        )
-        db.add(new_batch)
-
-def update_branch_product_quantity(db: Session, branch_id: int, product_id: int):
-    """Update branch product quantity to match sum of active batches"""
-    # Get branch and product first
-    branch_product = db.query(BranchProduct)\
-        .join(Branch)\
-        .join(Product)\
-        .filter(
-            BranchProduct.branch_id == branch_id,
-            BranchProduct.product_id == product_id
-        ).first()
-    
-    if not branch_product:
-        return
-        
-    # Check if product is available for this branch type
-    if (branch_product.branch.branch_type == 'wholesale' and 
-        not branch_product.product.is_wholesale_available):
-        branch_product.is_available = False
-        branch_product.low_stock_since = None
-        db.commit()
-        return
-    elif (branch_product.branch.branch_type == 'retail' and 
-          not branch_product.product.is_retail_available):
-        branch_product.is_available = False
-        branch_product.low_stock_since = None
-        db.commit()
-        return
+    product_batches.append(new_batch)
+    db.add(new_batch)
 
-    total_quantity = db.query(sa.func.sum(ProductBatch.quantity))\
-        .filter(
-            ProductBatch.branch_id == branch_id,
-            ProductBatch.product_id == product_id,
-            ProductBatch.is_active == True
-        ).scalar() or 0
-    
+def update_branch_product_quantity(branch_product: BranchProduct, product: Product, branch_type: str, total_quantity: int, expiration_date: Optional[date]):
+    """Update branch product stock to match its active batches"""
     old_quantity = branch_product.quantity
     branch_product.quantity = total_quantity
-    
-    # Check for low stock status
-    threshold = (
-        branch_product.product.wholesale_low_stock_threshold 
-        if branch_product.branch.branch_type == 'wholesale'
-        else branch_product.product.retail_low_stock_threshold
-    )
-    
-    # Update low stock status
-    if total_quantity <= threshold and branch_product.is_available:
-        if not branch_product.low_stock_since:
-            branch_product.low_stock_since = datetime.now()
-    elif total_quantity > threshold:
-        branch_product.low_stock_since = None
+    branch_product.current_expiration_date = expiration_date
     
     # If quantity is changing from 0 to a positive number, make the product available
     if old_quantity == 0 and total_quantity > 0:
         branch_product.is_available = True
-    
-    db.commit()
+
+    apply_low_stock(branch_product, product, branch_type, total_quantity)
 
 @router.post('/', response_model=InvReportResponse, status_code=status.HTTP_201_CREATED)
 def create_inventory_report(
@@ -351,22 +245,59 @@ def create_inventory_report(
     
     current_time = datetime.now()
     
+    # Check if product is available for this branch type
+    branch = db.query(Branch).filter(Branch.id == report.branch_id).first()
+    if not branch:
+        raise HTTPException(status_code=404, detail="Branch not found")
+
+    # Load everything the report touches up front, one query per table
+    product_ids = {item.product_id for item in report.items}
+    products = {
+        p.id: p for p in db.query(Product).filter(Product.id.in_(product_ids)).all()
+    }
+    branch_products = {
+        bp.product_id: bp for bp in db.query(BranchProduct).filter(
+            BranchProduct.branch_id == report.branch_id,
+            BranchProduct.product_id.in_(product_ids)
+        ).all()
+    }
+    # Batches are changed in Python below, lock them so concurrent sales and
+    # reports wait for this one instead of being overwritten by it
+    lock_batches(db, sa.and_(
+        ProductBatch.branch_id == report.branch_id,
+        ProductBatch.product_id.in_(product_ids),
+        ProductBatch.is_active == True
+    ))
+    active_batches = {product_id: [] for product_id in product_ids}
+    for batch in (db.query(ProductBatch)
+            .filter(
+                ProductBatch.branch_id == report.branch_id,
+                ProductBatch.product_id.in_(product_ids),
+                ProductBatch.is_active == True
+            )
+            .order_by(ProductBatch.expiration_date, ProductBatch.id)
+            .all()):
+        active_batches[batch.product_id].append(batch)
+
     # Create report
     new_report = InvReport(
         branch_id=report.branch_id,
         created_at=current_time,
         start_date=report.start_date,
-        end_date=report.end_date
+        end_date=report.end_date,
+        items_count=0,
+        products_with_delivery=0,
+        products_with_transfer=0,
+        products_with_pullout=0,
+        products_with_offtake=0,
+        total_offtake_value=0
     )
     db.add(new_report)
-    
-    # Check if product is available for this branch type
-    branch = db.query(Branch).filter(Branch.id == report.branch_id).first()
-    if not branch:
-        raise HTTPException(status_code=404, detail="Branch not found")
 
+    demands = {}
+    offtake_items = []
     for item_data in report.items:
-        product = db.query(Product).get(item_data.product_id)
+        product = products.get(item_data.product_id)
         if not product:
             raise HTTPException(status_code=404, detail=f"Product {item_data.product_id} not found")
             
@@ -380,6 +311,9 @@ def create_inventory_report(
                 status_code=400,
                 detail=f"Product {product.name} is not available for retail branches"
             )
+
+        if (item_data.delivery_batches or item_data.transfer_batches) and item_data.product_id not in branch_products:
+            raise HTTPException(status_code=404, detail="Branch product not found")
         
         # Create report item
         report_item = InvReportItem(
@@ -388,45 +322,37 @@ def create_inventory_report(
             selling_area=item_data.selling_area,
             offtake=0,  # Set to 0 initially, will update after processing batches
             current_cost=product.cost,
-            current_srp=product.srp
+            current_srp=product.srp,
+            batches=[]  # Loaded and empty, so appending offtake batches after the flush never lazy loads
         )
         new_report.items.append(report_item)
+        new_report.items_count += 1
+        product_batches = active_batches[item_data.product_id]
 
         # Step 1: Process all incoming stock first (deliveries and transfers)
-        if item_data.delivery_batches:
-            for batch in item_data.delivery_batches:
-                process_batch(db, report.branch_id, item_data.product_id, batch, current_time)
-                report_batch = InvReportBatch(
+        for batch_type, incoming in (('delivery', item_data.delivery_batches), ('transfer', item_data.transfer_batches)):
+            if not incoming:
+                continue
+            for batch in incoming:
+                process_batch(db, report.branch_id, item_data.product_id, batch, current_time, product_batches)
+                report_item.batches.append(InvReportBatch(
                     quantity=batch.quantity,
                     expiration_date=batch.expiration_date,
-                    batch_type='delivery',
+                    batch_type=batch_type,
                     created_at=current_time
-                )
-                report_item.batches.append(report_batch)
-
-        if item_data.transfer_batches:
-            for batch in item_data.transfer_batches:
-                process_batch(db, report.branch_id, item_data.product_id, batch, current_time)
-                report_batch = InvReportBatch(
-                    quantity=batch.quantity,
-                    expiration_date=batch.expiration_date,
-                    batch_type='transfer',
-                    created_at=current_time
-                )
-                report_item.batches.append(report_batch)
-
-        # Commit the incoming stock changes before processing pull-outs
-        db.flush()
+                ))
+            if batch_type == 'delivery':
+                new_report.products_with_delivery += 1
+            else:
+                new_report.products_with_transfer += 1
 
         # Step 2: Process pull-outs
         if item_data.pull_out_batches:
             for batch in item_data.pull_out_batches:
-                existing_batch = db.query(ProductBatch).filter(
-                    ProductBatch.branch_id == report.branch_id,
-                    ProductBatch.product_id == item_data.product_id,
-                    ProductBatch.expiration_date == batch.expiration_date,
-                    ProductBatch.is_active == True
-                ).first()
+                existing_batch = next(
+                    (b for b in product_batches if b.expiration_date == batch.expiration_date),
+                    None
+                )
                 
                 if not existing_batch:
                     raise HTTPException(
@@ -449,43 +375,45 @@ def create_inventory_report(
                 report_item.batches.append(report_batch)
                 
                 existing_batch.quantity -= batch.quantity
+            new_report.products_with_pullout += 1
 
-        # Step 3: Process offtake using update_batch_quantities
+        # Step 3: Queue offtake, deducted for the whole report at once below
         if item_data.offtake > 0:
-            try:
-                update_batch_quantities(db, report.branch_id, item_data.product_id, item_data.offtake)
-                report_item.offtake = item_data.offtake
-            except HTTPException as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Error processing offtake: {str(e)}"
-                )
+            offtake_items.append((report_item, item_data.offtake))
+            demands[item_data.product_id] = demands.get(item_data.product_id, 0) + item_data.offtake
+            new_report.products_with_offtake += 1
+            new_report.total_offtake_value += item_data.offtake * product.srp
 
-        # Update final quantities after all operations
-        update_branch_product_quantity(db, report.branch_id, item_data.product_id)
-    
-    # Calculate all report metrics before commit
-    new_report.items_count = len(new_report.items)
-    new_report.products_with_delivery = len([
-        item for item in new_report.items 
-        if any(b.batch_type == 'delivery' for b in item.batches)
-    ])
-    new_report.products_with_transfer = len([
-        item for item in new_report.items 
-        if any(b.batch_type == 'transfer' for b in item.batches)
-    ])
-    new_report.products_with_pullout = len([
-        item for item in new_report.items 
-        if any(b.batch_type == 'pull_out' for b in item.batches)
-    ])
-    new_report.products_with_offtake = len([
-        item for item in new_report.items 
-        if item.offtake > 0
-    ])
-    new_report.total_offtake_value = round(sum(
-        item.offtake * item.current_srp 
-        for item in new_report.items
-    ), 2)
+    new_report.total_offtake_value = round(new_report.total_offtake_value, 2)
+
+    # Final stock is known before the offtake is applied
+    final_stock = {
+        product_id: remaining_stock(batches, demands.get(product_id, 0))
+        for product_id, batches in active_batches.items()
+    }
+
+    # Step 3: Deduct all offtake earliest-expiry-first in one statement
+    allocations = allocate_fefo(db, report.branch_id, demands)
+    for report_item, offtake in offtake_items:
+        for allocation in take_allocated(allocations, report_item.product_id, offtake):
+            report_item.batches.append(InvReportBatch(
+                quantity=allocation["quantity"],
+                expiration_date=allocation["expiration_date"],
+                batch_type='offtake',
+                product_batch_id=allocation["batch_id"],
+                created_at=current_time
+            ))
+        report_item.offtake = offtake
+
+    # Update final quantities after all operations
+    for product_id, (total_quantity, expiration_date) in final_stock.items():
+        branch_product = branch_products.get(product_id)
+        if branch_product:
+            update_branch_product_quantity(branch_product, products[product_id], branch.branch_type, total_quantity, expiration_date)
+
+    record_daily_sales(db, new_report)
+    bump_data_version(db, report.branch_id)
+    item_levels = [(item.product_id, item.selling_area, item.offtake) for item in new_report.items]
 
     try:
         db.commit()
@@ -493,34 +421,84 @@ def create_inventory_report(
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
+    # Record inventory metrics once the report is committed, written in the background
+    for product_id, selling_area, offtake in item_levels:
+        metric_writer.record(
+            "inventory_level",
+            selling_area,
+            branch_id=report.branch_id,
+            product_id=product_id,
+            timestamp=current_time
+        )
+        if offtake > 0:
+            metric_writer.record(
+                "product_offtake",
+                offtake,
+                branch_id=report.branch_id,
+                product_id=product_id,
+                timestamp=current_time
+            )
+
     complete_report = (
         db.query(InvReport)
-        .options(joinedload(InvReport.items).joinedload(InvReportItem.batches))
+        .options(
+            joinedload(InvReport.items).joinedload(InvReportItem.batches),
+            joinedload(InvReport.items).joinedload(InvReportItem.product),
+            joinedload(InvReport.branch)
+        )
         .filter(InvReport.id == new_report.id)
         .first()
     )
     
-    # Record inventory metrics
-    for item in complete_report.items:
-        AnalyticsTimeSeries.record_metric(
-            db,
-            "inventory_level",
-            item.selling_area,
-            product_id=item.product_id,
-            branch_id=complete_report.branch_id
-        )
-        
-        if item.offtake > 0:
-            AnalyticsTimeSeries.record_metric(
-                db,
-                "product_offtake",
-                item.offtake,
-                product_id=item.product_id,
-                branch_id=complete_report.branch_id
-            )
-    
     return complete_report
 
+@router.get('/export')
+def export_inventory_reports(
+    db: db_dependency,
+    user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
+    branch_id: Optional[int] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    format: ExportFormat = ExportFormat.CSV
+):
+    """Every line item of the matching reports, streamed as CSV or NDJSON"""
+    # Non-admin users can only export their own branch
+    if user['role'] in [UserRole.PHARMACIST.value, UserRole.WHOLESALER.value]:
+        if branch_id is not None and branch_id != user['branch_id']:
+            raise HTTPException(
+                status_code=403,
+                detail="You can only view reports for your assigned branch"
+            )
+        branch_id = user['branch_id']
+
+    query = (
+        sa.select(
+            InvReport.id.label('report_id'),
+            InvReport.created_at,
+            Branch.id.label('branch_id'),
+            Branch.branch_name,
+            Product.id.label('product_id'),
+            Product.name.label('product_name'),
+            InvReportItem.beginning,
+            InvReportItem.selling_area,
+            InvReportItem.offtake,
+            InvReportItem.current_cost,
+            InvReportItem.current_srp
+        )
+        .join(InvReport, InvReport.id == InvReportItem.invreport_id)
+        .join(Branch, Branch.id == InvReport.branch_id)
+        .join(Product, Product.id == InvReportItem.product_id)
+        .order_by(InvReport.created_at, InvReport.id, InvReportItem.id)
+    )
+    if branch_id is not None:
+        query = query.where(InvReport.branch_id == branch_id)
+    if start_date:
+        query = query.where(InvReport.created_at >= start_date)
+    if end_date:
+        query = query.where(InvReport.created_at < end_date + timedelta(days=1))
+
+    return export_response(query, "inventory-reports", format)
+
 @router.get('/{report_id}', response_model=InvReportResponse)
 def get_inventory_report(
     report_id: int,
@@ -632,12 +610,45 @@ class BranchExpiringBatchesResponse(BaseModel):
     expired: List[ExpiringBatchItem]
     critical: List[ExpiringBatchItem]
     warning: List[ExpiringBatchItem]
+    counts: Dict[str, int] = {}  # groups per status before skip/limit
+
+def expiry_thresholds(
+    expired_days: int = EXPIRY_EXPIRED_DAYS,
+    critical_days: int = EXPIRY_CRITICAL_DAYS,
+    warning_days: int = EXPIRY_WARNING_DAYS
+) -> dict:
+    """Days-until-expiry thresholds of the expired, critical and warning statuses"""
+    if not expired_days <= critical_days <= warning_days:
+        raise HTTPException(
+            status_code=400,
+            detail="Expiry thresholds must satisfy expired_days <= critical_days <= warning_days"
+        )
+    return {"expired_days": expired_days, "critical_days": critical_days, "warning_days": warning_days}
+
+def batch_groups(thresholds: dict, *criteria):
+    """Active batches matching `criteria` summed per product and expiration date, with their expiry status"""
+    today = date.today()
+    return (
+        sa.select(
+            ProductBatch.product_id,
+            ProductBatch.expiration_date,
+            sa.func.sum(ProductBatch.quantity).label('quantity'),
+            (ProductBatch.expiration_date - today).label('days_until_expiry'),
+            expiry_bucket(ProductBatch.expiration_date, today, **thresholds).label('status')
+        )
+        .where(ProductBatch.is_active == True, *criteria)
+        .group_by(ProductBatch.product_id, ProductBatch.expiration_date)
+        .subquery('batch_groups')
+    )
 
 @router.get('/expiring-batches/{branch_id}', response_model=BranchExpiringBatchesResponse)
 def get_branch_expiring_batches(
     branch_id: int,
     db: db_dependency,
-    user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))]
+    user: Annotated[dict, Depends(role_required([UserRole.ADMIN, UserRole.PHARMACIST, UserRole.WHOLESALER]))],
+    thresholds: Annotated[dict, Depends(expiry_thresholds)],
+    skip: int = 0,
+    limit: Optional[int] = None  # per status, all batches when not given
 ):
     # Check if user is assigned to this branch (only for non-admin users)
     if user['role'] != UserRole.ADMIN.value and user['branch_id'] != branch_id:
@@ -647,43 +658,46 @@ def get_branch_expiring_batches(
         )
     
     """Get all batch suggestions for a branch, grouped by expiry status"""
-    batches = (db.query(ProductBatch)
-        .filter(
-            ProductBatch.branch_id == branch_id,
-            ProductBatch.is_active == True
-        )
-        .order_by(ProductBatch.expiration_date)
-        .all())
-
-    # Group batches by product_id and expiration_date only
-    batch_groups = {}
-    for batch in batches:
-        key = (batch.product_id, batch.expiration_date)
-        if key not in batch_groups:
-            batch_groups[key] = {
-                "product_id": batch.product_id,
-                "quantity": batch.quantity,
-                "expiration_date": batch.expiration_date.isoformat(),
-                "days_until_expiry": batch.days_until_expiry,
-                "status": batch.expiry_status
-            }
-        else:
-            batch_groups[key]["quantity"] += batch.quantity
-
-    combined_batches = list(batch_groups.values())
-
-    return {
-        "expired": [b for b in combined_batches if b["status"] == "expired"],
-        "critical": [b for b in combined_batches if b["status"] == "critical"],
-        "warning": [b for b in combined_batches if b["status"] == "warning"]
-    }
+    # Only batches up to the warning threshold can be listed
+    groups = batch_groups(
+        thresholds,
+        ProductBatch.branch_id == branch_id,
+        ProductBatch.expiration_date <= date.today() + timedelta(days=thresholds["warning_days"])
+    )
+    position = sa.func.row_number().over(
+        partition_by=groups.c.status,
+        order_by=(groups.c.expiration_date, groups.c.product_id)
+    )
+    ranked = sa.select(
+        groups,
+        position.label('position'),
+        sa.func.count().over(partition_by=groups.c.status).label('status_count')
+    ).subquery('ranked')
+
+    query = sa.select(ranked).where(ranked.c.position > skip).order_by(ranked.c.status, ranked.c.position)
+    if limit is not None:
+        query = query.where(ranked.c.position <= skip + limit)
+
+    result = {"expired": [], "critical": [], "warning": [], "counts": {"expired": 0, "critical": 0, "warning": 0}}
+    for row in db.execute(query):
+        result[row.status].append({
+            "product_id": row.product_id,
+            "quantity": row.quantity,
+            "expiration_date": row.expiration_date.isoformat(),
+            "days_until_expiry": row.days_until_expiry
+        })
+        result["counts"][row.status] = row.status_count
+    return result
 
 @router.get('/product-batches/{branch_id}/{product_id}', response_model=ProductBatchesResponse)
 def get_product_batches(
     branch_id: int,
     product_id: int,
     db: db_dependency,
-    user: Annotated[dict, Depends(role_required([UserRole.PHARMACIST, UserRole.WHOLESALER]))]
+    user: Annotated[dict, Depends(role_required([UserRole.PHARMACIST, UserRole.WHOLESALER]))],
+    thresholds: Annotated[dict, Depends(expiry_thresholds)],
+    skip: int = 0,
+    limit: Optional[int] = None
 ):
     # Check if user is assigned to this branch
     if user['branch_id'] != branch_id:
@@ -713,31 +727,35 @@ def get_product_batches(
             detail="This product is not available for retail branches"
         )
 
-    batches = (db.query(ProductBatch)
-        .filter(
-            ProductBatch.branch_id == branch_id,
-            ProductBatch.product_id == product_id,
-            ProductBatch.is_active == True
+    groups = batch_groups(
+        thresholds,
+        ProductBatch.branch_id == branch_id,
+        ProductBatch.product_id == product_id
+    )
+    # Totals are over every group, the batches list alone is paginated
+    position = sa.func.row_number().over(order_by=groups.c.expiration_date)
+    ranked = sa.select(
+        groups,
+        position.label('position'),
+        sa.func.sum(groups.c.quantity).over().label('total_quantity'),
+        *(
+            sa.func.count().filter(groups.c.status == status).over().label(status)
+            for status in ("expired", "critical", "warning")
         )
-        .order_by(ProductBatch.expiration_date)
-        .all())
-
-    # Group batches by expiration date only
-    batch_groups = {}
-    for batch in batches:
-        key = batch.expiration_date
-        if key not in batch_groups:
-            batch_groups[key] = {
-                "quantity": batch.quantity,
-                "expiration_date": batch.expiration_date.isoformat(),
-                "days_until_expiry": batch.days_until_expiry,
-                "status": batch.expiry_status,
-            }
-        else:
-            batch_groups[key]["quantity"] += batch.quantity
+    ).subquery('ranked')
 
-    combined_batches = list(batch_groups.values())
-    combined_batches.sort(key=lambda x: x["expiration_date"])
+    query = sa.select(ranked).where(ranked.c.position > skip).order_by(ranked.c.position)
+    if limit is not None:
+        query = query.where(ranked.c.position <= skip + limit)
+    rows = db.execute(query).all()
+
+    # Past the last page the totals still have to be read
+    if not rows and skip:
+        totals = db.execute(
+            sa.select(ranked.c.total_quantity, ranked.c.expired, ranked.c.critical, ranked.c.warning).limit(1)
+        ).first()
+    else:
+        totals = rows[0] if rows else None
 
     return {
         "product_id": product_id,
@@ -745,11 +763,19 @@ def get_product_batches(
         "branch_id": branch.id,
         "branch_name": branch.branch_name,
         "branch_type": branch.branch_type,
-        "total_quantity": sum(b["quantity"] for b in combined_batches),
-        "expired": sum(1 for b in combined_batches if b["status"] == "expired"),
-        "critical": sum(1 for b in combined_batches if b["status"] == "critical"),
-        "warning": sum(1 for b in combined_batches if b["status"] == "warning"),
-        "batches": combined_batches
+        "total_quantity": totals.total_quantity if totals else 0,
+        "expired": totals.expired if totals else 0,
+        "critical": totals.critical if totals else 0,
+        "warning": totals.warning if totals else 0,
+        "batches": [
+            {
+                "quantity": row.quantity,
+                "expiration_date": row.expiration_date.isoformat(),
+                "days_until_expiry": row.days_until_expiry,
+                "status": row.status
+            }
+            for row in rows
+        ]
     }
 
 @router.post('/{report_id}/mark-viewed', response_model=dict)
@@ -7,6 +7,8 @@ from uuid import uuid4
 
 from api.models import Product, UserRole, Branch, BranchProduct, PriceHistory
 from api.deps import db_dependency, user_dependency, role_required
+from api.inventory import refresh_low_stock
+from api.cache import bump_data_version
 
 router = APIRouter(
     prefix='/products',
@@ -94,6 +96,7 @@ def add_product(
         db.add(branch_product)
     
     try:
+        bump_data_version(db)
         db.commit()
         db.refresh(db_product)
         return db_product
@@ -140,9 +143,15 @@ def update_product(
         )
         db.add(price_history)
     
-    for key, value in product.model_dump(exclude_unset=True).items():
+    updates = product.model_dump(exclude_unset=True)
+    for key, value in updates.items():
         setattr(db_product, key, value)
+
+    # Thresholds decide low stock state for every branch carrying the product
+    if updates.keys() & {'retail_low_stock_threshold', 'wholesale_low_stock_threshold'}:
+        refresh_low_stock(db, product_id=product_id)
     
+    bump_data_version(db)
     db.commit()
     db.refresh(db_product)
     return db_product
@@ -187,6 +196,7 @@ def delete_product(
     db.delete(db_product)
     
     try:
+        bump_data_version(db)
         db.commit()
         return {"detail": "Product deleted successfully"}
     except Exception as e:
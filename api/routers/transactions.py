@@ -1,17 +1,38 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session, joinedload
-from typing import List, Optional, Annotated
+from sqlalchemy import func
+import sqlalchemy as sa
+from typing import Dict, List, Literal, Optional, Annotated
 from pydantic import BaseModel, Field, computed_field
 from datetime import datetime, date, timedelta
+from collections import defaultdict
 
-from api.models import Transaction, TransactionItem, Client, BranchProduct, ProductBatch, UserRole, Payment
+from api.models import (
+    Transaction,
+    TransactionItem,
+    TransactionItemBatch,
+    Client,
+    BranchProduct,
+    Product,
+    ProductBatch,
+    UserRole,
+    Payment,
+    Branch
+)
 from api.deps import db_dependency, role_required
+from api.cache import bump_data_version
+from api.inventory import allocate_fefo, return_to_batches, sync_branch_stock, take_allocated
 
 router = APIRouter(
     prefix='/transactions',
     tags=['transactions']
 )
 
+# Balances are read-modify-write, so writers lock the rows they change with
+# SELECT ... FOR UPDATE, always in the order transaction, payment, client,
+# product batches (see api.inventory.lock_batches): concurrent requests then
+# queue instead of losing updates, and cannot deadlock on each other.
+
 # Schemas
 class TransactionItemBase(BaseModel):
     product_id: int
@@ -70,9 +91,21 @@ class PaymentCreate(BaseModel):
 class TransactionFilter(BaseModel):
     start_date: Optional[date] = None
     end_date: Optional[date] = None
-    payment_status: Optional[str] = None
+    payment_status: Optional[Literal['pending', 'partial', 'paid']] = None
     is_overdue: Optional[bool] = None
 
+class AgingRow(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str] = None
+    transactions: int
+    total: float
+    buckets: Dict[str, float]
+
+class AgingResponse(AgingRow):
+    as_of: date
+    by_branch: List[AgingRow]
+    by_client: List[AgingRow]
+
 class VoidTransaction(BaseModel):
     reason: str = Field(..., min_length=1, max_length=500)
 
@@ -91,6 +124,30 @@ class PaymentResponse(BaseModel):
         "from_attributes": True
     }
 
+AGING_BUCKETS = [(0, 'current'), (30, '0-30'), (60, '31-60'), (90, '61-90')]  # up to n days past due
+AGING_LABELS = [label for _, label in AGING_BUCKETS] + ['90+']
+
+def aging_bucket(due_date, today: Optional[date] = None):
+    """current while not yet due, then 0-30, 31-60, 61-90 or 90+ days past due"""
+    days = sa.literal(today or date.today(), sa.Date) - due_date
+    return sa.case(
+        *((days <= limit, label) for limit, label in AGING_BUCKETS),
+        else_='90+'
+    )
+
+def filter_transactions(query, filters: TransactionFilter, today: Optional[date] = None):
+    """Apply a TransactionFilter in SQL, is_overdue as in TransactionResponse"""
+    if filters.start_date:
+        query = query.filter(Transaction.transaction_date >= filters.start_date)
+    if filters.end_date:
+        query = query.filter(Transaction.transaction_date < filters.end_date + timedelta(days=1))
+    if filters.payment_status:
+        query = query.filter(Transaction.payment_status == filters.payment_status)
+    if filters.is_overdue is not None:
+        overdue = sa.and_(Transaction.due_date < (today or date.today()), Transaction.payment_status != 'paid')
+        query = query.filter(overdue if filters.is_overdue else ~overdue)
+    return query
+
 # Endpoints
 @router.post('/', response_model=TransactionResponse)
 def create_transaction(
@@ -99,7 +156,7 @@ def create_transaction(
     user: Annotated[dict, Depends(role_required([UserRole.WHOLESALER, UserRole.ADMIN]))]
 ):
     # Get client and verify
-    client = db.query(Client).filter(Client.id == transaction.client_id).first()
+    client = db.query(Client).filter(Client.id == transaction.client_id).with_for_update().first()
     if not client:
         raise HTTPException(status_code=404, detail="Client not found")
     
@@ -107,14 +164,25 @@ def create_transaction(
     terms = transaction.transaction_terms or client.payment_terms
     markup = transaction.transaction_markup or client.markup_percentage
     
-    # Generate reference number
-    reference_number = Transaction.generate_reference(db, user['branch_id'])
+    # Products of every line available in the branch, in one query
+    product_ids = {item.product_id for item in transaction.items}
+    products = {
+        product.id: product
+        for product in (
+            db.query(Product)
+            .join(BranchProduct, BranchProduct.product_id == Product.id)
+            .filter(
+                BranchProduct.branch_id == user['branch_id'],
+                BranchProduct.product_id.in_(product_ids),
+                BranchProduct.is_available == True
+            )
+        )
+    }
     
     # Create transaction
     new_transaction = Transaction(
         client_id=client.id,
         branch_id=user['branch_id'],
-        reference_number=reference_number,
         transaction_terms=terms,
         transaction_markup=markup,
         payment_status='pending',
@@ -126,13 +194,7 @@ def create_transaction(
     # Process items
     for item in transaction.items:
         # Only verify if product is available for this branch type
-        branch_product = db.query(BranchProduct).filter(
-            BranchProduct.branch_id == user['branch_id'],
-            BranchProduct.product_id == item.product_id,
-            BranchProduct.is_available == True
-        ).first()
-        
-        if not branch_product:
+        if item.product_id not in products:
             raise HTTPException(
                 status_code=400,
                 detail=f"Product {item.product_id} is not available for this branch"
@@ -142,7 +204,7 @@ def create_transaction(
         transaction_item = TransactionItem(
             product_id=item.product_id,
             quantity=item.quantity,
-            base_price=branch_product.product.cost
+            base_price=products[item.product_id].cost
         )
         transaction_item.calculate_prices(markup)
         
@@ -168,6 +230,21 @@ def create_transaction(
         payment_status = 'pending'
         amount_paid = 0.0
     
+    # Take the stock earliest-expiry-first, a 400 here leaves nothing to commit
+    demands = defaultdict(int)
+    for transaction_item in new_transaction.items:
+        demands[transaction_item.product_id] += transaction_item.quantity
+    allocations = allocate_fefo(db, user['branch_id'], demands)
+    for transaction_item in new_transaction.items:
+        for allocation in take_allocated(allocations, transaction_item.product_id, transaction_item.quantity):
+            transaction_item.batches.append(TransactionItemBatch(
+                product_batch_id=allocation["batch_id"],
+                quantity=allocation["quantity"]
+            ))
+    sync_branch_stock(db, branch_id=user['branch_id'], product_ids=demands)
+    
+    # Generate reference number, once the order is known to be valid
+    new_transaction.reference_number = Transaction.generate_reference(db, user['branch_id'])
     new_transaction.total_amount = round(total_amount, 2)
     new_transaction.amount_paid = amount_paid
     new_transaction.payment_status = payment_status
@@ -175,22 +252,20 @@ def create_transaction(
     # Update client balance with remaining amount
     client.current_balance = round(client.current_balance + remaining_balance, 2)
     
-    # First commit the transaction to get the ID
-    db.add(new_transaction)
-    db.commit()
-    db.refresh(new_transaction)
-    
-    # Create payment record if there's an initial payment
+    # Create payment record if there's an initial payment, its transaction_id
+    # is filled in by the same flush that inserts the transaction
     if amount_paid > 0:
-        initial_payment = Payment(
-            transaction_id=new_transaction.id,  # Now we have the transaction ID
+        new_transaction.payments.append(Payment(
             client_id=client.id,
             amount=amount_paid,
             payment_date=date.today(),
             recorded_by_id=user['id']
-        )
-        db.add(initial_payment)
-        db.commit()
+        ))
+    
+    # Transaction, items, payment, stock and client balance go out in one flush and commit
+    db.add(new_transaction)
+    bump_data_version(db, new_transaction.branch_id)
+    db.commit()
     
     return new_transaction
 
@@ -198,6 +273,7 @@ def create_transaction(
 def get_transactions(
     db: db_dependency,
     user: Annotated[dict, Depends(role_required([UserRole.WHOLESALER, UserRole.ADMIN]))],
+    filters: Annotated[TransactionFilter, Depends()],
     skip: int = 0,
     limit: int = 100,
     client_id: Optional[int] = None,
@@ -218,9 +294,90 @@ def get_transactions(
     
     if client_id:
         query = query.filter(Transaction.client_id == client_id)
+
+    query = filter_transactions(query, filters)
     
     return query.order_by(Transaction.transaction_date.desc()).offset(skip).limit(limit).all()
 
+@router.get('/aging', response_model=AgingResponse)
+def get_receivables_aging(
+    db: db_dependency,
+    user: Annotated[dict, Depends(role_required([UserRole.WHOLESALER, UserRole.ADMIN]))],
+    filters: Annotated[TransactionFilter, Depends()],
+    branch_id: Optional[int] = None,
+    client_id: Optional[int] = None
+):
+    """Outstanding balances by days past due, in total, per branch and per client.
+
+    One grouped query over the open (unpaid, non-void) transactions, which
+    ix_transactions_unpaid_branch_id_due_date covers.
+    """
+    today = date.today()
+    if user['role'] == UserRole.WHOLESALER.value:
+        branch_id = user['branch_id']
+
+    bucket = aging_bucket(Transaction.due_date, today)
+    outstanding = Transaction.total_amount - Transaction.amount_paid
+    query = (
+        db.query(
+            func.grouping(Transaction.branch_id).label('all_branches'),
+            func.grouping(Transaction.client_id).label('all_clients'),
+            Transaction.branch_id,
+            Branch.branch_name.label('branch_name'),
+            Transaction.client_id,
+            Client.name.label('client_name'),
+            func.count().label('transactions'),
+            func.sum(outstanding).label('total'),
+            *(
+                func.coalesce(func.sum(outstanding).filter(bucket == label), 0).label(label)
+                for label in AGING_LABELS
+            )
+        )
+        .select_from(Transaction)
+        .join(Branch, Branch.id == Transaction.branch_id)
+        .join(Client, Client.id == Transaction.client_id)
+        .filter(
+            Transaction.payment_status != 'paid',
+            Transaction.is_void == False
+        )
+    )
+    if branch_id:
+        query = query.filter(Transaction.branch_id == branch_id)
+    if client_id:
+        query = query.filter(Transaction.client_id == client_id)
+    query = filter_transactions(query, filters, today).group_by(
+        func.grouping_sets(
+            sa.tuple_(Transaction.branch_id, Branch.branch_name),
+            sa.tuple_(Transaction.client_id, Client.name),
+            sa.text('()')
+        )
+    )
+
+    report = {
+        'as_of': today,
+        'transactions': 0,
+        'total': 0.0,
+        'buckets': {label: 0.0 for label in AGING_LABELS},
+        'by_branch': [],
+        'by_client': []
+    }
+    for row in query.all():
+        values = {
+            'transactions': row.transactions,
+            'total': round(row.total, 2),
+            'buckets': {label: round(row._mapping[label], 2) for label in AGING_LABELS}
+        }
+        if not row.all_branches:
+            report['by_branch'].append({'id': row.branch_id, 'name': row.branch_name, **values})
+        elif not row.all_clients:
+            report['by_client'].append({'id': row.client_id, 'name': row.client_name, **values})
+        else:
+            report.update(values)
+
+    report['by_branch'].sort(key=lambda row: row['total'], reverse=True)
+    report['by_client'].sort(key=lambda row: row['total'], reverse=True)
+    return report
+
 @router.get('/{transaction_id}', response_model=TransactionResponse)
 def get_transaction(
     transaction_id: int,
@@ -251,13 +408,12 @@ def void_transaction(
     db: db_dependency,
     user: Annotated[dict, Depends(role_required([UserRole.WHOLESALER, UserRole.ADMIN]))]
 ):
+    # Locked on its own: items and payments are read afterwards, so they
+    # include anything a concurrent request committed while we waited
     transaction = (
         db.query(Transaction)
-        .options(
-            joinedload(Transaction.items),
-            joinedload(Transaction.payments)
-        )
         .filter(Transaction.id == transaction_id)
+        .with_for_update()
         .first()
     )
     if not transaction:
@@ -274,13 +430,16 @@ def void_transaction(
             detail="You can only void transactions from your branch"
         )
     
+    payments = db.query(Payment).filter(Payment.transaction_id == transaction.id).with_for_update().all()
+    client = db.query(Client).filter(Client.id == transaction.client_id).with_for_update().one()
+    
     # Void all payments first
-    for payment in transaction.payments:
+    for payment in payments:
         if not payment.is_void:
             payment.is_void = True
             payment.void_reason = f"Transaction voided: {void_data.reason}"
             # Update client balance for each payment
-            transaction.client.current_balance += payment.amount
+            client.current_balance += payment.amount
             # Update transaction amount_paid
             transaction.amount_paid -= payment.amount
     
@@ -289,10 +448,26 @@ def void_transaction(
     
     # Update client balance - only unpaid amount if any remains
     if round(transaction.balance, 2) > 0:
-        transaction.client.current_balance -= round(transaction.balance, 2)
+        client.current_balance -= round(transaction.balance, 2)
+    
+    # Give the stock back to the batches it was taken from
+    returns = dict(
+        db.query(TransactionItemBatch.product_batch_id, func.sum(TransactionItemBatch.quantity))
+        .join(TransactionItem, TransactionItem.id == TransactionItemBatch.transaction_item_id)
+        .filter(TransactionItem.transaction_id == transaction.id)
+        .group_by(TransactionItemBatch.product_batch_id)
+        .all()
+    )
+    return_to_batches(db, returns)
+    sync_branch_stock(
+        db,
+        branch_id=transaction.branch_id,
+        product_ids={item.product_id for item in transaction.items}
+    )
     
     transaction.void_reason = void_data.reason
     transaction.is_void = True
+    bump_data_version(db, transaction.branch_id)
     db.commit()
     
     return {"detail": "Transaction voided successfully"}
@@ -304,7 +479,7 @@ def add_payment(
     db: db_dependency,
     user: Annotated[dict, Depends(role_required([UserRole.WHOLESALER, UserRole.ADMIN]))]
 ):
-    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
+    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).with_for_update().first()
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
     
@@ -347,8 +522,10 @@ def add_payment(
         transaction.payment_status = 'partial'
     
     # Update client balance
-    transaction.client.current_balance -= payment.amount
+    client = db.query(Client).filter(Client.id == transaction.client_id).with_for_update().one()
+    client.current_balance -= payment.amount
     
+    bump_data_version(db, transaction.branch_id)
     db.commit()
     db.refresh(new_payment)
     
@@ -362,15 +539,17 @@ def void_payment(
     db: db_dependency,
     user: Annotated[dict, Depends(role_required([UserRole.WHOLESALER, UserRole.ADMIN]))]
 ):
+    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).with_for_update().first()
     payment = db.query(Payment).filter(
         Payment.id == payment_id,
         Payment.transaction_id == transaction_id
-    ).first()
+    ).with_for_update().first()
     
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
     
-    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
+    if payment.is_void:
+        raise HTTPException(status_code=400, detail="Payment is already void")
     
     # Check branch access
     if (user['role'] == UserRole.WHOLESALER.value and 
@@ -390,12 +569,14 @@ def void_payment(
         transaction.payment_status = 'partial'
     
     # Update client balance
-    transaction.client.current_balance += payment.amount
+    client = db.query(Client).filter(Client.id == transaction.client_id).with_for_update().one()
+    client.current_balance += payment.amount
     
     # Soft delete the payment
     payment.is_void = True
     payment.void_reason = void_data.reason
     
+    bump_data_version(db, transaction.branch_id)
     db.commit()
     
     return {"detail": "Payment voided successfully"}
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Optional
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal
+from .models import AnalyticsRollup, AnalyticsTimeSeries, DailySales, ExpenseAllocation
+from .timeseries import _COMPACTION_LOCK_ID
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_METRICS = ["revenue", "expenses", "profit", "branch_revenue", "branch_expenses", "product_revenue"]
+SNAPSHOT_INTERVAL = 15 * 60  # seconds between runs of the background loop
+TOP_PRODUCTS = 10
+
+# Arbitrary key so concurrent workers never snapshot the same day twice
+_SNAPSHOT_LOCK_ID = 7301
+
+
+def snapshot_metrics(db: Session, day: date) -> int:
+    """Record the dashboard metrics of one day in analytics_timeseries.
+
+    Idempotent per (metric, branch, product, day): the day's snapshot rows are
+    replaced, so running it again for the same day, e.g. to refresh today,
+    never duplicates anything. That includes the hour and day rollups
+    compaction already made of them; a day compacted into its month can no
+    longer be separated from the rest of the month and raises ValueError.
+    Returns the number of rows written.
+    """
+    db.execute(sa.select(sa.func.pg_advisory_xact_lock(_SNAPSHOT_LOCK_ID)))
+    # Compaction must not move the day's points into rollups between the deletes and the insert
+    db.execute(sa.select(sa.func.pg_advisory_xact_lock(_COMPACTION_LOCK_ID)))
+
+    timestamp = datetime.combine(day, time.min)
+    snapshot_rollups = AnalyticsRollup.metric_name.in_(SNAPSHOT_METRICS)
+    month = timestamp.replace(day=1)
+    compacted = db.execute(
+        sa.select(sa.exists().where(
+            snapshot_rollups,
+            AnalyticsRollup.resolution == "month",
+            AnalyticsRollup.bucket == month
+        ))
+    ).scalar()
+    if compacted:
+        raise ValueError(f"{day} is already compacted into the {month:%Y-%m} rollup, it cannot be snapshotted again")
+
+    db.execute(
+        sa.delete(AnalyticsTimeSeries)
+        .where(
+            AnalyticsTimeSeries.metric_name.in_(SNAPSHOT_METRICS),
+            AnalyticsTimeSeries.timestamp == timestamp
+        )
+    )
+    # Snapshots sit at midnight, so their hour and day buckets both start there
+    db.execute(
+        sa.delete(AnalyticsRollup)
+        .where(
+            snapshot_rollups,
+            AnalyticsRollup.resolution.in_(["hour", "day"]),
+            AnalyticsRollup.bucket == timestamp
+        )
+    )
+
+    sales = db.query(
+        DailySales.branch_id,
+        sa.func.sum(DailySales.revenue).label('revenue'),
+        sa.func.sum(DailySales.revenue - DailySales.cost).label('profit')
+    ).filter(DailySales.day == day).group_by(DailySales.branch_id).all()
+
+    expenses = db.query(
+        ExpenseAllocation.branch_id,
+        sa.func.sum(ExpenseAllocation.amount).label('amount')
+    ).filter(ExpenseAllocation.day == day).group_by(ExpenseAllocation.branch_id).all()
+
+    top_products = db.query(
+        DailySales.product_id,
+        sa.func.sum(DailySales.revenue).label('revenue')
+    ).filter(DailySales.day == day).group_by(DailySales.product_id).order_by(
+        sa.func.sum(DailySales.revenue).desc()
+    ).limit(TOP_PRODUCTS).all()
+
+    total_revenue = sum(s.revenue for s in sales)
+    total_expenses = sum(e.amount for e in expenses)
+    gross_profit = sum(s.profit for s in sales)
+
+    rows = [
+        ("revenue", total_revenue, None, None),
+        ("expenses", total_expenses, None, None),
+        ("profit", gross_profit - total_expenses, None, None)
+    ]
+    rows += [("branch_revenue", s.revenue, s.branch_id, None) for s in sales]
+    rows += [("branch_expenses", e.amount, e.branch_id, None) for e in expenses if e.branch_id]
+    rows += [("product_revenue", p.revenue, None, p.product_id) for p in top_products]
+
+    db.execute(sa.insert(AnalyticsTimeSeries), [
+        {
+            "metric_name": metric_name,
+            "value": value,
+            "timestamp": timestamp,
+            "branch_id": branch_id,
+            "product_id": product_id
+        }
+        for metric_name, value, branch_id, product_id in rows
+    ])
+    return len(rows)
+
+
+def run_snapshot(day: Optional[date] = None):
+    """Snapshot one day, or yesterday and today, each in its own transaction"""
+    days = [day] if day else [date.today() - timedelta(days=1), date.today()]
+    db = SessionLocal()
+    try:
+        for snapshot_day in days:
+            snapshot_metrics(db, snapshot_day)
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def snapshot_loop(interval: int = SNAPSHOT_INTERVAL):
+    """Background task started with the app, keeps yesterday final and today current"""
+    while True:
+        try:
+            await asyncio.to_thread(run_snapshot)
+        except Exception:
+            logger.exception("Analytics snapshot failed")
+        await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    # python -m api.snapshots [day], for cron or backfilling a single day
+    import sys
+
+    try:
+        run_snapshot(date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None)
+    except ValueError as e:
+        sys.exit(str(e))
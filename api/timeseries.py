@@ -0,0 +1,390 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal
+from .models import AnalyticsRollup, AnalyticsTimeSeries
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = ["hour", "day", "month"]
+AGGREGATES = ["sum", "avg", "min", "max", "count"]
+FILLS = [None, "zero", "previous"]
+
+# Age after which each tier is compacted into the next coarser one:
+# raw points into hours, hours into days, days into months
+RETENTION = {
+    "raw": timedelta(days=7),
+    "hour": timedelta(days=90),
+    "day": timedelta(days=730)
+}
+
+MAX_POINTS = 500  # query_timeseries picks the finest resolution returning at most this many buckets
+PARTITION_MONTHS_AHEAD = 2
+PARTITION_LOCK_TIMEOUT = "5s"
+COMPACTION_INTERVAL = 60 * 60  # seconds between runs of the background loop
+
+# Arbitrary key so concurrent workers never compact the same window twice
+_COMPACTION_LOCK_ID = 7302
+
+_PARTITION_NAME = re.compile(r'^analytics_timeseries_(\d{4})_(\d{2})$')
+
+
+def _truncate(timestamp: datetime, resolution: str) -> datetime:
+    """Start of the hour, day or month containing `timestamp`"""
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    if resolution in ("day", "month"):
+        timestamp = timestamp.replace(hour=0)
+    if resolution == "month":
+        timestamp = timestamp.replace(day=1)
+    return timestamp
+
+
+def _next(bucket: datetime, resolution: str) -> datetime:
+    """Start of the hour, day or month following `bucket`"""
+    if resolution == "hour":
+        return bucket + timedelta(hours=1)
+    if resolution == "day":
+        return bucket + timedelta(days=1)
+    return (bucket.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def _partition_ddl(db: Session, statement: str) -> bool:
+    """Run CREATE/DROP of a partition, giving up after PARTITION_LOCK_TIMEOUT.
+
+    Both need a lock on analytics_timeseries that would queue every reader
+    behind them, so a busy table is left for the next run instead.
+    """
+    try:
+        with db.begin_nested():
+            db.execute(sa.text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+            db.execute(sa.text(statement))
+    except sa.exc.OperationalError:
+        logger.warning("analytics_timeseries is busy, skipped: %s", statement)
+        return False
+    return True
+
+
+def ensure_partitions(db: Session, start: Optional[datetime] = None, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Create the monthly partitions of analytics_timeseries from `start` (this month by default) onwards.
+
+    A default partition catches points outside every monthly partition, e.g.
+    a snapshot backfilled for a month already dropped, so inserts never fail.
+    """
+    _partition_ddl(
+        db,
+        "CREATE TABLE IF NOT EXISTS analytics_timeseries_default "
+        "PARTITION OF analytics_timeseries DEFAULT"
+    )
+
+    month = _truncate(start or datetime.now(), "month")
+    last = _truncate(datetime.now(), "month")
+    for _ in range(months_ahead):
+        last = _next(last, "month")
+
+    while month <= last:
+        following = _next(month, "month")
+        stray = db.execute(sa.text(
+            "SELECT EXISTS (SELECT 1 FROM analytics_timeseries_default "
+            "WHERE timestamp >= :start AND timestamp < :end)"
+        ), {"start": month, "end": following}).scalar()
+        if stray:
+            # Postgres refuses a partition whose rows already sit in the default one
+            logger.warning("Points for %s are in the default partition, not partitioning it", f"{month:%Y-%m}")
+            month = following
+            continue
+        _partition_ddl(
+            db,
+            f"CREATE TABLE IF NOT EXISTS analytics_timeseries_{month:%Y_%m} "
+            f"PARTITION OF analytics_timeseries "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        )
+        month = following
+
+
+def drop_empty_partitions(db: Session, before: datetime) -> List[str]:
+    """Drop the monthly partitions ending before `before` that compaction has emptied"""
+    names = db.execute(sa.text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "WHERE parent.relname = 'analytics_timeseries'"
+    )).scalars().all()
+
+    dropped = []
+    for name in sorted(names):
+        match = _PARTITION_NAME.match(name)
+        if not match:
+            continue
+        month = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if _next(month, "month") > before:
+            continue
+        if db.execute(sa.text(f"SELECT EXISTS (SELECT 1 FROM {name})")).scalar():
+            continue
+        if _partition_ddl(db, f"DROP TABLE {name}"):
+            dropped.append(name)
+    return dropped
+
+
+def _compact_tier(db: Session, source: Optional[str], resolution: str, cutoff: datetime, window: str) -> int:
+    """Aggregate `source` rows (raw points when None) older than `cutoff` into `resolution` buckets.
+
+    Works through one `window` (day or month) per transaction, so the raw
+    rows are deleted in bounded batches. Returns the number of source rows
+    compacted.
+    """
+    unit = sa.literal_column(f"'{resolution}'")
+    if source is None:
+        table = AnalyticsTimeSeries
+        timestamp = AnalyticsTimeSeries.timestamp
+        scope = sa.true()
+        aggregates = [
+            sa.func.count(),
+            sa.func.sum(AnalyticsTimeSeries.value),
+            sa.func.min(AnalyticsTimeSeries.value),
+            sa.func.max(AnalyticsTimeSeries.value)
+        ]
+    else:
+        table = AnalyticsRollup
+        timestamp = AnalyticsRollup.bucket
+        scope = AnalyticsRollup.resolution == source
+        aggregates = [
+            sa.func.sum(AnalyticsRollup.value_count),
+            sa.func.sum(AnalyticsRollup.value_sum),
+            sa.func.min(AnalyticsRollup.value_min),
+            sa.func.max(AnalyticsRollup.value_max)
+        ]
+
+    bucket = sa.func.date_trunc(unit, timestamp)
+    keys = [table.metric_name, table.branch_id, table.product_id]
+
+    compacted = 0
+    while True:
+        db.execute(sa.select(sa.func.pg_advisory_xact_lock(_COMPACTION_LOCK_ID)))
+        oldest = db.execute(sa.select(sa.func.min(timestamp)).where(scope, timestamp < cutoff)).scalar()
+        if oldest is None:
+            db.commit()
+            return compacted
+
+        window_start = _truncate(oldest, window)
+        window_end = min(_next(window_start, window), cutoff)
+        in_window = sa.and_(scope, timestamp >= window_start, timestamp < window_end)
+
+        rows = (
+            sa.select(sa.literal(resolution), bucket, *keys, *aggregates)
+            .where(in_window)
+            .group_by(bucket, *keys)
+        )
+        db.execute(
+            sa.insert(AnalyticsRollup).from_select([
+                'resolution', 'bucket', 'metric_name', 'branch_id', 'product_id',
+                'value_count', 'value_sum', 'value_min', 'value_max'
+            ], rows)
+        )
+        compacted += db.execute(sa.delete(table).where(in_window)).rowcount
+        db.commit()
+
+
+def compact_timeseries(db: Session, raw_age: timedelta = RETENTION["raw"],
+                       hour_age: timedelta = RETENTION["hour"], day_age: timedelta = RETENTION["day"]) -> dict:
+    """Downsample old points: raw into hours, hours into days, days into months.
+
+    Each cutoff is aligned to the bucket it produces, so a bucket is only
+    ever written once all of its points are past the cutoff. Commits as it
+    goes; returns the number of rows compacted per tier.
+    """
+    now = datetime.now()
+    return {
+        "raw": _compact_tier(db, None, "hour", _truncate(now - raw_age, "hour"), "day"),
+        "hour": _compact_tier(db, "hour", "day", _truncate(now - hour_age, "day"), "month"),
+        "day": _compact_tier(db, "day", "month", _truncate(now - day_age, "month"), "month")
+    }
+
+
+def pick_resolution(start: datetime, end: datetime, max_points: int = MAX_POINTS) -> str:
+    """Finest resolution that covers start..end in at most `max_points` buckets.
+
+    Never finer than what compaction has left at `start`, e.g. a range
+    starting a year ago gets days even if it would fit in 500 hours.
+    """
+    span = end - start
+    age = datetime.now() - start
+    if span <= timedelta(hours=max_points) and age <= RETENTION["hour"]:
+        return "hour"
+    if span <= timedelta(days=max_points) and age <= RETENTION["day"]:
+        return "day"
+    return "month"
+
+
+def query_timeseries(db: Session, metric_names: List[str], start: datetime, end: datetime,
+                     resolution: Optional[str] = None, aggregate: str = "avg", fill: Optional[str] = None,
+                     branch_id: Optional[int] = None, product_id: Optional[int] = None
+                     ) -> Tuple[str, List[datetime], Dict[str, List[Optional[float]]]]:
+    """Aligned series of several metrics between start and end, across raw and compacted points.
+
+    Bucketing, the bucket grid (generate_series) and gap filling all run in
+    one SQL statement, so Python only reshapes the rows into lists. Every
+    series has one value per bucket from date_trunc(start) up to end:
+    `aggregate` is one of AGGREGATES, empty buckets are None, 0 with
+    fill="zero" or the last known value with fill="previous".
+
+    The resolution defaults to pick_resolution(start, end). Data already
+    compacted to a coarser resolution than requested lands at the start of
+    its own bucket. Returns the resolution, the bucket starts and the
+    values per metric name.
+    """
+    resolution = resolution or pick_resolution(start, end)
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution {resolution!r}")
+    if aggregate not in AGGREGATES:
+        raise ValueError(f"Unknown aggregate {aggregate!r}")
+    if fill not in FILLS:
+        raise ValueError(f"Unknown fill {fill!r}")
+    unit = sa.literal_column(f"'{resolution}'")
+
+    raw_bucket = sa.func.date_trunc(unit, AnalyticsTimeSeries.timestamp)
+    raw = sa.select(
+        AnalyticsTimeSeries.metric_name,
+        raw_bucket.label('bucket'),
+        sa.func.count().label('value_count'),
+        sa.func.sum(AnalyticsTimeSeries.value).label('value_sum'),
+        sa.func.min(AnalyticsTimeSeries.value).label('value_min'),
+        sa.func.max(AnalyticsTimeSeries.value).label('value_max')
+    ).where(
+        AnalyticsTimeSeries.metric_name.in_(metric_names),
+        AnalyticsTimeSeries.timestamp >= start,
+        AnalyticsTimeSeries.timestamp < end
+    ).group_by(AnalyticsTimeSeries.metric_name, raw_bucket)
+
+    rolled_bucket = sa.func.date_trunc(unit, AnalyticsRollup.bucket)
+    rolled = sa.select(
+        AnalyticsRollup.metric_name,
+        rolled_bucket.label('bucket'),
+        sa.func.sum(AnalyticsRollup.value_count).label('value_count'),
+        sa.func.sum(AnalyticsRollup.value_sum).label('value_sum'),
+        sa.func.min(AnalyticsRollup.value_min).label('value_min'),
+        sa.func.max(AnalyticsRollup.value_max).label('value_max')
+    ).where(
+        AnalyticsRollup.metric_name.in_(metric_names),
+        AnalyticsRollup.bucket >= start,
+        AnalyticsRollup.bucket < end
+    ).group_by(AnalyticsRollup.metric_name, rolled_bucket)
+
+    if branch_id is not None:
+        raw = raw.where(AnalyticsTimeSeries.branch_id == branch_id)
+        rolled = rolled.where(AnalyticsRollup.branch_id == branch_id)
+    if product_id is not None:
+        raw = raw.where(AnalyticsTimeSeries.product_id == product_id)
+        rolled = rolled.where(AnalyticsRollup.product_id == product_id)
+
+    points = sa.union_all(raw, rolled).subquery('points')
+    aggregated = sa.select(
+        points.c.metric_name,
+        points.c.bucket,
+        sa.func.sum(points.c.value_count).label('value_count'),
+        sa.func.sum(points.c.value_sum).label('value_sum'),
+        sa.func.min(points.c.value_min).label('value_min'),
+        sa.func.max(points.c.value_max).label('value_max')
+    ).group_by(points.c.metric_name, points.c.bucket).subquery('aggregated')
+
+    # Every (metric, bucket) of the range, whether or not it has points
+    metrics = sa.values(sa.column('metric_name', sa.String), name='metrics').data([(name,) for name in metric_names])
+    buckets = sa.func.generate_series(
+        sa.func.date_trunc(unit, sa.cast(start, sa.DateTime)),
+        sa.cast(end - timedelta(microseconds=1), sa.DateTime),
+        sa.literal_column(f"interval '1 {resolution}'")
+    ).table_valued('bucket').render_derived(name='buckets')
+
+    value = {
+        "sum": aggregated.c.value_sum,
+        "avg": aggregated.c.value_sum / aggregated.c.value_count,
+        "min": aggregated.c.value_min,
+        "max": aggregated.c.value_max,
+        "count": aggregated.c.value_count
+    }[aggregate]
+
+    grid = sa.select(
+        metrics.c.metric_name,
+        buckets.c.bucket,
+        sa.cast(value, sa.Float).label('value')
+    ).select_from(
+        metrics.join(buckets, sa.true()).outerjoin(aggregated, sa.and_(
+            aggregated.c.metric_name == metrics.c.metric_name,
+            aggregated.c.bucket == buckets.c.bucket
+        ))
+    ).subquery('grid')
+
+    filled = grid.c.value
+    if fill == "zero":
+        filled = sa.func.coalesce(grid.c.value, 0)
+    elif fill == "previous":
+        # Buckets after a value share its run number, the run's first row carries the value
+        run = sa.select(
+            grid,
+            sa.func.count(grid.c.value).over(partition_by=grid.c.metric_name, order_by=grid.c.bucket).label('run')
+        ).subquery('runs')
+        grid = run
+        filled = sa.func.first_value(run.c.value).over(
+            partition_by=(run.c.metric_name, run.c.run),
+            order_by=run.c.bucket
+        )
+
+    rows = db.execute(
+        sa.select(grid.c.metric_name, grid.c.bucket, filled.label('value'))
+        .order_by(grid.c.metric_name, grid.c.bucket)
+    ).all()
+
+    series = {name: [] for name in metric_names}
+    timestamps = []
+    for row in rows:
+        series[row.metric_name].append(row.value)
+        if row.metric_name == rows[0].metric_name:
+            timestamps.append(row.bucket)
+    return resolution, timestamps, series
+
+
+def prepare_partitions():
+    """Create this month's and the upcoming partitions, run before anything records metrics"""
+    db = SessionLocal()
+    try:
+        ensure_partitions(db)
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_compaction():
+    """Compact old points, drop emptied partitions and create upcoming ones"""
+    db = SessionLocal()
+    try:
+        ensure_partitions(db)
+        db.commit()
+        compacted = compact_timeseries(db)
+        dropped = drop_empty_partitions(db, _truncate(datetime.now() - RETENTION["raw"], "hour"))
+        db.commit()
+        logger.info("Compacted analytics points %s, dropped partitions %s", compacted, dropped)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def compaction_loop(interval: int = COMPACTION_INTERVAL):
+    """Background task started with the app"""
+    while True:
+        try:
+            await asyncio.to_thread(run_compaction)
+        except Exception:
+            logger.exception("Analytics compaction failed")
+        await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    # python -m api.timeseries, for cron when the app's own loop is not wanted
+    run_compaction()
@@ -0,0 +1,34 @@
+"""Stress checks and benchmarks, run against a scratch database.
+
+Every script here needs `--database-url` on its command line, e.g.
+
+    python -m bench.stress --database-url postgresql://postgres@localhost/pharmassist_bench
+
+and refuses to start without it, so a stray run never falls back to the
+database the app is configured with. The URL is exported as DATABASE_URL
+before anything from `api` is imported.
+"""
+import argparse
+import os
+import sys
+
+
+def require_database_url() -> str:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--database-url')
+    args, _ = parser.parse_known_args()
+    if not args.database_url:
+        raise SystemExit("refusing to run without --database-url: point it at a scratch database, never production")
+
+    database = sys.modules.get('api.database')
+    if database is not None and database.URL_DATABASE != args.database_url:
+        raise SystemExit("api.database was imported before bench could point it at --database-url")
+
+    os.environ['DATABASE_URL'] = args.database_url
+    return args.database_url
+
+
+def add_database_url(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Let a script's own argument parser accept (and document) --database-url"""
+    parser.add_argument('--database-url', required=True, help="scratch database to run against")
+    return parser
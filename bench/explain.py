@@ -0,0 +1,256 @@
+import argparse
+import json
+import sys
+from datetime import date, timedelta
+from typing import List
+
+from bench import add_database_url, require_database_url
+
+require_database_url()
+
+import sqlalchemy as sa
+
+from api.database import SessionLocal
+
+EXPLAIN_NAME = "explain-check"
+INDEX_SCANS = ("Index Scan", "Index Only Scan")
+
+# Rows seeded per table, enough that a sequential scan is never the cheaper plan
+SEED = {
+    'branches': 20,
+    'products': 500,
+    'batches_per_product': 3,  # per branch
+    'reports_per_branch': 365,
+    'items_per_report': 20,
+    'transactions_per_branch': 2000,
+    'clients': 50
+}
+
+# The hot queries of migration b4f7c2e9d810 and the index each one must use
+QUERIES = [
+    ('fefo batches', 'ix_product_batches_active', """
+        SELECT id, quantity FROM product_batches
+        WHERE branch_id = :branch_id AND product_id = :product_id AND is_active
+        ORDER BY expiration_date
+    """),
+    ('expiring batches', 'ix_product_batches_active_expiration_date', """
+        SELECT id, branch_id, product_id, quantity, expiration_date FROM product_batches
+        WHERE is_active AND quantity > 0 AND expiration_date <= :soon
+        ORDER BY expiration_date
+        LIMIT 100
+    """),
+    ('branch report list', 'ix_invreports_branch_id_created_at', """
+        SELECT * FROM invreports
+        WHERE branch_id = :branch_id
+        ORDER BY created_at DESC
+        LIMIT 20
+    """),
+    ('branch reports by period', 'ix_invreports_branch_id_end_date', """
+        SELECT id, end_date FROM invreports
+        WHERE branch_id = :branch_id AND end_date >= :week_ago AND end_date < :today
+    """),
+    ('reports by period', 'ix_invreports_end_date', """
+        SELECT id, branch_id FROM invreports
+        WHERE end_date >= :yesterday AND end_date < :today
+    """),
+    ('report items', 'ix_invreport_items_invreport_id_product_id', """
+        SELECT product_id, offtake, current_srp, current_cost FROM invreport_items
+        WHERE invreport_id = :invreport_id
+    """),
+    ('product report items', 'ix_invreport_items_product_id', """
+        SELECT invreport_id, offtake FROM invreport_items
+        WHERE product_id = :product_id
+        LIMIT 50
+    """),
+    ('report item batches', 'ix_invreport_batches_invreport_item_id', """
+        SELECT * FROM invreport_batches
+        WHERE invreport_item_id = :invreport_item_id
+    """),
+    ('company expenses', 'ix_expenses_date_created_scope', """
+        SELECT id, amount FROM expenses
+        WHERE date_created >= :week_ago AND date_created < :today AND scope = 'company'
+    """),
+    ('branch expenses', 'ix_expenses_branch_id_date_created', """
+        SELECT id, amount FROM expenses
+        WHERE branch_id = :branch_id AND date_created >= :week_ago
+    """),
+    ('branch transactions', 'ix_transactions_branch_id_transaction_date', """
+        SELECT * FROM transactions
+        WHERE branch_id = :branch_id
+        ORDER BY transaction_date DESC
+        LIMIT 20
+    """),
+    ('client transactions', 'ix_transactions_client_id_transaction_date', """
+        SELECT * FROM transactions
+        WHERE client_id = :client_id
+        ORDER BY transaction_date DESC
+        LIMIT 20
+    """),
+    ('transaction items', 'ix_transaction_items_transaction_id', """
+        SELECT * FROM transaction_items
+        WHERE transaction_id = :transaction_id
+    """),
+    ('transaction payments', 'ix_payments_transaction_id', """
+        SELECT * FROM payments
+        WHERE transaction_id = :transaction_id
+    """),
+]
+
+
+def _seed(db) -> dict:
+    """Fill the tables of QUERIES in the current transaction and return parameters pointing into the data"""
+    def ids(statement: str, **params) -> List[int]:
+        return db.execute(sa.text(statement), {**SEED, 'name': EXPLAIN_NAME, **params}).scalars().all()
+
+    branch_ids = ids("""
+        INSERT INTO branches (branch_name, location, branch_type, is_active)
+        SELECT :name, :name, 'wholesale', false FROM generate_series(1, :branches)
+        RETURNING id
+    """)
+    product_ids = ids("""
+        INSERT INTO products (name, cost, srp, retail_low_stock_threshold, wholesale_low_stock_threshold,
+                              is_retail_available, is_wholesale_available)
+        SELECT :name || '-' || i, 10, 15, 50, 50, true, true FROM generate_series(1, :products) i
+        RETURNING id
+    """)
+    user_id, = ids("INSERT INTO users (username, role) VALUES (:name, 'admin') RETURNING id")
+    client_ids = ids("""
+        INSERT INTO clients (name, markup_percentage, payment_terms, credit_limit, current_balance, is_active)
+        SELECT :name || '-' || i, 0.1, 30, 1e9, 0, true FROM generate_series(1, :clients) i
+        RETURNING id
+    """)
+    params = {'branch_ids': branch_ids, 'product_ids': product_ids, 'client_ids': client_ids, 'user_id': user_id}
+
+    # Expiry dates spread over two years, so only a sliver is about to expire
+    db.execute(sa.text("""
+        INSERT INTO product_batches (branch_id, product_id, quantity, expiration_date, is_active, created_at)
+        SELECT b, p, 10 + k, CURRENT_DATE + (random() * 730)::int, k > 0, now()
+        FROM unnest(CAST(:branch_ids AS int[])) b, unnest(CAST(:product_ids AS int[])) p,
+             generate_series(0, :batches_per_product - 1) k
+    """), {**SEED, **params})
+    db.execute(sa.text("""
+        INSERT INTO invreports (branch_id, created_at, start_date, end_date, is_viewed, items_count)
+        SELECT b, CURRENT_DATE - d, CURRENT_DATE - d - 1, CURRENT_DATE - d, false, :items_per_report
+        FROM unnest(CAST(:branch_ids AS int[])) b, generate_series(0, :reports_per_branch - 1) d
+    """), {**SEED, **params})
+    db.execute(sa.text("""
+        INSERT INTO invreport_items (invreport_id, product_id, beginning, selling_area, offtake, current_cost, current_srp)
+        SELECT r.id, p, 100, 100, 3, 10, 15
+        FROM invreports r,
+             unnest((CAST(:product_ids AS int[]))[1:CAST(:items_per_report AS int)]) p
+        WHERE r.branch_id = ANY(CAST(:branch_ids AS int[]))
+    """), {**SEED, **params})
+    db.execute(sa.text("""
+        INSERT INTO invreport_batches (invreport_item_id, quantity, expiration_date, batch_type, created_at)
+        SELECT i.id, 3, CURRENT_DATE + 365, 'offtake', now()
+        FROM invreport_items i JOIN invreports r ON r.id = i.invreport_id
+        WHERE r.branch_id = ANY(CAST(:branch_ids AS int[]))
+    """), params)
+    db.execute(sa.text("""
+        INSERT INTO expenses (name, type, amount, date_created, scope, branch_id, allocation_policy, created_by_id, created_at)
+        SELECT :name, 'utilities', 100, CURRENT_DATE - d, 'branch', b, 'even', :user_id, now()
+        FROM unnest(CAST(:branch_ids AS int[])) b, generate_series(0, 729) d
+        UNION ALL
+        SELECT :name, 'utilities', 500, CURRENT_DATE - d, 'company', NULL, 'even', :user_id, now()
+        FROM generate_series(0, 729) d
+    """), {**params, 'name': EXPLAIN_NAME})
+    db.execute(sa.text("""
+        INSERT INTO transactions (client_id, branch_id, total_amount, amount_paid, payment_status,
+                                  transaction_date, due_date, is_void, created_at)
+        SELECT (CAST(:client_ids AS int[]))[1 + n % cardinality(CAST(:client_ids AS int[]))], b, 100, 50, 'partial',
+               now() - n * interval '1 hour', CURRENT_DATE + 30, false, now()
+        FROM unnest(CAST(:branch_ids AS int[])) b, generate_series(1, :transactions_per_branch) n
+    """), {**SEED, **params})
+    db.execute(sa.text("""
+        INSERT INTO transaction_items (transaction_id, product_id, quantity, base_price, markup_price, total_amount)
+        SELECT t.id, (CAST(:product_ids AS int[]))[k], 2, 10, 11, 22
+        FROM transactions t, generate_series(1, 2) k
+        WHERE t.branch_id = ANY(CAST(:branch_ids AS int[]))
+    """), params)
+    db.execute(sa.text("""
+        INSERT INTO payments (transaction_id, client_id, amount, payment_date, recorded_by_id, is_void, created_at)
+        SELECT t.id, t.client_id, 50, CURRENT_DATE, :user_id, false, now()
+        FROM transactions t
+        WHERE t.branch_id = ANY(CAST(:branch_ids AS int[]))
+    """), params)
+
+    for table in ['product_batches', 'invreports', 'invreport_items', 'invreport_batches',
+                  'expenses', 'transactions', 'transaction_items', 'payments']:
+        db.execute(sa.text(f"ANALYZE {table}"))
+
+    def first(statement: str) -> int:
+        return db.execute(sa.text(statement), params).scalar()
+
+    today = date.today()
+    return {
+        'branch_id': branch_ids[0],
+        'product_id': product_ids[-1],
+        'client_id': client_ids[0],
+        'invreport_id': first("SELECT max(id) FROM invreports WHERE branch_id = ANY(CAST(:branch_ids AS int[]))"),
+        'invreport_item_id': first("""
+            SELECT max(i.id) FROM invreport_items i JOIN invreports r ON r.id = i.invreport_id
+            WHERE r.branch_id = ANY(CAST(:branch_ids AS int[]))
+        """),
+        'transaction_id': first("SELECT max(id) FROM transactions WHERE branch_id = ANY(CAST(:branch_ids AS int[]))"),
+        'soon': today + timedelta(days=3),
+        'today': today,
+        'yesterday': today - timedelta(days=1),
+        'week_ago': today - timedelta(days=7)
+    }
+
+
+def _scans(plan: dict):
+    """(node type, index name) of every node of an EXPLAIN (FORMAT JSON) plan"""
+    yield plan['Node Type'], plan.get('Index Name')
+    for child in plan.get('Plans', []):
+        yield from _scans(child)
+
+
+def run_explain_check(verbose: bool = False) -> List[str]:
+    """Seed data, EXPLAIN the hot queries and check each one scans the index meant for it.
+
+    Bitmap scans are turned off, so a query passes with an Index Scan or
+    Index Only Scan on its index. Everything happens in one transaction that is rolled back at the end,
+    statistics included, so the database is left as it was. Returns the
+    problems found, empty when every query uses its index.
+    """
+    db = SessionLocal()
+    try:
+        params = _seed(db)
+        # For the few rows these queries read the planner often prefers a bitmap scan of
+        # the same index; without it the choice left is the index or a sequential scan
+        db.execute(sa.text("SET LOCAL enable_bitmapscan = off"))
+        existing = set(db.execute(sa.text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")).scalars())
+
+        problems = []
+        for name, index, statement in QUERIES:
+            if index not in existing:
+                problems.append(f"{name}: index {index} does not exist")
+                continue
+            plan, = db.execute(sa.text(f"EXPLAIN (FORMAT JSON) {statement}"), params).scalar()
+            scans = list(_scans(plan['Plan']))
+            used = any(node in INDEX_SCANS and used_index == index for node, used_index in scans)
+            summary = ", ".join(node if used_index is None else f"{node} on {used_index}" for node, used_index in scans)
+            print(f"  {'ok' if used else 'FAIL':<5} {name:<26} {summary}")
+            if verbose:
+                print(json.dumps(plan, indent=2))
+            if not used:
+                problems.append(f"{name}: no index scan on {index}")
+        return problems
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == '__main__':
+    # python -m bench.explain --database-url URL [--verbose]
+    # seeds and rolls back in one transaction; exits 1 when a query misses its index
+    parser = add_database_url(argparse.ArgumentParser(description=run_explain_check.__doc__.splitlines()[0]))
+    parser.add_argument('--verbose', action='store_true', help="print every plan in full")
+    args = parser.parse_args()
+
+    problems = run_explain_check(args.verbose)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    print("OK" if not problems else f"{len(problems)} problems")
+    sys.exit(1 if problems else 0)
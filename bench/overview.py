@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import json
+import time
+from datetime import date, datetime, timedelta
+from typing import List
+
+from bench import add_database_url, require_database_url
+
+require_database_url()
+
+import sqlalchemy as sa
+from sqlalchemy import and_, case, distinct, event, exists, func, or_, select
+
+from api.allocations import backfill_allocations
+from api.cache import branch_scope
+from api.database import SessionLocal, engine
+from api.models import (
+    Branch,
+    BranchProduct,
+    DailySales,
+    DataVersion,
+    Expense,
+    InvReport,
+    InvReportItem,
+    Product,
+    ProductBatch,
+    UserRole
+)
+from api.rollups import backfill_daily_sales
+from api.routers.analytics import get_company_overview, get_start_date
+
+BENCH_NAME = "overview-bench"
+TIME_RANGES = ["7d", "30d", "90d", "1y"]
+BRANCH_TYPES = ["retail", "wholesale"]
+
+# 20 branches with two years of daily reports, as in the numbers quoted by a07aef9
+SEED = {
+    'branches': 20,  # half retail, half wholesale
+    'products': 200,
+    'days': 730,
+    'items_per_report': 20
+}
+
+
+def old_company_overview(db, time_range: str = "30d", branch_type: str = "retail") -> dict:
+    """get_company_overview as it was before a07aef9, eight queries and a branch count subquery"""
+    end_date = datetime.now()
+    start_date = get_start_date(time_range)
+    
+    # Get branches of specified type
+    branches = db.query(Branch).filter(
+        Branch.is_active == True,
+        Branch.branch_type == branch_type
+    ).all()
+    branch_ids = [b.id for b in branches]
+
+    # Calculate overall metrics (existing code)
+    sales_data = db.query(
+        func.sum(DailySales.revenue).label('total_revenue'),
+        func.sum(DailySales.quantity).label('total_sales'),
+        func.sum(DailySales.revenue - DailySales.cost).label('gross_profit')
+    ).filter(
+        DailySales.branch_id.in_(branch_ids),
+        DailySales.day.between(start_date.date(), end_date.date())
+    ).first()
+    
+    # Get branch performance
+    branch_performance = db.query(
+        Branch.id.label('branch_id'),
+        Branch.branch_name,
+        func.coalesce(func.sum(DailySales.quantity), 0).label('total_sales'),
+        func.coalesce(func.sum(DailySales.revenue), 0).label('revenue'),
+        func.coalesce(
+            db.query(func.sum(Expense.amount))
+            .filter(
+                Expense.branch_id == Branch.id,
+                Expense.scope == 'branch',
+                Expense.date_created.between(start_date, end_date)
+            ).as_scalar(),
+            0
+        ).label('total_expenses')
+    ).join(
+        DailySales, and_(
+            DailySales.branch_id == Branch.id,
+            DailySales.day.between(start_date.date(), end_date.date())
+        ), isouter=True
+    ).filter(
+        Branch.id.in_(branch_ids)
+    ).group_by(
+        Branch.id,
+        Branch.branch_name
+    ).all()
+
+    # Get top products
+    top_products = db.query(
+        Product.id,
+        Product.name,
+        func.sum(DailySales.quantity).label('total_sales'),
+        func.sum(DailySales.revenue).label('revenue'),
+        func.sum(DailySales.revenue - DailySales.cost).label('profit')
+    ).join(
+        DailySales, and_(
+            DailySales.product_id == Product.id,
+            DailySales.branch_id.in_(branch_ids),
+            DailySales.day.between(start_date.date(), end_date.date())
+        )
+    ).group_by(
+        Product.id,
+        Product.name
+    ).order_by(
+        func.sum(DailySales.revenue).desc()
+    ).limit(5).all()
+
+    
+    total_revenue = float(sales_data.total_revenue or 0)
+    gross_profit = float(sales_data.gross_profit or 0)
+    total_expenses = db.query(func.sum(Expense.amount)).filter(
+        Expense.branch_id.in_(branch_ids),
+        Expense.date_created.between(start_date, end_date)
+    ).scalar() or 0
+    net_profit = gross_profit - total_expenses
+    profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
+
+    # Calculate revenue trend
+    revenue_trend = []
+    
+    # Get revenue data from the daily rollup
+    revenue_data = db.query(
+        DailySales.day.label('date'),
+        func.sum(DailySales.revenue).label('value')
+    ).filter(
+        DailySales.branch_id.in_(branch_ids),
+        DailySales.day.between(start_date.date(), end_date.date())
+    ).group_by(
+        DailySales.day
+    ).order_by(
+        DailySales.day
+    ).all()
+
+    # Get expense data directly from expenses table
+    expense_data = db.query(
+        Expense.date_created.label('date'),
+        func.sum(case(
+            (Expense.scope == 'company_wide', 
+             Expense.amount / db.query(func.count(Branch.id)).scalar()),
+            (Expense.scope == 'main_office', Expense.amount),
+            else_=Expense.amount
+        )).label('value')
+    ).filter(
+        Expense.date_created.between(start_date, end_date),
+        or_(
+            Expense.branch_id.in_(branch_ids),
+            Expense.scope.in_(['company_wide', 'main_office'])
+        )
+    ).group_by(
+        Expense.date_created
+    ).all()
+
+    # Convert to dictionaries for easier lookup
+    expense_dict = {exp.date: exp.value for exp in expense_data}
+    
+    # Combine revenue and expense data
+    for rev in revenue_data:
+        date = rev.date
+        revenue = rev.value or 0
+        expense = expense_dict.get(date, 0)
+        
+        revenue_trend.append({
+            "timestamp": date,
+            "value": revenue,
+            "profit": revenue - expense,
+            "expenses": expense
+        })
+
+    # First, get the total quantity per branch and product
+    product_quantities = db.query(
+        Branch.id.label('branch_id'),
+        Branch.branch_type,
+        Product.id.label('product_id'),
+        Product.wholesale_low_stock_threshold,
+        Product.retail_low_stock_threshold,
+        func.sum(case((ProductBatch.is_active == True, ProductBatch.quantity), else_=0)).label('total_quantity')
+    ).join(
+        BranchProduct, BranchProduct.branch_id == Branch.id
+    ).join(
+        Product, Product.id == BranchProduct.product_id
+    ).outerjoin(
+        ProductBatch, and_(
+            ProductBatch.product_id == Product.id,
+            ProductBatch.branch_id == Branch.id
+        )
+    ).filter(
+        Branch.id.in_(branch_ids)
+    ).group_by(
+        Branch.id,
+        Branch.branch_type,
+        Product.id,
+        Product.wholesale_low_stock_threshold,
+        Product.retail_low_stock_threshold
+    ).subquery()
+
+    # Then use this subquery for the branch-level counts
+    inventory_stats = db.query(
+        func.count(distinct(Branch.id)).label('total_branches'),
+        func.count(distinct(case(
+            (exists(
+                select(1).select_from(product_quantities)
+                .join(BranchProduct, and_(
+                    BranchProduct.branch_id == product_quantities.c.branch_id,
+                    BranchProduct.product_id == product_quantities.c.product_id,
+                    BranchProduct.is_available == True
+                ))
+                .correlate(Branch)
+                .where(and_(
+                    product_quantities.c.branch_id == Branch.id,
+                    product_quantities.c.total_quantity <= 
+                    case(
+                        (product_quantities.c.branch_type == 'wholesale', 
+                         product_quantities.c.wholesale_low_stock_threshold),
+                        else_=product_quantities.c.retail_low_stock_threshold
+                    )
+                ))
+            ), Branch.id)
+        ))).label('low_stock_branches'),
+        func.count(distinct(case(
+            (exists(
+                select(1).select_from(ProductBatch)
+                .correlate(Branch)
+                .where(and_(
+                    ProductBatch.branch_id == Branch.id,
+                    ProductBatch.expiration_date <= datetime.now() + timedelta(days=30),
+                    ProductBatch.is_active == True,
+                    ProductBatch.quantity > 0
+                ))
+            ), Branch.id)
+        ))).label('near_expiry_branches')
+    ).select_from(Branch).filter(
+        Branch.id.in_(branch_ids)
+    ).first()
+
+    return {
+        "total_revenue": total_revenue,
+        "total_sales": int(sales_data.total_sales or 0),
+        "total_expenses": float(total_expenses),
+        "gross_profit": gross_profit,
+        "net_profit": net_profit,
+        "profit_margin": profit_margin,
+        "active_branches": len(branches),
+        "branch_performance": [{
+            "branch_id": bp.branch_id,
+            "branch_name": bp.branch_name,
+            "total_sales": int(bp.total_sales or 0),
+            "revenue": float(bp.revenue or 0),
+            "total_expenses": float(bp.total_expenses or 0),
+            "profit": float((bp.revenue or 0) - (bp.total_expenses or 0))
+        } for bp in branch_performance],
+        "top_products": [{
+            "id": p.id,
+            "name": p.name,
+            "total_sales": int(p.total_sales or 0),
+            "revenue": float(p.revenue or 0),
+            "profit_margin": float(p.profit / p.revenue * 100) if p.revenue else 0
+        } for p in top_products],
+        "revenue_trend": [{
+            "timestamp": entry["timestamp"],
+            "value": float(entry["value"]),
+            "profit": float(entry["profit"]),
+            "expenses": float(entry["expenses"])
+        } for entry in revenue_trend],
+        "inventory": {
+            "total_branches": int(inventory_stats.total_branches or 0),
+            "low_stock_branches": int(inventory_stats.low_stock_branches or 0),
+            "near_expiry_branches": int(inventory_stats.near_expiry_branches or 0)
+        }
+    }
+
+
+def _seed(db) -> dict:
+    """Active branches with products, stock, daily reports, expenses and the rollups built from them"""
+    params = {**SEED, 'name': BENCH_NAME}
+
+    def ids(statement: str) -> List[int]:
+        return db.execute(sa.text(statement), params).scalars().all()
+
+    branch_ids = ids("""
+        INSERT INTO branches (branch_name, location, branch_type, is_active)
+        SELECT :name || '-' || i, :name, CASE WHEN i % 2 = 0 THEN 'retail' ELSE 'wholesale' END, true
+        FROM generate_series(1, :branches) i
+        RETURNING id
+    """)
+    product_ids = ids("""
+        INSERT INTO products (name, cost, srp, retail_low_stock_threshold, wholesale_low_stock_threshold,
+                              is_retail_available, is_wholesale_available)
+        SELECT :name || '-' || i, 10 + i % 7, 15 + i % 11, 50, 50, true, true FROM generate_series(1, :products) i
+        RETURNING id
+    """)
+    params.update(branch_ids=branch_ids, product_ids=product_ids)
+
+    # Stock low on some products and expiring soon on others, so the inventory counts have work to do
+    db.execute(sa.text("""
+        INSERT INTO product_batches (branch_id, product_id, quantity, expiration_date, is_active, created_at)
+        SELECT b, p, (b + p) % 100, CURRENT_DATE + (b * p) % 400, true, now()
+        FROM unnest(CAST(:branch_ids AS int[])) b, unnest(CAST(:product_ids AS int[])) p
+    """), params)
+    db.execute(sa.text("""
+        INSERT INTO branch_products (branch_id, product_id, quantity, current_expiration_date, is_available)
+        SELECT branch_id, product_id, quantity, expiration_date, true
+        FROM product_batches WHERE branch_id = ANY(CAST(:branch_ids AS int[]))
+    """), params)
+    db.execute(sa.text("""
+        INSERT INTO invreports (branch_id, created_at, start_date, end_date, is_viewed, items_count)
+        SELECT b, CURRENT_DATE - d, CURRENT_DATE - d - 1, CURRENT_DATE - d, false, :items_per_report
+        FROM unnest(CAST(:branch_ids AS int[])) b, generate_series(0, :days - 1) d
+    """), params)
+    # Each report covers a different run of products, so the top products differ by range,
+    # and each product has a price of its own, so they are rarely tied on revenue
+    db.execute(sa.text("""
+        INSERT INTO invreport_items (invreport_id, product_id, beginning, selling_area, offtake, current_cost, current_srp)
+        SELECT r.id, (CAST(:product_ids AS int[]))[pick.i], 100, 100, 1 + (r.id + k) % 9, 10, 15 + pick.i * 0.01
+        FROM invreports r, generate_series(0, :items_per_report - 1) k,
+             LATERAL (SELECT 1 + (r.id * 7 + k) % :products AS i) pick
+        WHERE r.branch_id = ANY(CAST(:branch_ids AS int[]))
+    """), params)
+    expense_ids = ids("""
+        INSERT INTO expenses (name, type, amount, date_created, scope, branch_id, allocation_policy, created_at)
+        SELECT :name, 'utilities', 50 + b % 13, CURRENT_DATE - d, 'branch', b, 'even', now()
+        FROM unnest(CAST(:branch_ids AS int[])) b, generate_series(0, :days - 1) d
+        RETURNING id
+    """)
+
+    backfill_daily_sales(db, date.today() - timedelta(days=SEED['days']), date.today())
+    backfill_allocations(db, expense_ids)
+    db.commit()
+
+    # Left to autovacuum, the fresh rows would be vacuumed in the middle of the timings
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in ['branches', 'products', 'product_batches', 'branch_products', 'invreports',
+                      'invreport_items', 'expenses', 'expense_allocations', 'daily_sales']:
+            conn.execute(sa.text(f"VACUUM ANALYZE {table}"))
+    return {'branch_ids': branch_ids, 'product_ids': product_ids}
+
+
+def _cleanup(db, fixtures: dict):
+    branch_ids = fixtures['branch_ids']
+    report_ids = sa.select(InvReport.id).where(InvReport.branch_id.in_(branch_ids))
+    for stmt in [
+        sa.delete(Expense).where(Expense.branch_id.in_(branch_ids)),  # allocations cascade
+        sa.delete(DailySales).where(DailySales.branch_id.in_(branch_ids)),
+        sa.delete(InvReportItem).where(InvReportItem.invreport_id.in_(report_ids)),
+        sa.delete(InvReport).where(InvReport.branch_id.in_(branch_ids)),
+        sa.delete(ProductBatch).where(ProductBatch.branch_id.in_(branch_ids)),
+        sa.delete(BranchProduct).where(BranchProduct.branch_id.in_(branch_ids)),
+        sa.delete(DataVersion).where(DataVersion.scope.in_([branch_scope(id) for id in branch_ids])),
+        sa.delete(Product).where(Product.id.in_(fixtures['product_ids'])),
+        sa.delete(Branch).where(Branch.id.in_(branch_ids))
+    ]:
+        db.execute(stmt, execution_options={'synchronize_session': False})
+    db.commit()
+
+
+def _new_company_overview(time_range: str, branch_type: str) -> dict:
+    """The current endpoint, past its response cache so every call runs the query"""
+    endpoint = get_company_overview.__wrapped__
+    admin = {'id': None, 'username': BENCH_NAME, 'role': UserRole.ADMIN.value, 'branch_id': None}
+    return asyncio.run(endpoint(db=SessionLocal(), current_user=admin, time_range=time_range, branch_type=branch_type))
+
+
+def _old(time_range: str, branch_type: str) -> dict:
+    db = SessionLocal()
+    try:
+        return old_company_overview(db, time_range, branch_type)
+    finally:
+        db.close()
+
+
+def _normalized(response: dict) -> dict:
+    """The response as JSON would send it, floats rounded to the cent.
+
+    Products tied on revenue come back in any order from either
+    implementation, so top products are compared sorted by revenue then id.
+    """
+    def walk(value):
+        if isinstance(value, float):
+            return round(value, 2)
+        if isinstance(value, dict):
+            return {key: walk(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [walk(item) for item in value]
+        return value
+    response = walk(json.loads(json.dumps(response, default=str)))
+    response['top_products'].sort(key=lambda product: (-product['revenue'], product['id']))
+    return response
+
+
+def _measure(call, repeat: int):
+    """Best wall time over `repeat` calls after a warm-up call, the statements of one call and its response"""
+    call()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        timings = []
+        for _ in range(repeat):
+            statements.clear()
+            started = time.perf_counter()
+            response = call()
+            timings.append(time.perf_counter() - started)
+        return min(timings), len(statements), response
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def run_overview_benchmark(repeat: int = 5, keep: bool = False) -> List[dict]:
+    """Time the company overview against its implementation before a07aef9 on seeded data.
+
+    Seeds SEED's branches, products and two years of reports and expenses,
+    builds the daily_sales and expense allocation rollups from them, then
+    times both implementations for every range and branch type, best of
+    `repeat`. The current one is called past its cache. The seeded rows are
+    removed afterwards unless `keep`. Returns one row per range and branch
+    type, with the response fields the two disagree on: the old
+    implementation compared expense dates with the start timestamp and so
+    left out the first day's expenses, which shows up in every expense
+    figure.
+    """
+    db = SessionLocal()
+    started = time.perf_counter()
+    fixtures = _seed(db)
+    print(f"seeded in {time.perf_counter() - started:.1f}s")
+    results = []
+    try:
+        for branch_type in BRANCH_TYPES:
+            for time_range in TIME_RANGES:
+                old_time, old_statements, old = _measure(lambda: _old(time_range, branch_type), repeat)
+                new_time, new_statements, new = _measure(lambda: _new_company_overview(time_range, branch_type), repeat)
+                old, new = _normalized(old), _normalized(new)
+                results.append({
+                    'range': time_range,
+                    'branch_type': branch_type,
+                    'old_ms': old_time * 1000,
+                    'new_ms': new_time * 1000,
+                    'old_statements': old_statements,
+                    'new_statements': new_statements,
+                    'differences': sorted(key for key in old if old[key] != new.get(key))
+                })
+        return results
+    finally:
+        if not keep:
+            db.rollback()
+            _cleanup(db, fixtures)
+        db.close()
+
+
+if __name__ == '__main__':
+    # python -m bench.overview --database-url URL [--repeat N] [--keep]
+    # seeds active branches into that database and removes them afterwards
+    parser = add_database_url(argparse.ArgumentParser(description=run_overview_benchmark.__doc__.splitlines()[0]))
+    parser.add_argument('--repeat', type=int, default=5, help="calls per implementation, the best time is shown")
+    parser.add_argument('--keep', action='store_true', help="leave the seeded branches and their data in place")
+    args = parser.parse_args()
+
+    print(f"{'range':<6} {'type':<10} {'old ms':>8} {'new ms':>8} {'old stmts':>10} {'new stmts':>10}  differences")
+    for row in run_overview_benchmark(args.repeat, keep=args.keep):
+        print(
+            f"{row['range']:<6} {row['branch_type']:<10} {row['old_ms']:>8.1f} {row['new_ms']:>8.1f} "
+            f"{row['old_statements']:>10} {row['new_statements']:>10}  {', '.join(row['differences']) or 'none'}"
+        )
@@ -0,0 +1,170 @@
+import argparse
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import List
+
+from bench import add_database_url, require_database_url
+
+require_database_url()
+
+import sqlalchemy as sa
+
+from api.database import SessionLocal
+from api.models import Branch, BranchType, ReferenceCounter, Transaction
+
+REFERENCE_NAME = "reference-check"
+ROLLBACK_SHARE = 0.1  # sales that fail after taking a number, their numbers must be handed out again
+
+
+def _fixtures(db, branches: int) -> List[int]:
+    """Inactive wholesale branches nobody else sells on"""
+    rows = [
+        Branch(branch_name=REFERENCE_NAME, location=REFERENCE_NAME, branch_type=BranchType.WHOLESALE.value, is_active=False)
+        for _ in range(branches)
+    ]
+    db.add_all(rows)
+    db.commit()
+    return [branch.id for branch in rows]
+
+
+def _cleanup(db, branch_ids: List[int]):
+    for stmt in [
+        sa.delete(Transaction).where(Transaction.branch_id.in_(branch_ids)),
+        sa.delete(ReferenceCounter).where(ReferenceCounter.branch_id.in_(branch_ids)),
+        sa.delete(Branch).where(Branch.id.in_(branch_ids))
+    ]:
+        db.execute(stmt, execution_options={'synchronize_session': False})
+    db.commit()
+
+
+def _allocate(branch_ids: List[int], days: List[date], seed: int):
+    """Take a number in a sale of its own and commit or roll it back: (outcome, record)"""
+    rnd = random.Random(seed)
+    branch_id, day = rnd.choice(branch_ids), rnd.choice(days)
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        reference = Transaction.generate_reference(db, branch_id, day)
+        # The stored row is what makes a duplicate number fail on the unique constraint
+        db.add(Transaction(
+            branch_id=branch_id,
+            reference_number=reference,
+            transaction_date=datetime.combine(day, datetime.min.time()),
+            payment_status='pending'
+        ))
+        db.flush()
+        if rnd.random() < ROLLBACK_SHARE:
+            db.rollback()
+            return 'rolled back', None
+        db.commit()
+        return 'ok', {
+            'key': (branch_id, day),
+            'reference': reference,
+            'sequence': int(reference.rsplit('-', 1)[1]),
+            'started': started,
+            'committed': time.perf_counter()
+        }
+    except Exception as e:
+        db.rollback()
+        return type(e).__name__, None
+    finally:
+        db.close()
+
+
+def _check(db, branch_ids: List[int], records: List[dict]) -> List[str]:
+    """Uniqueness, gap-free 1..n per branch and day, and numbers that only ever go up"""
+    problems = []
+
+    references = [record['reference'] for record in records]
+    if len(set(references)) != len(references):
+        problems.append(f"{len(references) - len(set(references))} duplicate references handed out")
+    stored = [ref for (ref,) in db.query(Transaction.reference_number).filter(Transaction.branch_id.in_(branch_ids))]
+    if sorted(stored) != sorted(references):
+        problems.append(f"{len(stored)} stored references for {len(references)} committed sales")
+
+    by_key = defaultdict(list)
+    for record in records:
+        by_key[record['key']].append(record)
+    counters = {
+        (branch_id, day): last_value
+        for branch_id, day, last_value in db.query(ReferenceCounter.branch_id, ReferenceCounter.day, ReferenceCounter.last_value)
+        .filter(ReferenceCounter.branch_id.in_(branch_ids))
+    }
+
+    for key, group in sorted(by_key.items()):
+        sequences = sorted(record['sequence'] for record in group)
+        if sequences != list(range(1, len(group) + 1)):
+            problems.append(f"branch {key[0]} on {key[1]}: numbers are not 1..{len(group)}")
+        if counters.get(key) != len(group):
+            problems.append(f"branch {key[0]} on {key[1]}: counter at {counters.get(key)} after {len(group)} sales")
+
+        # A sale started after another one committed always gets a higher number
+        by_commit = sorted(group, key=lambda record: record['committed'])
+        highest, i = 0, 0
+        for record in sorted(group, key=lambda record: record['started']):
+            while i < len(by_commit) and by_commit[i]['committed'] < record['started']:
+                highest = max(highest, by_commit[i]['sequence'])
+                i += 1
+            if record['sequence'] <= highest:
+                problems.append(f"branch {key[0]} on {key[1]}: {record['sequence']} handed out after {highest} was committed")
+                break
+
+    return problems
+
+
+def run_reference_check(calls: int = 5000, branches: int = 4, days: int = 3, workers: int = 12, keep: bool = False) -> List[str]:
+    """Take reference numbers from parallel sales across several branches and days and check them.
+
+    Each of the `calls` sales takes a number through
+    Transaction.generate_reference for a random branch and day, stores a
+    transaction with it and commits, or rolls back one time in ten. Runs
+    on throwaway inactive branches, removed afterwards unless `keep`.
+    Returns the problems found, empty when every invariant holds.
+    """
+    db = SessionLocal()
+    branch_ids = _fixtures(db, branches)
+    day_list = [date.today() - timedelta(days=k) for k in range(days)]
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda seed: _allocate(branch_ids, day_list, seed), range(calls)))
+        print(f"{calls} sales on {branches} branches over {days} days in {time.perf_counter() - started:.1f}s")
+
+        outcomes = Counter(outcome for outcome, _ in results)
+        for outcome, count in sorted(outcomes.items()):
+            print(f"  {outcome:<20} {count}")
+
+        problems = [
+            f"{count} sales failed with {outcome}"
+            for outcome, count in outcomes.items()
+            if outcome not in ('ok', 'rolled back')
+        ]
+        problems += _check(db, branch_ids, [record for outcome, record in results if outcome == 'ok'])
+        return problems
+    finally:
+        if not keep:
+            db.rollback()
+            _cleanup(db, branch_ids)
+        db.close()
+
+
+if __name__ == '__main__':
+    # python -m bench.references --database-url URL [calls] [branches] [days] [workers] [--keep]
+    # on throwaway branches of that database; exits 1 on any problem
+    parser = add_database_url(argparse.ArgumentParser(description=run_reference_check.__doc__.splitlines()[0]))
+    parser.add_argument('calls', type=int, nargs='?', default=5000)
+    parser.add_argument('branches', type=int, nargs='?', default=4)
+    parser.add_argument('days', type=int, nargs='?', default=3)
+    parser.add_argument('workers', type=int, nargs='?', default=12)
+    parser.add_argument('--keep', action='store_true', help="leave the branches and their rows in place")
+    args = parser.parse_args()
+
+    problems = run_reference_check(args.calls, args.branches, args.days, args.workers, keep=args.keep)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    print("OK" if not problems else f"{len(problems)} problems")
+    sys.exit(1 if problems else 0)
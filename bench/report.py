@@ -0,0 +1,166 @@
+import argparse
+import random
+import statistics
+import time
+from datetime import date, datetime, timedelta
+from typing import List
+
+from bench import add_database_url, require_database_url
+
+require_database_url()
+
+import sqlalchemy as sa
+from sqlalchemy import event
+
+from api.cache import branch_scope
+from api.database import SessionLocal, engine
+from api.inventory import sync_branch_stock
+from api.models import (
+    Branch,
+    BranchProduct,
+    BranchType,
+    DailySales,
+    DataVersion,
+    InvReport,
+    InvReportBatch,
+    InvReportItem,
+    Product,
+    ProductBatch,
+    UserRole
+)
+from api.routers.inventory_reports import InvReportCreate, create_inventory_report
+
+BENCH_NAME = "report-bench"
+REPORT_SIZES = [50, 300, 1000]
+BATCHES_PER_PRODUCT = 2
+BATCH_QUANTITY = 10000  # plenty, so repeated reports never run a product dry
+DELIVERY_SHARE = 3  # every third item also takes a delivery
+PULL_OUT_SHARE = 5  # every fifth item also pulls out of its earliest batch
+
+
+def _fixtures(db, products: int) -> dict:
+    """An inactive retail branch stocking `products` products, each in a few batches"""
+    branch = Branch(branch_name=BENCH_NAME, location=BENCH_NAME, branch_type=BranchType.RETAIL.value, is_active=False)
+    rows = [
+        Product(name=f"{BENCH_NAME}-{i}", cost=10, srp=15, is_retail_available=True, is_wholesale_available=False)
+        for i in range(products)
+    ]
+    db.add_all([branch, *rows])
+    db.flush()
+
+    expiry = [date.today() + timedelta(days=90 * (k + 1)) for k in range(BATCHES_PER_PRODUCT)]
+    db.add_all([
+        BranchProduct(branch_id=branch.id, product_id=product.id, quantity=0, is_available=True)
+        for product in rows
+    ])
+    db.add_all([
+        ProductBatch(branch_id=branch.id, product_id=product.id, quantity=BATCH_QUANTITY, expiration_date=day, is_active=True)
+        for product in rows for day in expiry
+    ])
+    sync_branch_stock(db, branch_id=branch.id)
+    db.commit()
+
+    return {
+        'branch_id': branch.id,
+        'user': {'id': None, 'username': BENCH_NAME, 'role': UserRole.PHARMACIST.value, 'branch_id': branch.id},
+        'product_ids': [product.id for product in rows],
+        'earliest_expiry': expiry[0]
+    }
+
+
+def _cleanup(db, fixtures: dict):
+    branch_id = fixtures['branch_id']
+    report_ids = sa.select(InvReport.id).where(InvReport.branch_id == branch_id)
+    item_ids = sa.select(InvReportItem.id).where(InvReportItem.invreport_id.in_(report_ids))
+    for stmt in [
+        sa.delete(InvReportBatch).where(InvReportBatch.invreport_item_id.in_(item_ids)),
+        sa.delete(InvReportItem).where(InvReportItem.invreport_id.in_(report_ids)),
+        sa.delete(InvReport).where(InvReport.branch_id == branch_id),
+        sa.delete(DailySales).where(DailySales.branch_id == branch_id),
+        sa.delete(ProductBatch).where(ProductBatch.branch_id == branch_id),
+        sa.delete(BranchProduct).where(BranchProduct.branch_id == branch_id),
+        sa.delete(DataVersion).where(DataVersion.scope == branch_scope(branch_id)),
+        sa.delete(Product).where(Product.id.in_(fixtures['product_ids'])),
+        sa.delete(Branch).where(Branch.id == branch_id)
+    ]:
+        db.execute(stmt, execution_options={'synchronize_session': False})
+    db.commit()
+
+
+def _payload(fixtures: dict, size: int, seed: int) -> InvReportCreate:
+    """A report over the first `size` products: offtake on every item, deliveries and pull-outs on some"""
+    rnd = random.Random(seed)
+    # A fresh expiry date per run, so deliveries create batches instead of topping up old ones
+    delivery_expiry = date.today() + timedelta(days=400 + seed)
+    items = []
+    for i, product_id in enumerate(fixtures['product_ids'][:size]):
+        item = {'product_id': product_id, 'beginning': 100, 'selling_area': 100, 'offtake': rnd.randint(1, 5)}
+        if i % DELIVERY_SHARE == 0:
+            item['delivery_batches'] = [{'quantity': 20, 'expiration_date': delivery_expiry}]
+        if i % PULL_OUT_SHARE == 0:
+            item['pull_out_batches'] = [{'quantity': 1, 'expiration_date': fixtures['earliest_expiry']}]
+        items.append(item)
+    now = datetime.now()
+    return InvReportCreate(branch_id=fixtures['branch_id'], start_date=now - timedelta(days=1), end_date=now, items=items)
+
+
+def run_report_benchmark(sizes: List[int] = REPORT_SIZES, repeat: int = 3, keep: bool = False) -> List[dict]:
+    """Time create_inventory_report for reports of each size and count its database round trips.
+
+    Every statement sent to the server counts as one round trip; an
+    executemany batch counts once. Runs on a throwaway inactive branch,
+    removed afterwards unless `keep`. Returns one row per size.
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+
+    db = SessionLocal()
+    fixtures = _fixtures(db, max(sizes))
+    results = []
+    try:
+        run = 0
+        for size in sizes:
+            counts, timings = [], []
+            for _ in range(repeat):
+                payload = _payload(fixtures, size, run)
+                run += 1
+                session = SessionLocal()
+                try:
+                    statements.clear()
+                    started = time.perf_counter()
+                    create_inventory_report(payload, db=session, user=fixtures['user'])
+                    timings.append(time.perf_counter() - started)
+                    counts.append(len(statements))
+                finally:
+                    session.close()
+            results.append({
+                'items': size,
+                'round_trips': max(counts),
+                'median_ms': statistics.median(timings) * 1000,
+                'max_ms': max(timings) * 1000
+            })
+        return results
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+        if not keep:
+            db.rollback()
+            _cleanup(db, fixtures)
+        db.close()
+
+
+if __name__ == '__main__':
+    # python -m bench.report --database-url URL [sizes ...] [--repeat N] [--keep]
+    # on a throwaway branch of that database
+    parser = add_database_url(argparse.ArgumentParser(description=run_report_benchmark.__doc__.splitlines()[0]))
+    parser.add_argument('sizes', type=int, nargs='*', default=REPORT_SIZES)
+    parser.add_argument('--repeat', type=int, default=3, help="reports per size, the median time is shown")
+    parser.add_argument('--keep', action='store_true', help="leave the branch, its products and reports in place")
+    args = parser.parse_args()
+
+    print(f"{'items':>6} {'round trips':>12} {'median ms':>10} {'max ms':>8}")
+    for row in run_report_benchmark(args.sizes, args.repeat, keep=args.keep):
+        print(f"{row['items']:>6} {row['round_trips']:>12} {row['median_ms']:>10.1f} {row['max_ms']:>8.1f}")
@@ -0,0 +1,296 @@
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import List
+
+from bench import add_database_url, require_database_url
+
+require_database_url()
+
+import sqlalchemy as sa
+from fastapi import HTTPException
+
+from api.cache import branch_scope
+from api.database import SessionLocal
+from api.inventory import sync_branch_stock
+from api.models import (
+    Branch,
+    BranchProduct,
+    BranchType,
+    Client,
+    DataVersion,
+    Payment,
+    Product,
+    ProductBatch,
+    ReferenceCounter,
+    Transaction,
+    TransactionItem,
+    TransactionItemBatch,
+    User,
+    UserRole
+)
+from api.routers.transactions import (
+    PaymentCreate,
+    TransactionCreate,
+    VoidTransaction,
+    add_payment,
+    create_transaction,
+    void_payment,
+    void_transaction
+)
+
+STRESS_NAME = "stress-check"
+STRESS_PRODUCTS = 4
+STRESS_BATCHES = 3  # per product, with different expiry dates so sales span batches
+STRESS_BATCH_QUANTITY = 60
+STRESS_CLIENTS = 3
+HOT_TRANSACTIONS = 10  # payments and voids all target the newest few, so they contend
+
+
+def _fixtures(db) -> dict:
+    """An inactive wholesale branch with its own user, clients, products and batches"""
+    branch = Branch(branch_name=STRESS_NAME, location=STRESS_NAME, branch_type=BranchType.WHOLESALE.value, is_active=False)
+    db.add(branch)
+    db.flush()
+    user = User(username=f"{STRESS_NAME}-{branch.id}", role=UserRole.WHOLESALER.value, branch_id=branch.id)
+    clients = [
+        Client(name=f"{STRESS_NAME}-{i}", credit_limit=1e9, current_balance=0, payment_terms=30, markup_percentage=0.1)
+        for i in range(STRESS_CLIENTS)
+    ]
+    products = [
+        Product(name=f"{STRESS_NAME}-{i}", cost=10 + i, srp=15 + i, is_retail_available=False, is_wholesale_available=True)
+        for i in range(STRESS_PRODUCTS)
+    ]
+    db.add_all([user, *clients, *products])
+    db.flush()
+
+    batches = []
+    for product in products:
+        db.add(BranchProduct(branch_id=branch.id, product_id=product.id, quantity=0, is_available=True))
+        for k in range(STRESS_BATCHES):
+            batches.append(ProductBatch(
+                branch_id=branch.id,
+                product_id=product.id,
+                quantity=STRESS_BATCH_QUANTITY,
+                expiration_date=date.today() + timedelta(days=30 * (k + 1)),
+                is_active=True
+            ))
+    db.add_all(batches)
+    sync_branch_stock(db, branch_id=branch.id)
+    db.commit()
+
+    return {
+        'branch_id': branch.id,
+        'user': {'id': user.id, 'username': user.username, 'role': user.role, 'branch_id': branch.id},
+        'client_ids': [client.id for client in clients],
+        'product_ids': [product.id for product in products],
+        'initial': {batch.id: batch.quantity for batch in batches}
+    }
+
+
+def _cleanup(db, fixtures: dict):
+    branch_id = fixtures['branch_id']
+    transaction_ids = sa.select(Transaction.id).where(Transaction.branch_id == branch_id)
+    item_ids = sa.select(TransactionItem.id).where(TransactionItem.transaction_id.in_(transaction_ids))
+    for stmt in [
+        sa.delete(TransactionItemBatch).where(TransactionItemBatch.transaction_item_id.in_(item_ids)),
+        sa.delete(TransactionItem).where(TransactionItem.transaction_id.in_(transaction_ids)),
+        sa.delete(Payment).where(Payment.transaction_id.in_(transaction_ids)),
+        sa.delete(Transaction).where(Transaction.branch_id == branch_id),
+        sa.delete(ProductBatch).where(ProductBatch.branch_id == branch_id),
+        sa.delete(BranchProduct).where(BranchProduct.branch_id == branch_id),
+        sa.delete(ReferenceCounter).where(ReferenceCounter.branch_id == branch_id),
+        sa.delete(DataVersion).where(DataVersion.scope == branch_scope(branch_id)),
+        sa.delete(User).where(User.id == fixtures['user']['id']),
+        sa.delete(Client).where(Client.id.in_(fixtures['client_ids'])),
+        sa.delete(Product).where(Product.id.in_(fixtures['product_ids'])),
+        sa.delete(Branch).where(Branch.id == branch_id)
+    ]:
+        db.execute(stmt, execution_options={'synchronize_session': False})
+    db.commit()
+
+
+def _operation(fixtures: dict, seed: int, sales_only: bool = False):
+    """One random request against the fixtures: (kind, outcome) where outcome is ok, a status code or an error"""
+    rnd = random.Random(seed)
+    user = fixtures['user']
+    kind = 'sale' if sales_only else rnd.choice(['sale', 'sale', 'payment', 'payment', 'void_payment', 'void_transaction'])
+    db = SessionLocal()
+    try:
+        if kind != 'sale':
+            candidates = [
+                id for (id,) in db.query(Transaction.id)
+                .filter(Transaction.branch_id == fixtures['branch_id'])
+                .order_by(Transaction.id.desc())
+                .limit(HOT_TRANSACTIONS)
+            ]
+            if not candidates:
+                kind = 'sale'
+
+        if kind == 'sale':
+            order = TransactionCreate(
+                client_id=rnd.choice(fixtures['client_ids']),
+                initial_payment=rnd.choice([0, 0, 5.25]),
+                items=[
+                    {'product_id': product_id, 'quantity': rnd.randint(1, 5)}
+                    for product_id in rnd.sample(fixtures['product_ids'], rnd.randint(1, 2))
+                ]
+            )
+            transaction = create_transaction(order, db=db, user=user)
+            return kind, ('ok', transaction.id, transaction.reference_number)
+
+        transaction_id = rnd.choice(candidates)
+        if kind == 'payment':
+            add_payment(transaction_id, PaymentCreate(amount=1.25), db=db, user=user)
+        elif kind == 'void_payment':
+            payment_id = db.query(Payment.id).filter(Payment.transaction_id == transaction_id).order_by(Payment.id).limit(1).scalar()
+            if payment_id is None:
+                return kind, 'no payment'
+            void_payment(transaction_id, payment_id, VoidTransaction(reason=STRESS_NAME), db=db, user=user)
+        else:
+            void_transaction(transaction_id, VoidTransaction(reason=STRESS_NAME), db=db, user=user)
+        return kind, 'ok'
+    except HTTPException as e:
+        db.rollback()
+        return kind, e.status_code
+    except Exception as e:
+        db.rollback()
+        return kind, type(e).__name__
+    finally:
+        db.close()
+
+
+def _check(db, fixtures: dict, references: List[str]) -> List[str]:
+    """Invariants that lost updates or double allocations would break, as a list of problems"""
+    problems = []
+    branch_id = fixtures['branch_id']
+
+    if len(set(references)) != len(references):
+        problems.append(f"{len(references) - len(set(references))} duplicate references handed out")
+    stored = [ref for (ref,) in db.query(Transaction.reference_number).filter(Transaction.branch_id == branch_id)]
+    if sorted(stored) != sorted(references):
+        problems.append(f"{len(stored)} stored references for {len(references)} successful sales")
+    sequences = sorted(int(ref.rsplit('-', 1)[1]) for ref in stored)
+    if sequences != list(range(1, len(sequences) + 1)):
+        problems.append("reference numbers of the day are not 1..n")
+
+    paid = sa.func.coalesce(sa.func.sum(Payment.amount).filter(Payment.is_void == False), 0)
+    mismatched = (
+        db.query(Transaction.id)
+        .outerjoin(Payment, Payment.transaction_id == Transaction.id)
+        .filter(Transaction.branch_id == branch_id)
+        .group_by(Transaction.id)
+        .having(sa.func.abs(Transaction.amount_paid - paid) > 0.005)
+        .all()
+    )
+    if mismatched:
+        problems.append(f"{len(mismatched)} transactions whose amount_paid differs from their payments")
+
+    open_balance = (
+        sa.select(sa.func.coalesce(sa.func.sum(Transaction.total_amount - Transaction.amount_paid), 0))
+        .where(Transaction.client_id == Client.id, Transaction.is_void == False)
+        .scalar_subquery()
+    )
+    clients = (
+        db.query(Client.id)
+        .filter(
+            Client.id.in_(fixtures['client_ids']),
+            sa.func.abs(Client.current_balance - open_balance) > 0.005
+        )
+        .all()
+    )
+    if clients:
+        problems.append(f"{len(clients)} clients whose balance differs from their open transactions")
+
+    sold = dict(
+        db.query(TransactionItemBatch.product_batch_id, sa.func.sum(TransactionItemBatch.quantity))
+        .join(TransactionItem, TransactionItem.id == TransactionItemBatch.transaction_item_id)
+        .join(Transaction, Transaction.id == TransactionItem.transaction_id)
+        .filter(Transaction.branch_id == branch_id, Transaction.is_void == False)
+        .group_by(TransactionItemBatch.product_batch_id)
+    )
+    for batch_id, quantity in db.query(ProductBatch.id, ProductBatch.quantity).filter(ProductBatch.branch_id == branch_id):
+        expected = fixtures['initial'][batch_id] - sold.get(batch_id, 0)
+        if quantity != expected:
+            problems.append(f"batch {batch_id} holds {quantity}, expected {expected}")
+        if quantity < 0:
+            problems.append(f"batch {batch_id} is negative")
+
+    active = (
+        sa.select(sa.func.coalesce(sa.func.sum(ProductBatch.quantity), 0))
+        .where(
+            ProductBatch.branch_id == BranchProduct.branch_id,
+            ProductBatch.product_id == BranchProduct.product_id,
+            ProductBatch.is_active == True
+        )
+        .scalar_subquery()
+    )
+    drifted = db.query(BranchProduct.product_id).filter(BranchProduct.branch_id == branch_id, BranchProduct.quantity != active).all()
+    if drifted:
+        problems.append(f"{len(drifted)} branch products whose quantity differs from their batches")
+
+    return problems
+
+
+def run_stress_check(sales: int = 200, operations: int = 400, workers: int = 12, keep: bool = False) -> List[str]:
+    """Hammer the transaction endpoints from parallel sessions and check the results add up.
+
+    Runs `sales` concurrent sales, which between them ask for more stock
+    than there is, then `operations` concurrent sales, payments, payment
+    voids and transaction voids on the newest few transactions. Everything
+    happens on a throwaway inactive branch, removed afterwards unless
+    `keep`. Returns the problems found, empty when every invariant holds.
+    """
+    db = SessionLocal()
+    fixtures = _fixtures(db)
+    try:
+        outcomes = Counter()
+        references = []
+        for phase, count, sales_only in [('sales', sales, True), ('mixed', operations, False)]:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda seed: _operation(fixtures, seed, sales_only), range(count)))
+            for kind, outcome in results:
+                if isinstance(outcome, tuple):
+                    references.append(outcome[2])
+                    outcome = 'ok'
+                outcomes[(kind, outcome)] += 1
+            print(f"{phase}: {count} requests in {time.perf_counter() - started:.1f}s")
+
+        for (kind, outcome), count in sorted(outcomes.items(), key=str):
+            print(f"  {kind:<16} {outcome!s:<20} {count}")
+
+        problems = [
+            f"{count} {kind} requests failed with {outcome}"
+            for (kind, outcome), count in outcomes.items()
+            if isinstance(outcome, str) and outcome not in ('ok', 'no payment')
+        ]
+        db.expire_all()
+        problems += _check(db, fixtures, references)
+        return problems
+    finally:
+        if not keep:
+            db.rollback()
+            _cleanup(db, fixtures)
+        db.close()
+
+
+if __name__ == '__main__':
+    # python -m bench.stress --database-url URL [sales] [operations] [workers] [--keep]
+    # on a throwaway branch of that database; exits 1 on any problem
+    parser = add_database_url(argparse.ArgumentParser(description=run_stress_check.__doc__.splitlines()[0]))
+    parser.add_argument('sales', type=int, nargs='?', default=200)
+    parser.add_argument('operations', type=int, nargs='?', default=400)
+    parser.add_argument('workers', type=int, nargs='?', default=12)
+    parser.add_argument('--keep', action='store_true', help="leave the stress branch and its rows in place")
+    args = parser.parse_args()
+
+    problems = run_stress_check(args.sales, args.operations, args.workers, keep=args.keep)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    print("OK" if not problems else f"{len(problems)} problems")
+    sys.exit(1 if problems else 0)
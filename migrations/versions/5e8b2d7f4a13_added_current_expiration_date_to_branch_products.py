@@ -0,0 +1,70 @@
+"""added current_expiration_date to branch products
+
+Revision ID: 5e8b2d7f4a13
+Revises: 9c1d4e7a2b60
+Create Date: 2026-10-17 11:26:54.730184
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e8b2d7f4a13'
+down_revision: Union[str, None] = '9c1d4e7a2b60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('branch_products', sa.Column('current_expiration_date', sa.Date(), nullable=True))
+
+    # Bring quantity and expiry in line with the active batches once,
+    # from here on every batch mutation keeps them in step (api.inventory.sync_branch_stock)
+    op.execute("""
+        UPDATE branch_products
+        SET quantity = COALESCE((
+                SELECT sum(product_batches.quantity)
+                FROM product_batches
+                WHERE product_batches.branch_id = branch_products.branch_id
+                  AND product_batches.product_id = branch_products.product_id
+                  AND product_batches.is_active
+            ), 0),
+            current_expiration_date = (
+                SELECT min(product_batches.expiration_date)
+                FROM product_batches
+                WHERE product_batches.branch_id = branch_products.branch_id
+                  AND product_batches.product_id = branch_products.product_id
+                  AND product_batches.is_active
+                  AND product_batches.quantity > 0
+            )
+    """)
+    # and refresh low stock state for the corrected quantities
+    op.execute("""
+        UPDATE branch_products
+        SET low_stock_since = CASE WHEN branch_products.low_stock_since IS NULL THEN LOCALTIMESTAMP END
+        FROM branches, products
+        WHERE branches.id = branch_products.branch_id
+          AND products.id = branch_products.product_id
+          AND (branch_products.low_stock_since IS NULL) = (
+              branch_products.is_available
+              AND branch_products.quantity <= CASE WHEN branches.branch_type = 'wholesale'
+                                                   THEN products.wholesale_low_stock_threshold
+                                                   ELSE products.retail_low_stock_threshold END
+          )
+    """)
+
+    op.alter_column('branch_products', 'quantity',
+               existing_type=sa.INTEGER(),
+               nullable=False,
+               server_default='0')
+
+
+def downgrade() -> None:
+    op.alter_column('branch_products', 'quantity',
+               existing_type=sa.INTEGER(),
+               nullable=True,
+               server_default=None)
+    op.drop_column('branch_products', 'current_expiration_date')
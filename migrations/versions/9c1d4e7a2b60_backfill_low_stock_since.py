@@ -0,0 +1,38 @@
+"""backfill low_stock_since
+
+Revision ID: 9c1d4e7a2b60
+Revises: 3b7e1f0c9a42
+Create Date: 2026-10-17 10:03:18.221907
+
+"""
+from typing import Sequence, Union
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c1d4e7a2b60'
+down_revision: Union[str, None] = '3b7e1f0c9a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # low_stock_since used to be set lazily by GET requests, bring every row up to date once,
+    # as api.inventory.refresh_low_stock does: set where newly low, cleared where no longer low
+    op.execute("""
+        UPDATE branch_products
+        SET low_stock_since = CASE WHEN branch_products.low_stock_since IS NULL THEN LOCALTIMESTAMP END
+        FROM branches, products
+        WHERE branches.id = branch_products.branch_id
+          AND products.id = branch_products.product_id
+          AND (branch_products.low_stock_since IS NULL) = (
+              branch_products.is_available
+              AND branch_products.quantity <= CASE WHEN branches.branch_type = 'wholesale'
+                                                   THEN products.wholesale_low_stock_threshold
+                                                   ELSE products.retail_low_stock_threshold END
+          )
+    """)
+
+
+def downgrade() -> None:
+    pass
@@ -0,0 +1,53 @@
+"""added hot path indexes
+
+Revision ID: b4f7c2e9d810
+Revises: 5e8b2d7f4a13
+Create Date: 2026-10-17 12:48:05.316492
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4f7c2e9d810'
+down_revision: Union[str, None] = '5e8b2d7f4a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+INDEXES = [
+    ('ix_product_batches_active', 'product_batches', ['branch_id', 'product_id', 'expiration_date'],
+     dict(postgresql_where=sa.text('is_active'))),
+    ('ix_product_batches_active_expiration_date', 'product_batches', ['expiration_date'],
+     dict(postgresql_where=sa.text('is_active AND quantity > 0'))),
+    ('ix_invreports_branch_id_created_at', 'invreports', ['branch_id', 'created_at'], {}),
+    ('ix_invreports_branch_id_end_date', 'invreports', ['branch_id', 'end_date'], {}),
+    ('ix_invreports_end_date', 'invreports', ['end_date'], {}),
+    ('ix_invreport_items_invreport_id_product_id', 'invreport_items', ['invreport_id', 'product_id'],
+     dict(postgresql_include=['offtake', 'current_srp', 'current_cost'])),
+    ('ix_invreport_items_product_id', 'invreport_items', ['product_id'], {}),
+    ('ix_invreport_batches_invreport_item_id', 'invreport_batches', ['invreport_item_id'], {}),
+    ('ix_expenses_date_created_scope', 'expenses', ['date_created', 'scope'], {}),
+    ('ix_expenses_branch_id_date_created', 'expenses', ['branch_id', 'date_created'], {}),
+    ('ix_transactions_branch_id_transaction_date', 'transactions', ['branch_id', 'transaction_date'], {}),
+    ('ix_transactions_client_id_transaction_date', 'transactions', ['client_id', 'transaction_date'], {}),
+    ('ix_transaction_items_transaction_id', 'transaction_items', ['transaction_id'], {}),
+    ('ix_payments_transaction_id', 'payments', ['transaction_id'], {}),
+]
+
+
+def upgrade() -> None:
+    # CONCURRENTLY keeps the tables writable while the indexes build,
+    # it cannot run inside the migration transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns, kwargs in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **kwargs)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns, kwargs in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,128 @@
+"""partitioned analytics_timeseries and analytics_rollups table
+
+Revision ID: c81d5f3a7e26
+Revises: 7a3c9e1f2d45
+Create Date: 2026-10-17 17:42:09.531274
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c81d5f3a7e26'
+down_revision: Union[str, None] = '7a3c9e1f2d45'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PARTITION_MONTHS_AHEAD = 2
+
+
+def _timeseries_table(name, *args, **kw):
+    return op.create_table(name,
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('analytics_timeseries_id_seq')"), nullable=False),
+    sa.Column('metric_name', sa.String(), nullable=False),
+    sa.Column('value', sa.Float(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('branch_id', sa.Integer(), nullable=True),
+    sa.Column('product_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['branch_id'], ['branches.id'], ),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    *args,
+    **kw
+    )
+
+
+def _rename_timeseries(suffix):
+    op.execute(f"ALTER TABLE analytics_timeseries RENAME TO analytics_timeseries_{suffix}")
+    op.execute(f"ALTER TABLE analytics_timeseries_{suffix} RENAME CONSTRAINT analytics_timeseries_pkey TO analytics_timeseries_{suffix}_pkey")
+    op.execute(f"ALTER INDEX ix_analytics_timeseries_id RENAME TO ix_analytics_timeseries_{suffix}_id")
+
+
+def _next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _create_partitions(start):
+    """Monthly partitions from the month of `start` to PARTITION_MONTHS_AHEAD months from now, plus a default one"""
+    op.execute("CREATE TABLE analytics_timeseries_default PARTITION OF analytics_timeseries DEFAULT")
+    month = start.replace(day=1)
+    last = date.today().replace(day=1)
+    for _ in range(PARTITION_MONTHS_AHEAD):
+        last = _next_month(last)
+    while month <= last:
+        following = _next_month(month)
+        op.execute(
+            f"CREATE TABLE analytics_timeseries_{month:%Y_%m} "
+            f"PARTITION OF analytics_timeseries "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        )
+        month = following
+
+
+def _copy_timeseries(source):
+    op.execute(
+        "INSERT INTO analytics_timeseries (id, metric_name, value, timestamp, branch_id, product_id) "
+        f"SELECT id, metric_name, value, COALESCE(timestamp, now()), branch_id, product_id FROM {source}"
+    )
+    op.execute("ALTER SEQUENCE analytics_timeseries_id_seq OWNED BY analytics_timeseries.id")
+    op.drop_table(source)
+
+
+def upgrade() -> None:
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('analytics_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('resolution', sa.String(), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('metric_name', sa.String(), nullable=False),
+    sa.Column('branch_id', sa.Integer(), nullable=True),
+    sa.Column('product_id', sa.Integer(), nullable=True),
+    sa.Column('value_count', sa.Integer(), nullable=False),
+    sa.Column('value_sum', sa.Float(), nullable=False),
+    sa.Column('value_min', sa.Float(), nullable=False),
+    sa.Column('value_max', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['branch_id'], ['branches.id'], ),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    if_not_exists=True
+    )
+    op.create_index('ix_analytics_rollups_metric_name_bucket', 'analytics_rollups', ['metric_name', 'bucket'], unique=False, if_not_exists=True)
+    op.create_index('ix_analytics_rollups_resolution_bucket', 'analytics_rollups', ['resolution', 'bucket'], unique=False, if_not_exists=True)
+    # ### end Alembic commands ###
+
+    # A table cannot be turned into a partitioned one in place: rebuild it
+    # under the same name, keeping ids and the sequence
+    _rename_timeseries('old')
+    _timeseries_table('analytics_timeseries',
+    sa.PrimaryKeyConstraint('id', 'timestamp'),
+    postgresql_partition_by='RANGE (timestamp)'
+    )
+    op.create_index('ix_analytics_timeseries_id', 'analytics_timeseries', ['id'], unique=False)
+    op.create_index('ix_analytics_timeseries_timestamp', 'analytics_timeseries', ['timestamp'], unique=False)
+
+    bind = op.get_bind()
+    oldest = bind.execute(sa.text("SELECT min(timestamp)::date FROM analytics_timeseries_old")).scalar()
+    _create_partitions(oldest or date.today())
+
+    _copy_timeseries('analytics_timeseries_old')
+
+
+def downgrade() -> None:
+    # Compacted buckets cannot be split back into points, only raw points are kept
+    _rename_timeseries('partitioned')
+    _timeseries_table('analytics_timeseries',
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_analytics_timeseries_id', 'analytics_timeseries', ['id'], unique=False)
+    op.drop_index('ix_analytics_timeseries_timestamp', table_name='analytics_timeseries_partitioned')
+    _copy_timeseries('analytics_timeseries_partitioned')
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index('ix_analytics_rollups_resolution_bucket', table_name='analytics_rollups')
+    op.drop_index('ix_analytics_rollups_metric_name_bucket', table_name='analytics_rollups')
+    op.drop_table('analytics_rollups')
+    # ### end Alembic commands ###
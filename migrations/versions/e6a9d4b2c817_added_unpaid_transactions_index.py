@@ -0,0 +1,36 @@
+"""added unpaid transactions index
+
+Revision ID: e6a9d4b2c817
+Revises: c5f1a8d3e472
+Create Date: 2026-10-17 23:12:47.908153
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6a9d4b2c817'
+down_revision: Union[str, None] = 'c5f1a8d3e472'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY keeps transactions writable while the index builds,
+    # it cannot run inside the migration transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_transactions_unpaid_branch_id_due_date', 'transactions', ['branch_id', 'due_date'],
+            postgresql_where=sa.text("payment_status != 'paid' AND is_void = false"),
+            postgresql_include=['client_id', 'total_amount', 'amount_paid'],
+            postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_unpaid_branch_id_due_date', table_name='transactions',
+                      postgresql_concurrently=True, if_exists=True)